@@ -0,0 +1,9 @@
+from .backends import CacheBackend, MemoryCacheBackend, RedisCacheBackend
+from .manager import CacheNode, CacheManager
+from .model import ModelCache, JSONSerializer
+from .local import LocalCache
+from .query import QueryCache
+from .flight import SingleFlight
+from .negative import NegativeCache
+from .bus import InvalidationBus
+from .replica import ReplicaTable
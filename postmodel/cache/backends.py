@@ -0,0 +1,308 @@
+
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+class CacheBackend:
+    """
+    Base cache backend.
+
+    Items are hashes of string fields stored under one key, like Redis hashes.
+    ``shared`` backends are shared by processes, others are local to process.
+    """
+    shared = True
+
+    async def get_item(self, key: str) -> Dict[str, str]:
+        raise NotImplementedError()
+
+    async def set_item(self, key: str, mapping: Dict[str, Any],
+            deleted_fields: Iterable[str] = (), expire: Optional[int] = None) -> None:
+        raise NotImplementedError()
+
+    async def set_item_if(self, key: str, check: Callable[[Dict[str, str]], bool],
+            mapping: Dict[str, Any], deleted_fields: Iterable[str] = (),
+            expire: Optional[int] = None) -> bool:
+        """
+        Set item like ``set_item`` if ``check`` of the current item is true,
+        atomically, returns False if it is not set.
+        """
+        raise NotImplementedError()
+
+    async def incr_field(self, key: str, field: str, amount: int = 1,
+            expire: Optional[int] = None) -> int:
+        raise NotImplementedError()
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError()
+
+    async def info(self) -> dict:
+        raise NotImplementedError()
+
+    async def close(self) -> None:
+        pass
+
+    def describe(self) -> str:
+        return self.__class__.__name__
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    In-process cache backend, items are kept in a dict of the current process.
+    """
+    shared = False
+
+    def __init__(self) -> None:
+        self.items = {}  # type: Dict[str, Dict[str, str]]
+        self.expires = {}  # type: Dict[str, float]
+
+    def _get(self, key):
+        expire_at = self.expires.get(key)
+        if expire_at is not None and expire_at <= time.monotonic():
+            self.items.pop(key, None)
+            self.expires.pop(key, None)
+        return self.items.get(key)
+
+    def _expire(self, key, expire):
+        if expire is not None:
+            self.expires[key] = time.monotonic() + expire
+
+    async def get_item(self, key):
+        return dict(self._get(key) or {})
+
+    async def set_item(self, key, mapping, deleted_fields=(), expire=None):
+        item = self._get(key)
+        if item is None:
+            item = self.items[key] = {}
+        for field in deleted_fields:
+            item.pop(field, None)
+        item.update({k: str(v) for k, v in mapping.items()})
+        self._expire(key, expire)
+
+    async def set_item_if(self, key, check, mapping, deleted_fields=(), expire=None):
+        if not check(dict(self._get(key) or {})):
+            return False
+        await self.set_item(key, mapping, deleted_fields, expire)
+        return True
+
+    async def incr_field(self, key, field, amount=1, expire=None):
+        item = self._get(key)
+        if item is None:
+            item = self.items[key] = {}
+        value = int(item.get(field, 0)) + amount
+        item[field] = str(value)
+        self._expire(key, expire)
+        return value
+
+    async def delete(self, key):
+        self.items.pop(key, None)
+        self.expires.pop(key, None)
+
+    async def info(self):
+        return {"process_id": os.getpid()}
+
+    async def clear(self):
+        self.items.clear()
+        self.expires.clear()
+
+    def describe(self):
+        return "memory://"
+
+
+class RedisReplyError(Exception):
+    """
+    Error reply returned by redis server.
+    """
+
+
+class RedisConnection:
+    """
+    Minimal connection speaking the redis protocol (RESP), commands are pipelined.
+    """
+
+    def __init__(self, host, port, db=0, password=None, timeout=None) -> None:
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        if self.password:
+            await self.execute(("AUTH", self.password))
+        if self.db:
+            await self.execute(("SELECT", self.db))
+
+    @staticmethod
+    def encode_command(args) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by redis server")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b"+":
+            return body.decode("utf-8")
+        if prefix == b"-":
+            return RedisReplyError(body.decode("utf-8"))
+        if prefix == b":":
+            return int(body)
+        if prefix == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2]
+        if prefix == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [await self.read_reply() for _ in range(length)]
+        raise ConnectionError(f"unknown redis reply: {line!r}")
+
+    async def execute(self, *commands) -> List[Any]:
+        self.writer.write(b"".join(self.encode_command(args) for args in commands))
+        await self.writer.drain()
+        replies = []
+        for _ in commands:
+            replies.append(await asyncio.wait_for(self.read_reply(), self.timeout))
+        for reply in replies:
+            if isinstance(reply, RedisReplyError):
+                raise reply
+        return replies
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Cache backend for redis server, or any server speaking the redis protocol.
+
+    Connection errors are raised as ``ConnectionError`` so the caller can mark
+    the node down.
+    """
+
+    def __init__(self, host="127.0.0.1", port=6379, db=0, password=None,
+            max_connections=10, timeout=5) -> None:
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.idle = []  # type: List[RedisConnection]
+        self.semaphore = asyncio.Semaphore(max_connections)
+
+    async def execute(self, *commands):
+        return await self._run(lambda connection: connection.execute(*commands))
+
+    async def _run(self, func):
+        """
+        Returns result of ``func(connection)`` run on an idle connection.
+        """
+        async with self.semaphore:
+            connection = self.idle.pop() if self.idle else None
+            try:
+                if connection is None:
+                    connection = RedisConnection(self.host, self.port, self.db,
+                        self.password, self.timeout)
+                    await connection.connect()
+                result = await func(connection)
+            except RedisReplyError:
+                self.idle.append(connection)
+                raise
+            except (OSError, EOFError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                if connection is not None:
+                    connection.close()
+                # idle connections to a failed server are likely broken too
+                for idle in self.idle:
+                    idle.close()
+                self.idle = []
+                raise ConnectionError(f"redis {self.describe()} error: {e!r}") from e
+            self.idle.append(connection)
+            return result
+
+    @staticmethod
+    def _decode_item(reply):
+        return {
+            reply[i].decode("utf-8"): reply[i + 1].decode("utf-8")
+            for i in range(0, len(reply), 2)
+        }
+
+    async def get_item(self, key):
+        reply, = await self.execute(("HGETALL", key))
+        return self._decode_item(reply)
+
+    async def set_item(self, key, mapping, deleted_fields=(), expire=None):
+        commands = self._set_commands(key, mapping, deleted_fields, expire)
+        if commands:
+            await self.execute(*commands)
+
+    async def set_item_if(self, key, check, mapping, deleted_fields=(), expire=None):
+        commands = self._set_commands(key, mapping, deleted_fields, expire)
+
+        async def watched(connection):
+            # EXEC fails if the item is changed after WATCH
+            _, reply = await connection.execute(("WATCH", key), ("HGETALL", key))
+            if not check(self._decode_item(reply)):
+                await connection.execute(("UNWATCH", ))
+                return False
+            replies = await connection.execute(("MULTI", ), *commands, ("EXEC", ))
+            return replies[-1] is not None
+
+        return await self._run(watched)
+
+    @staticmethod
+    def _set_commands(key, mapping, deleted_fields, expire):
+        commands = []
+        deleted_fields = list(deleted_fields)
+        if deleted_fields:
+            commands.append(("HDEL", key, *deleted_fields))
+        if mapping:
+            args = ["HSET", key]
+            for k, v in mapping.items():
+                args.extend((k, v))
+            commands.append(args)
+        if expire is not None:
+            commands.append(("EXPIRE", key, expire))
+        return commands
+
+    async def incr_field(self, key, field, amount=1, expire=None):
+        commands = [("HINCRBY", key, field, amount)]
+        if expire is not None:
+            commands.append(("EXPIRE", key, expire))
+        replies = await self.execute(*commands)
+        return replies[0]
+
+    async def delete(self, key):
+        await self.execute(("DEL", key))
+
+    async def info(self):
+        reply, = await self.execute(("INFO", "server"))
+        info = {}
+        for line in reply.decode("utf-8").splitlines():
+            if ":" in line and not line.startswith("#"):
+                name, value = line.split(":", 1)
+                info[name] = int(value) if value.isdigit() else value
+        return info
+
+    async def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+    def describe(self):
+        return f"redis://{self.host}:{self.port}/{self.db}"
@@ -0,0 +1,112 @@
+
+import inspect
+import json
+import uuid
+import weakref
+from basepy.asynclog import logger
+
+
+class InvalidationBus:
+    """
+    Cross process cache invalidation with postgres ``LISTEN/NOTIFY``.
+
+    Mapper writes publish ``(table, pks)`` messages on the channel. In transaction
+    the messages are collected and sent by one ``NOTIFY`` right before commit, which
+    postgres delivers only when the transaction commits. Each process listens on
+    a dedicated connection and passes messages of other processes to subscribers.
+
+    Message payload is json ``[sender, table, pks]``, empty pks means rows of table
+    are unknown, e.g. for bulk insert.
+    """
+
+    CHANNEL = "postmodel_invalidation"
+    MAX_PAYLOAD = 7900
+
+    def __init__(self, db, channel=CHANNEL):
+        self.db = db
+        self.channel = channel
+        self.sender = uuid.uuid4().hex[:12]
+        self.subscribers = []
+        self.pending = weakref.WeakKeyDictionary()
+        self.received = 0
+
+    async def start(self):
+        await self.db.listen(self.channel, self.on_message)
+
+    def subscribe(self, callback):
+        """
+        Subscribe to messages of other processes with ``callback(table, pks)``,
+        which may be a coroutine function. ``table`` is None when messages may
+        have been lost, then everything cached should be dropped.
+        """
+        self.subscribers.append(callback)
+
+    def _dumps(self, table, pks):
+        return json.dumps([self.sender, table, pks], default=str, separators=(',', ':'))
+
+    def encode(self, table, pks):
+        """
+        Returns payloads for the message, pks are split so that every payload is
+        within the ``NOTIFY`` size limit.
+        """
+        payloads = []
+        chunk = []
+        base_size = size = len(self._dumps(table, []))
+        for pk in pks:
+            pk = list(pk) if isinstance(pk, tuple) else pk
+            pk_size = len(json.dumps(pk, default=str)) + 1
+            if chunk and size + pk_size > self.MAX_PAYLOAD:
+                payloads.append(self._dumps(table, chunk))
+                chunk = []
+                size = base_size
+            chunk.append(pk)
+            size += pk_size
+        if chunk or not payloads:
+            payloads.append(self._dumps(table, chunk))
+        return payloads
+
+    async def publish(self, table, pks=()):
+        transacted_conn = self.db._current_transacted_conn()
+        if not transacted_conn:
+            await self._send({table: list(pks)})
+            return
+        pending = self.pending.get(transacted_conn)
+        if pending is None:
+            pending = self.pending[transacted_conn] = {}
+
+            async def send():
+                await self._send(self.pending.pop(transacted_conn, {}))
+
+            await self.db.before_commit(send)
+        pks = list(pks)
+        if not pks:
+            # no pks stand for unknown rows, None marks all rows of table changed
+            pending[table] = None
+        elif table not in pending:
+            pending[table] = pks
+        elif pending[table] is not None:
+            pending[table].extend(pks)
+
+    async def _send(self, messages):
+        for table, pks in messages.items():
+            pks = [] if pks is None else list(dict.fromkeys(pks))
+            for payload in self.encode(table, pks):
+                await self.db.notify(self.channel, payload)
+
+    async def on_message(self, payload):
+        if payload is None:
+            table, pks = None, []
+        else:
+            try:
+                sender, table, pks = json.loads(payload)
+            except (TypeError, ValueError):
+                await logger.error('postmodel_invalid_notification', payload=payload)
+                return
+            if sender == self.sender:
+                return
+            pks = [tuple(pk) if isinstance(pk, list) else pk for pk in pks]
+        self.received += 1
+        for callback in self.subscribers:
+            ret = callback(table, pks)
+            if inspect.isawaitable(ret):
+                await ret
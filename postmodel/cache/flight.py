@@ -0,0 +1,54 @@
+
+import asyncio
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time, callers of a key already running wait
+    for its result instead of running it again.
+
+    When the running call is cancelled, callers waiting for it run the call
+    themselves.
+    """
+
+    def __init__(self):
+        self.calls = {}  # key -> future
+        self.collapsed = 0
+
+    def running(self, key):
+        return key in self.calls
+
+    async def run(self, key, func):
+        """
+        Returns ``(result, shared)``, ``shared`` is True if the result was
+        returned by a call started by another caller.
+        """
+        while True:
+            future = self.calls.get(key)
+            if future is None:
+                break
+            self.collapsed += 1
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+
+        future = asyncio.get_event_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # retrieved, it is raised by this caller
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            if self.calls.get(key) is future:
+                del self.calls[key]
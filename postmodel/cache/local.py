@@ -0,0 +1,63 @@
+
+import time
+from collections import OrderedDict
+
+
+class LocalCache:
+    """
+    Per process LRU cache of model field values with ``ttl``, the first tier
+    in front of the model cache nodes.
+
+    Values are stored by primary key. A value is stored only if no key was
+    invalidated since ``generation`` was taken before reading it, so a read
+    racing with a writer never keeps the old row.
+    """
+
+    def __init__(self, max_entries=1000, ttl=5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # pk -> (expire_at, data)
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, pk):
+        entry = self.entries.get(pk)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self.entries[pk]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(pk)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, pk, data, generation):
+        if generation != self.generation:
+            return False
+        self.entries.pop(pk, None)
+        self.entries[pk] = (time.monotonic() + self.ttl, data)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def discard(self, pk):
+        self.generation += 1
+        self.entries.pop(pk, None)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,178 @@
+
+import importlib
+import time
+from urllib.parse import urlparse, parse_qs
+from basepy.asynclog import logger
+
+from postmodel.exceptions import ConfigurationError
+
+CACHE_NODE_ERRORS = (ConnectionError, OSError)
+
+
+class CacheNode:
+    """
+    One cache server with status ``up``, ``down`` or ``starting``.
+
+    When an operation fails the node goes ``down`` and is checked again every
+    ``check_interval`` seconds. Keys written while the node is down are remembered
+    and marked dirty when it comes back. A node coming back is ``starting`` for
+    ``start_cycle`` intervals, it takes writes but reads are not served from it.
+    """
+
+    MAX_DIRTY_KEYS = 100000
+
+    def __init__(self, backend, check_interval=60, start_cycle=2):
+        self.backend = backend
+        self.status = 'up'  # 'down', 'starting', 'up'
+        self.status_time = 0
+        self.process_id = -1
+        self.last_check_time = 0
+        self.check_interval = check_interval
+        self.start_cycle = start_cycle
+        self.dirty_keys = set()
+        self.dirty_overflow = False
+
+    async def log_status(self):
+        node_desc = self.backend.describe()
+        if self.status == 'down':
+            await logger.error('postmodel_cache_down', cache_node=node_desc)
+        await logger.info(f'cache node <{node_desc}> status changed to {self.status}')
+
+    async def check_node(self):
+        try:
+            self.last_check_time = time.time()
+            info = await self.backend.info()
+            process_id = info.get('process_id')
+            if self.process_id != -1 and process_id == self.process_id:
+                return True
+            else:
+                self.process_id = process_id
+        except CACHE_NODE_ERRORS:
+            return False
+        return True
+
+    async def check_status(self):
+        if self.status == 'down':
+            if time.time() - self.last_check_time > self.check_interval:
+                if await self.check_node() and await self.flush_dirty_keys():
+                    self.status_time = time.time()
+                    self.status = 'starting'
+                    await self.log_status()
+        elif self.status == 'starting':
+            if time.time() - self.status_time > self.check_interval * self.start_cycle:
+                self.status_time = time.time()
+                self.status = 'up'
+                await self.log_status()
+        elif self.status == 'up':
+            if self.process_id == -1:
+                if not await self.check_node():
+                    await self.node_down()
+
+    def get_client(self):
+        if self.status in ['starting', 'up']:
+            return self.backend
+        return None
+
+    @property
+    def writeonly(self):
+        return self.status == 'starting'
+
+    @property
+    def enabled(self):
+        return self.status in ['starting', 'up']
+
+    async def node_down(self, error=None):
+        self.status_time = time.time()
+        self.last_check_time = time.time()
+        self.status = 'down'
+        if error is not None:
+            await logger.error('postmodel_cache_error', cache_node=self.backend.describe(), error=repr(error))
+        await self.log_status()
+
+    async def mark_dirty_data(self, item_key, write_version_field='_wv'):
+        await logger.error('POSTMODEL_DIRTYDATA', cache_node=self.backend.describe(), item_key=item_key)
+        if len(self.dirty_keys) >= self.MAX_DIRTY_KEYS:
+            self.dirty_overflow = True
+        else:
+            self.dirty_keys.add((item_key, write_version_field))
+
+    async def flush_dirty_keys(self):
+        """
+        Mark keys written when node was down as dirty, returns False if node failed again.
+        """
+        try:
+            while self.dirty_keys:
+                item_key, write_version_field = next(iter(self.dirty_keys))
+                await self.backend.incr_field(item_key, write_version_field)
+                self.dirty_keys.discard((item_key, write_version_field))
+        except CACHE_NODE_ERRORS:
+            return False
+        if self.dirty_overflow:
+            self.dirty_overflow = False
+            await logger.error('POSTMODEL_DIRTYDATA_OVERFLOW', cache_node=self.backend.describe())
+        return True
+
+
+class CacheManager:
+    """
+    Cache nodes configured by cache urls, items are sharded to nodes by key.
+
+    Supported urls::
+
+        memory://
+        redis://:password@127.0.0.1:6379/0?check_interval=60
+    """
+    CACHE_CLASS = {
+        'memory': ('postmodel.cache.backends', 'MemoryCacheBackend'),
+        'redis': ('postmodel.cache.backends', 'RedisCacheBackend'),
+    }
+
+    def __init__(self, nodes):
+        if not nodes:
+            raise ConfigurationError("cache requires at least one cache node")
+        self.nodes = nodes
+
+    @classmethod
+    def from_urls(cls, cache_urls):
+        if isinstance(cache_urls, str):
+            cache_urls = [cache_urls]
+        return cls([cls._init_node(url) for url in cache_urls])
+
+    @classmethod
+    def _init_node(cls, cache_url):
+        url = urlparse(cache_url)
+        if url.scheme not in cls.CACHE_CLASS:
+            raise ConfigurationError(f"Unknown cache scheme: {url.scheme}")
+        params = {key: value[0] for key, value in parse_qs(url.query).items()}
+        node_kwargs = {}
+        for key in ('check_interval', 'start_cycle'):
+            if key in params:
+                node_kwargs[key] = int(params.pop(key))
+        module_name, class_name = cls.CACHE_CLASS[url.scheme]
+        backend_class = getattr(importlib.import_module(module_name), class_name)
+        if url.scheme == 'redis':
+            try:
+                backend = backend_class(
+                    host=url.hostname or '127.0.0.1',
+                    port=int(url.port or 6379),
+                    db=int(url.path.lstrip('/') or 0),
+                    password=url.password or None,
+                    **{key: int(value) for key, value in params.items()}
+                )
+            except (ValueError, TypeError):
+                raise ConfigurationError(f"Invalid cache url: {cache_url}")
+        else:
+            backend = backend_class()
+        return CacheNode(backend, **node_kwargs)
+
+    def cache_node(self, sharding_id):
+        return self.nodes[sharding_id % len(self.nodes)]
+
+    async def clear_local(self):
+        for node in self.nodes:
+            if not node.backend.shared:
+                await node.backend.clear()
+
+    async def close(self):
+        for node in self.nodes:
+            await node.backend.close()
@@ -0,0 +1,235 @@
+
+import base64
+import binascii
+import json
+from copy import deepcopy
+
+from postmodel.exceptions import PostmodelCacheFailed
+from .manager import CACHE_NODE_ERRORS
+
+
+class JSONSerializer:
+    """
+    Default serializer of cached field values.
+    """
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value, default=str)
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class ModelCache:
+    """
+    Write through cache of model rows with read and write versions.
+
+    Every item is a hash keyed by ``${table}:${pk}:t`` which holds encoded field
+    values, the read version ``_rv`` and the write version ``_wv``. An item is
+    valid only when ``_rv == _wv``:
+
+    * writers increase ``_wv`` before writing database and again after commit,
+      then write the committed item with ``_rv`` set to the new ``_wv``;
+    * readers fill a missed item with ``_rv`` set to the ``_wv`` they read before
+      querying database, so a fill racing with a writer stays invalid.
+
+    With ``DataVersionField``, a fill older than the item it replaces is rejected.
+
+    With ``local``, a ``LocalCache``, valid items are kept in process too and
+    lookups check it before cache nodes. Field values are encoded by
+    ``serializer``, an object with ``dumps()`` and ``loads()``.
+    """
+
+    def __init__(self, model_class, manager, expire=86400, local=None, serializer=None):
+        self.model_class = model_class
+        self.manager = manager
+        self.expire = expire
+        self.local = local
+        self.serializer = serializer or JSONSerializer
+        self.raise_on_fail = False
+        self.dataversion_field = model_class._meta.dataversion_field
+
+    def decode_pk(self, value):
+        """
+        Returns pk of json value, e.g. pks of invalidation bus messages.
+        """
+        meta = self.model_class._meta
+        if isinstance(meta.primary_key, str):
+            return meta.fields_map[meta.primary_key].to_python_value(value)
+        return tuple(meta.fields_map[name].to_python_value(v)
+            for name, v in zip(meta.primary_key, value))
+
+    def _pk_parts(self, pk):
+        return pk if isinstance(pk, tuple) else (pk, )
+
+    def get_sharding_key(self, pk):
+        """
+        the format of cache key:
+        common = ${table}:${pk}[:${pk2}...]
+        sharding_key = ${common}
+        """
+        t_keys = [self.model_class._meta.table]
+        t_keys.extend('%s' % part for part in self._pk_parts(pk))
+        return ':'.join(t_keys)
+
+    def get_writethrough_key(self, pk):
+        """
+        write_through_key = ${common}:t
+        """
+        return self.get_sharding_key(pk) + ':t'
+
+    def sharding_id(self, pk):
+        sharding_key = self.get_sharding_key(pk)
+        return binascii.crc32(sharding_key.encode('utf-8')) % 100
+
+    async def cache_instance(self, pk):
+        node = self.manager.cache_node(self.sharding_id(pk))
+        await node.check_status()
+        return node
+
+    def encode_item(self, instance):
+        item = {}
+        for name, field in self.model_class._meta.fields_map.items():
+            value = field.to_db_value(getattr(instance, name))
+            if isinstance(value, bytes):
+                item[name] = 'b:' + base64.b64encode(value).decode('ascii')
+            else:
+                item[name] = 'j:' + self.serializer.dumps(value)
+        return item
+
+    def decode_item(self, item):
+        """
+        Decode cached item to field values, returns None if item is incomplete.
+        """
+        data = {}
+        for name, field in self.model_class._meta.fields_map.items():
+            value = item.get(name)
+            if value is None:
+                return None
+            if value.startswith('b:'):
+                data[name] = base64.b64decode(value[2:])
+            else:
+                data[name] = field.to_python_value(self.serializer.loads(value[2:]))
+        return data
+
+    def load_instance(self, item):
+        data = self.decode_item(item)
+        if data is None:
+            return None
+        return self.model_class._init_from_db(**data)
+
+    def _is_stale(self, item, orig_item):
+        name = self.dataversion_field
+        if not name or name not in item or name not in orig_item:
+            return False
+        try:
+            return self.serializer.loads(item[name][2:]) < self.serializer.loads(orig_item[name][2:])
+        except (TypeError, ValueError):
+            return False
+
+    def get_local(self, pk):
+        """
+        Returns instance kept in process, or None.
+        """
+        if self.local is None:
+            return None
+        data = self.local.get(pk)
+        if data is None:
+            return None
+        return self.model_class._init_from_db(**deepcopy(data))
+
+    def local_generation(self):
+        return self.local.generation if self.local is not None else 0
+
+    def set_local(self, pk, instance, generation):
+        """
+        Keep valid instance in process unless pk was invalidated since
+        ``generation`` was taken.
+        """
+        if self.local is not None:
+            self.local.set(pk, instance.to_dict(), generation)
+
+    def clear_local(self):
+        if self.local is not None:
+            self.local.clear()
+
+    async def get_writethrough(self, pk):
+        """
+        Returns cached item, read version and write version. Cached item is None
+        when cache can not be used now, missed item should not be filled then.
+        """
+        node = await self.cache_instance(pk)
+        if not node.enabled and self.raise_on_fail:
+            raise PostmodelCacheFailed()
+        if not node.enabled or node.writeonly:
+            return None, -1, 0
+
+        rds = node.get_client()
+        item_key = self.get_writethrough_key(pk)
+        try:
+            item_data = await rds.get_item(item_key)
+            read_version = int(item_data.pop('_rv', -1))
+            write_version = int(item_data.pop('_wv', 0))
+            cache = dict(item_data)
+        except CACHE_NODE_ERRORS as e:
+            await node.node_down(e)
+            return None, -1, 0
+
+        return cache, read_version, write_version
+
+    async def set_writethrough(self, pk, item, orig_item, write_version):
+        node = await self.cache_instance(pk)
+        item_key = self.get_writethrough_key(pk)
+
+        if not node.enabled:
+            await node.mark_dirty_data(item_key)
+            return True
+
+        rds = node.get_client()
+        try:
+            item_cache = dict(item)
+            item_cache.update(_rv=write_version)
+            deleted_keys = list(set(orig_item.keys()) - set(item_cache.keys()))
+            # data version of the cached item is compared when it is set, writers
+            # committing out of order never replace a newer row
+            return await rds.set_item_if(item_key, lambda current: not self._is_stale(item, current),
+                item_cache, deleted_keys, self.expire)
+        except CACHE_NODE_ERRORS as e:
+            await node.node_down(e)
+            await node.mark_dirty_data(item_key)
+        return True
+
+    async def evict_local(self, pk):
+        """
+        Drop item kept in process and mark it dirty if it is kept by process
+        local node, used when row is written by other processes.
+        """
+        if self.local is not None:
+            self.local.discard(pk)
+        node = self.manager.cache_node(self.sharding_id(pk))
+        if not node.backend.shared:
+            await self.mark_dirty(pk)
+
+    async def mark_dirty(self, pk):
+        """
+        Increase write version of item, returns the new write version or None if
+        cache node is not available.
+        """
+        if self.local is not None:
+            self.local.discard(pk)
+        node = await self.cache_instance(pk)
+        item_key = self.get_writethrough_key(pk)
+
+        if not node.enabled:
+            await node.mark_dirty_data(item_key)
+            return None
+
+        rds = node.get_client()
+        try:
+            return await rds.incr_field(item_key, '_wv', 1, self.expire)
+        except CACHE_NODE_ERRORS as e:
+            await node.node_down(e)
+            await node.mark_dirty_data(item_key)
+            return None
@@ -0,0 +1,75 @@
+
+import time
+from collections import OrderedDict
+
+
+class NegativeCache:
+    """
+    Per process bounded set of primary keys looked up and not found, used by
+    models with ``Meta.negative_cache`` so repeated lookups of missing rows do
+    not query database.
+
+    Keys are forgotten after ``ttl`` seconds, when rows are inserted by mappers
+    of this process, or when the invalidation bus reports writes of other
+    processes. A miss is remembered only if no key was forgotten while its
+    query ran, so a lookup racing with an insert never hides the new row.
+    """
+
+    def __init__(self, model_class, max_entries=10000, ttl=60):
+        self.model_class = model_class
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # pk -> expire_at
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, pk):
+        expire_at = self.entries.get(pk)
+        if expire_at is not None and expire_at <= time.monotonic():
+            del self.entries[pk]
+            expire_at = None
+        if expire_at is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def add(self, pk, generation):
+        """
+        Remember missing pk unless keys were forgotten since ``generation``
+        was taken.
+        """
+        if generation != self.generation:
+            return False
+        self.entries.pop(pk, None)
+        self.entries[pk] = time.monotonic() + self.ttl
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return True
+
+    def decode_pk(self, value):
+        """
+        Returns pk of json value, e.g. pks of invalidation bus messages.
+        """
+        meta = self.model_class._meta
+        if isinstance(meta.primary_key, str):
+            return meta.fields_map[meta.primary_key].to_python_value(value)
+        return tuple(meta.fields_map[name].to_python_value(v)
+            for name, v in zip(meta.primary_key, value))
+
+    def discard(self, pks):
+        self.generation += 1
+        for pk in pks:
+            self.entries.pop(pk, None)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,206 @@
+
+import asyncio
+import math
+import random
+import sys
+import time
+from collections import OrderedDict
+from functools import partial
+from basepy.asynclog import logger
+
+from .flight import SingleFlight
+
+
+class QueryCache:
+    """
+    Per process LRU cache of query result rows, used by ``QuerySet.cached()``.
+
+    Entries are keyed by database, compiled SQL and values, and dropped when any
+    table they read is written by a mapper of this process. Rows are hydrated
+    on every hit, so each caller gets its own model instances.
+
+    ``fetch()`` protects expiring entries from stampedes: concurrent misses of
+    a key wait for one load, entries are refreshed in background before they
+    expire with probability growing as expiry nears (XFetch, scaled by how
+    long the load took and ``beta``), and entries expired less than
+    ``stale_ttl`` seconds ago are returned while they are refreshed.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, beta=1.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.beta = beta
+        self.entries = OrderedDict()  # key -> (tables, expire_at, rows, size, delta, stale_until)
+        self.table_keys = {}  # table -> set of keys
+        self.generations = {}  # table -> write generation
+        self.epoch = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_hits = 0
+        self.early_refreshes = 0
+        self.flight = SingleFlight()
+        self.refreshing = set()
+        self.tasks = set()
+
+    @staticmethod
+    def make_key(db_name, sql, values):
+        """
+        Returns cache key of query, or None if values are not hashable.
+        """
+        key = (db_name, sql, tuple(tuple(v) if isinstance(v, list) else v for v in values))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    @staticmethod
+    def _rows_size(rows):
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row)
+            for value in row.values():
+                size += sys.getsizeof(value)
+        return size
+
+    def generation(self, tables):
+        return (self.epoch, ) + tuple(self.generations.get(table, 0) for table in tables)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = time.monotonic()
+        if entry[1] <= now:
+            if entry[5] <= now:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def set(self, key, tables, rows, ttl, generation, delta=0, stale_ttl=0):
+        """
+        Store rows unless the tables were written since ``generation`` was taken,
+        ``delta`` is the time rows took to load.
+        """
+        if self.generation(tables) != generation:
+            return False
+        if key in self.entries:
+            self._remove(key)
+        size = self._rows_size(rows)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        expire_at = time.monotonic() + ttl
+        self.entries[key] = (tables, expire_at, rows, size, delta, expire_at + stale_ttl)
+        self.bytes += size
+        for table in tables:
+            self.table_keys.setdefault(table, set()).add(key)
+        while len(self.entries) > self.max_entries or (
+                self.max_bytes is not None and self.bytes > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+        return True
+
+    async def fetch(self, key, tables, ttl, loader, stale_ttl=0):
+        """
+        Returns rows of key, rows are loaded by ``await loader()`` when missed.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            _, expire_at, rows, _, delta, stale_until = entry
+            now = time.monotonic()
+            if now < expire_at:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                # XFetch: -log(u) is exponentially distributed, so refreshes
+                # spread before expiry instead of piling up at it
+                if delta > 0 and now - delta * self.beta * math.log(1.0 - random.random()) >= expire_at:
+                    if self._refresh(key, tables, ttl, loader, stale_ttl):
+                        self.early_refreshes += 1
+                return rows
+            if now < stale_until:
+                self.entries.move_to_end(key)
+                self.stale_hits += 1
+                self._refresh(key, tables, ttl, loader, stale_ttl)
+                return rows
+            self._remove(key)
+        self.misses += 1
+        rows, _ = await self.flight.run(key, partial(self._load, key, tables, ttl, loader, stale_ttl))
+        return rows
+
+    async def _load(self, key, tables, ttl, loader, stale_ttl):
+        generation = self.generation(tables)
+        start = time.monotonic()
+        rows = await loader()
+        self.set(key, tables, rows, ttl, generation, time.monotonic() - start, stale_ttl)
+        return rows
+
+    def _refresh(self, key, tables, ttl, loader, stale_ttl):
+        if key in self.refreshing or self.flight.running(key):
+            return False
+        self.refreshing.add(key)
+        task = asyncio.ensure_future(self._background_load(key, tables, ttl, loader, stale_ttl))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def _background_load(self, key, tables, ttl, loader, stale_ttl):
+        try:
+            await self.flight.run(key, partial(self._load, key, tables, ttl, loader, stale_ttl))
+        except Exception as e:
+            await logger.warning(f'query cache refresh failed: {e!r}')
+        finally:
+            self.refreshing.discard(key)
+
+    def _remove(self, key):
+        tables, _, _, size, _, _ = self.entries.pop(key)
+        self.bytes -= size
+        for table in tables:
+            keys = self.table_keys.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.table_keys[table]
+
+    def invalidate_table(self, table):
+        self.generations[table] = self.generations.get(table, 0) + 1
+        for key in list(self.table_keys.get(table, ())):
+            self._remove(key)
+            self.invalidations += 1
+
+    def clear(self):
+        self.epoch += 1
+        self.entries.clear()
+        self.table_keys.clear()
+        self.bytes = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "stale_hits": self.stale_hits,
+            "early_refreshes": self.early_refreshes,
+            "collapsed": self.flight.collapsed,
+        }
+
+    async def close(self):
+        """
+        Cancel background refreshes.
+        """
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,351 @@
+
+import asyncio
+import bisect
+import datetime
+import json
+import operator
+import uuid
+from decimal import Decimal
+from functools import partial
+from basepy.asynclog import logger
+
+from postmodel.exceptions import BaseORMException
+
+REPLICATE_CHANNEL = "postmodel_replicate"
+
+# types compared by equality the same way in python and postgres
+LOCAL_TYPES = (int, bool, str, Decimal, datetime.date, datetime.datetime,
+    datetime.timedelta, uuid.UUID)
+# types ordered the same way in python and postgres, text order depends on collation
+# and is the same only for "C" collation
+ORDERED_TYPES = (int, bool, Decimal, datetime.date, datetime.datetime,
+    datetime.timedelta, uuid.UUID)
+
+RANGE_OPERATORS = {
+    'greater_equal': operator.ge,
+    'greater_than': operator.gt,
+    'less_equal': operator.le,
+    'less_than': operator.lt,
+}
+INDEX_OPERATORS = {'equal', 'is_in', *RANGE_OPERATORS}
+
+LOCALE_SQL = ("SELECT pg_encoding_to_char(encoding) AS encoding, datcollate, datctype "
+    "FROM pg_database WHERE datname = current_database()")
+
+
+def _is_type(field, types):
+    field_type = field.type if isinstance(field.type, tuple) else (field.type, )
+    return all(isinstance(t, type) and issubclass(t, types) for t in field_type)
+
+
+class ReplicaTable:
+    """
+    Whole table of a model with ``Meta.replicate_in_memory = True`` held in
+    process memory.
+
+    Rows are indexed by primary key, by ``Meta.indexes``, ``Meta.unique_together``
+    and indexed or unique fields. Tables of these models are created with a
+    trigger notifying changed primary keys on ``REPLICATE_CHANNEL``, the replica
+    fetches those rows again, so it converges to the committed table whatever
+    the order notifications are handled. When the listener connection is lost
+    or the table is truncated the whole table is loaded again.
+
+    ``select()`` filters rows by predicates compiled from query expressions
+    while the replica is ``ready``, and returns None for queries it can not
+    answer exactly like postgres, which are run by the database. Text is
+    ordered and case folded in Python like the "C" collation of UTF8
+    databases, so those lookups are answered only when the database uses it.
+    """
+
+    FETCH_BATCH = 1000
+
+    def __init__(self, model_class, db):
+        meta = model_class._meta
+        self.model_class = model_class
+        self.db = db
+        self.table = meta.table
+        self.fields_map = meta.fields_map
+        self.projection = meta.fields_db_projection
+        self.columns = list(self.projection.values())
+        primary_key = meta.primary_key
+        self.pk_names = (primary_key, ) if isinstance(primary_key, str) else tuple(primary_key)
+        self.single_pk = isinstance(primary_key, str)
+        self.db_pk_names = tuple(self.projection[name] for name in self.pk_names)
+
+        index_names = set()
+        for names in tuple(meta.indexes) + tuple(meta.unique_together):
+            index_names.add(tuple(names))
+        for name, field in self.fields_map.items():
+            if (field.index or field.unique) and name not in self.pk_names:
+                index_names.add((name, ))
+        self.hash_indexes = {
+            names: {} for names in index_names
+            if all(_is_type(self.fields_map[name], LOCAL_TYPES) for name in names)
+        }  # names -> {values: set of pks}
+        sorted_names = {names[0] for names in index_names if len(names) == 1}
+        if self.single_pk:
+            sorted_names.add(primary_key)
+        self.sorted_indexes = {
+            name: [] for name in sorted_names
+            if _is_type(self.fields_map[name], ORDERED_TYPES)
+        }  # name -> sorted list of (value, pk), null values are not indexed
+
+        self.rows = {}  # pk -> row
+        self.pending = set()
+        self.lock = asyncio.Lock()
+        self.ready = False
+        self.c_locale = False
+
+        columns = ",".join(f'"{c}"' for c in self.columns)
+        self.load_sql = f'SELECT {columns} FROM "{self.table}"'
+        if self.single_pk:
+            self.fetch_sql = f'{self.load_sql} WHERE "{self.db_pk_names[0]}" = ANY($1)'
+        else:
+            self.fetch_sql = None
+
+    def _value(self, name, row):
+        return self.fields_map[name].to_python_value(row[self.projection[name]])
+
+    def _get(self, row, name):
+        return self._value(name, row)
+
+    def _row_pk(self, row):
+        values = tuple(self._value(name, row) for name in self.pk_names)
+        return values[0] if self.single_pk else values
+
+    def decode_pk(self, values):
+        values = tuple(self.fields_map[name].to_python_value(value)
+            for name, value in zip(self.pk_names, values))
+        return values[0] if self.single_pk else values
+
+    def _clear(self):
+        self.rows = {}
+        for index in self.hash_indexes.values():
+            index.clear()
+        for index in self.sorted_indexes.values():
+            index.clear()
+
+    def _add(self, row):
+        pk = self._row_pk(row)
+        self._remove(pk)
+        self.rows[pk] = row
+        for names, index in self.hash_indexes.items():
+            key = tuple(self._value(name, row) for name in names)
+            index.setdefault(key, set()).add(pk)
+        for name, index in self.sorted_indexes.items():
+            value = self._value(name, row)
+            if value is not None:
+                bisect.insort(index, (value, pk))
+
+    def _remove(self, pk):
+        row = self.rows.pop(pk, None)
+        if row is None:
+            return
+        for names, index in self.hash_indexes.items():
+            key = tuple(self._value(name, row) for name in names)
+            pks = index.get(key)
+            if pks is not None:
+                pks.discard(pk)
+                if not pks:
+                    del index[key]
+        for name, index in self.sorted_indexes.items():
+            value = self._value(name, row)
+            if value is not None:
+                i = bisect.bisect_left(index, (value, pk))
+                if i < len(index) and index[i] == (value, pk):
+                    del index[i]
+
+    async def load(self):
+        """
+        Load the whole table, returns False if it can not be loaded.
+        """
+        async with self.lock:
+            return await self._load()
+
+    async def _load(self):
+        # pending pks are kept, rows changed while loading are fetched after it
+        self.ready = False
+        self._clear()
+        try:
+            _, locale = await self.db.execute_query(LOCALE_SQL)
+            _, rows = await self.db.execute_query(self.load_sql)
+        except BaseORMException as e:
+            await logger.warning(f'replica of table {self.table} not loaded: {e}')
+            return False
+        self.c_locale = locale[0]['encoding'] == 'UTF8' and all(
+            locale[0][name] in ('C', 'POSIX') for name in ('datcollate', 'datctype'))
+        for row in rows:
+            self._add(dict(row))
+        self.ready = True
+        if not await self._fetch_pending():
+            self.ready = False
+            self._clear()
+            return False
+        return True
+
+    def reset(self):
+        self.ready = False
+        self.pending.clear()
+        self._clear()
+
+    async def refresh(self, pks):
+        """
+        Fetch rows of pks again, rows not found are removed.
+        """
+        self.pending.update(pks)
+        if not self.ready:
+            # fetched when the table is loaded
+            return
+        async with self.lock:
+            if self.ready and not await self._fetch_pending():
+                await self._load()
+
+    async def _fetch_pending(self):
+        """
+        Fetch rows of pending pks, returns False if they can not be fetched.
+        """
+        while self.pending and self.ready:
+            batch = []
+            while self.pending and len(batch) < self.FETCH_BATCH:
+                batch.append(self.pending.pop())
+            try:
+                rows = await self._fetch(batch)
+            except BaseORMException as e:
+                self.pending.update(batch)
+                await logger.error('postmodel_replica_error', table=self.table, error=repr(e))
+                return False
+            for pk in batch:
+                self._remove(pk)
+            for row in rows:
+                self._add(dict(row))
+        return True
+
+    async def _fetch(self, pks):
+        if self.fetch_sql is not None:
+            field = self.fields_map[self.pk_names[0]]
+            _, rows = await self.db.execute_query(self.fetch_sql, [[field.to_db_value(pk) for pk in pks]])
+            return rows
+        values = []
+        criteria = []
+        for pk in pks:
+            terms = []
+            for db_name, name, value in zip(self.db_pk_names, self.pk_names, pk):
+                values.append(self.fields_map[name].to_db_value(value))
+                terms.append(f'"{db_name}" = ${len(values)}')
+            criteria.append("({})".format(" AND ".join(terms)))
+        _, rows = await self.db.execute_query(
+            "{} WHERE {}".format(self.load_sql, " OR ".join(criteria)), values)
+        return rows
+
+    @staticmethod
+    def decode_message(payload):
+        """
+        Returns ``(table, pk values)`` of notification sent by the trigger, pk
+        values are None when the table is truncated.
+        """
+        table, values = json.loads(payload)
+        return table, values
+
+    async def on_message(self, values):
+        if values is None:
+            await self.load()
+        else:
+            await self.refresh([self.decode_pk(values)])
+
+    def _candidates(self, conditions):
+        """
+        Returns pks of rows which may match conditions, or None for all rows.
+        """
+        equal = {}
+        for name, op, value in conditions:
+            if op == 'equal':
+                equal[name] = value
+        if all(name in equal for name in self.pk_names):
+            pk = tuple(equal[name] for name in self.pk_names)
+            return [pk[0] if self.single_pk else pk]
+        for name, op, value in conditions:
+            if op == 'is_in' and self.single_pk and name == self.pk_names[0]:
+                return list(dict.fromkeys(v for v in value if v is not None))
+        for names, index in self.hash_indexes.items():
+            if all(name in equal for name in names):
+                return list(index.get(tuple(equal[name] for name in names), ()))
+        for name, op, value in conditions:
+            index = self.hash_indexes.get((name, ))
+            if op == 'is_in' and index is not None:
+                pks = []
+                for v in dict.fromkeys(value):
+                    pks.extend(index.get((v, ), ()))
+                return pks
+        for name, op, value in conditions:
+            index = self.sorted_indexes.get(name)
+            if index is None or value is None or op not in RANGE_OPERATORS:
+                continue
+            # (value, ) sorts right before every (value, pk) entry
+            if op in ('greater_equal', 'greater_than'):
+                i = bisect.bisect_left(index, (value, ))
+                return [pk for _, pk in index[i:]]
+            i = bisect.bisect_left(index, (value, ))
+            if op == 'less_equal':
+                while i < len(index) and index[i][0] == value:
+                    i += 1
+            return [pk for _, pk in index[:i]]
+        return None
+
+    def _sort_key(self, name, row):
+        value = self._value(name, row)
+        return (True, 0) if value is None else (False, value)
+
+    def _index_conditions(self, conditions):
+        # conditions usable to find candidate rows, the predicate checks them all
+        compiled = []
+        for name, op, arg in conditions:
+            field = self.fields_map.get(name)
+            if field is None or op not in INDEX_OPERATORS or arg is None:
+                continue
+            if not _is_type(field, ORDERED_TYPES if op in RANGE_OPERATORS else LOCAL_TYPES):
+                continue
+            try:
+                if op == 'is_in':
+                    arg = {field.to_python_value(v) for v in arg}
+                else:
+                    arg = field.to_python_value(arg)
+            except (TypeError, ValueError, ArithmeticError):
+                continue
+            compiled.append((name, op, arg))
+        return compiled
+
+    def select(self, predicate, conditions=(), orderings=(), offset=0, limit=0):
+        """
+        Returns rows matching ``predicate`` in order, or None if the query must
+        be run by database. ``conditions`` are ``(field_name, operator_name, value)``
+        lookups joined to the predicate by AND, used to find rows by indexes.
+        """
+        if not self.ready:
+            return None
+        if predicate.collation_sensitive and not self.c_locale:
+            return None
+        for name, _ in orderings:
+            field = self.fields_map.get(name)
+            if field is None:
+                return None
+            if not _is_type(field, ORDERED_TYPES) and not (self.c_locale and field.type is str):
+                return None
+        try:
+            pks = self._candidates(self._index_conditions(conditions))
+            if pks is None:
+                rows = self.rows.values()
+            else:
+                rows = [self.rows[pk] for pk in pks if pk in self.rows]
+            rows = predicate.filter(rows, get=self._get)
+            for name, order in reversed(orderings):
+                # nulls are last in ascending order and first in descending order
+                rows.sort(key=partial(self._sort_key, name), reverse=order.value == "DESC")
+        except (TypeError, BaseORMException):
+            # e.g. aware datetime compared with naive datetime, or json values
+            # postgres fails to cast, the database raises the error
+            return None
+        if offset:
+            rows = rows[offset:]
+        if limit:
+            rows = rows[:limit]
+        return [dict(row) for row in rows]
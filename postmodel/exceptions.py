@@ -8,6 +8,8 @@ __all__ = (
     "NoValuesFetched",
     "MultipleObjectsReturned",
     "DoesNotExist",
+    "PostmodelCacheFailed",
+    "NPlusOneError",
 )
 
 
@@ -90,7 +92,20 @@ class DoesNotExist(OperationalError):
     """
 
 
+class NPlusOneError(OperationalError):
+    """
+    The NPlusOneError is raised when N+1 query detector finds the same query run
+    with different parameters too many times.
+    """
+
+
 class DBConnectionError(BaseORMException):
     """
     The DBConnectionError is raised when problems with connecting to db occurs
     """
+
+
+class PostmodelCacheFailed(BaseORMException):
+    """
+    The PostmodelCacheFailed is raised when cache node is down and cache is required.
+    """
@@ -0,0 +1,17 @@
+import pytest
+
+from postmodel.nplusone import QueryDetector, current_query_detector
+
+
+@pytest.fixture()
+def nplusone():
+    """
+    Fails test with ``NPlusOneError`` if a query runs with more than 5
+    different parameters. Enable it with
+    ``pytest_plugins = ["postmodel.ext.pytest_plugin"]``, the threshold can
+    be changed by ``nplusone.threshold`` in the test.
+    """
+    detector = QueryDetector(threshold=5, raise_error=True)
+    token = current_query_detector.set(detector)
+    yield detector
+    current_query_detector.reset(token)
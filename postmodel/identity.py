@@ -0,0 +1,51 @@
+from functools import wraps
+from postmodel.sqldb.base import IdentityMap, current_identity_map
+
+
+class IdentityMapContext:
+    __slots__ = ("token", "identity_map")
+
+    def __init__(self) -> None:
+        self.token = None
+        self.identity_map = None
+
+    async def __aenter__(self):
+        self.identity_map = current_identity_map.get()
+        if self.identity_map is None:
+            self.identity_map = IdentityMap()
+            self.token = current_identity_map.set(self.identity_map)
+        return self.identity_map
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.token is not None:
+            self.identity_map.clear()
+            current_identity_map.reset(self.token)
+            self.token = None
+        return False
+
+
+def identity_map():
+    """
+    Identity map context manager.
+
+    Inside ``async with identity_map():`` statement, repeated loads of the same row
+    return the same model instance, and loads by primary key are answered without
+    query once the row is loaded. The map is cleared when the block exits.
+
+    Use it around one web request, or inside ``in_transaction()`` to scope it to a
+    transaction. Nested blocks share the outer map.
+    """
+    return IdentityMapContext()
+
+
+def with_identity_map(func):
+    """
+    Decorator to run function with identity map.
+    """
+
+    @wraps(func)
+    async def wrapped(*args, **kwargs):
+        async with identity_map():
+            return await func(*args, **kwargs)
+
+    return wrapped
@@ -9,10 +9,17 @@ from typing import Any, Coroutine, Dict, List, Optional, Tuple, Type, Union, cas
 from basepy.asynclog import logger
 
 from urllib.parse import urlparse, parse_qs
+from collections import OrderedDict
 import uuid
 
 from postmodel.exceptions import ConfigurationError
-from postmodel.sqldb.base import current_transaction_map
+from postmodel.sqldb.base import current_transaction_map, current_write_map, DatabaseGroup
+from postmodel.cache import (CacheManager, ModelCache, QueryCache, InvalidationBus, ReplicaTable,
+    NegativeCache, LocalCache)
+from postmodel.cache.replica import REPLICATE_CHANNEL
+from postmodel.sqldb.metrics import prometheus_text
+from postmodel.sqldb.stages import StageStats
+from postmodel.sqldb.statements import StatementStats
 
 try:
     from contextvars import ContextVar
@@ -26,8 +33,17 @@ class Postmodel:
         'postgresql': ('postmodel.sqldb.postgres', 'PostgresEngine'),
     }
     _databases = {}
+    _db_groups = {}
+    _lag_tasks = {}
+    _router = None
+    _routes = OrderedDict()
+    _stage_stats = None
+    _statement_stats = None
+    MAX_ROUTES = 1000
     _mapper_cache = {}
     _models = {}
+    _cache_manager = None
+    _query_cache = None
     _inited = False
 
     @classmethod
@@ -42,25 +58,121 @@ class Postmodel:
         name = 'default',
         extra_db_urls = {},
         modules = [],
+        cache_url = None,
+        query_cache_size = 1000,
+        invalidation_bus = False,
+        replica_urls = {},
+        replica_policy = 'round_robin',
+        read_your_writes = 1.0,
+        replica_lag_interval = 1.0,
+        max_replica_lag = None,
+        router = None,
+        query_stages = False,
+        statement_stats = False,
+        statement_stats_file = None,
+        statement_stats_interval = 60,
         _create_db = False
     ) -> None:
+        """
+        ``replica_urls`` are URLs of read replicas of database ``name``, or a
+        dict of database names to replica URLs, databases of ``extra_db_urls``
+        with ``replica_of`` parameter are replicas too. Reads of a database with
+        replicas go to them outside transactions, by ``replica_policy``,
+        ``round_robin`` or ``least_loaded``, except in ``read_your_writes``
+        seconds after a write of the same context. Reads of databases with
+        ``hedge_hosts`` are not hedged in the window either.
+
+        Replication lag of replicas is sampled every ``replica_lag_interval``
+        seconds, replicas more than ``max_replica_lag`` seconds behind are
+        skipped if it is set.
+
+        ``router`` is ``DatabaseRouter`` deciding databases of models without
+        ``Meta.router``.
+
+        With ``query_stages``, seconds spent in stages of queries are summed by
+        model and fingerprint, see ``get_query_stages()``.
+
+        With ``statement_stats``, statistics of statements are kept by database
+        and fingerprint, see ``get_statement_stats()``, and written to
+        ``statement_stats_file`` every ``statement_stats_interval`` seconds if
+        it is set.
+        """
         db_type, config, parameters = cls._parse_db_url(db_url)
+        if replica_policy not in DatabaseGroup.POLICIES:
+            raise ConfigurationError(f"Unknown replica policy: {replica_policy}")
+        if not isinstance(replica_urls, dict):
+            replica_urls = {name: replica_urls}
 
         db_urls = {}
         db_urls.update(extra_db_urls)
         db_urls[name] = db_url
+        replica_names = {}
+        for primary, urls in replica_urls.items():
+            names = replica_names.setdefault(primary, [])
+            for i, url in enumerate(urls):
+                names.append(f'{primary}_replica{i}')
+                db_urls[names[-1]] = url
+        for key, value in extra_db_urls.items():
+            primary = cls._parse_db_url(value)[2].get('replica_of')
+            if primary is not None:
+                replica_names.setdefault(primary, []).append(key)
+        replicas = {key: primary for primary, names in replica_names.items() for key in names}
+        for primary in replica_names:
+            if primary not in db_urls or primary in replicas:
+                raise ConfigurationError(f"Replicas of unknown primary database: {primary}")
 
         for key, value in db_urls.items():
             if key in cls._databases:
                 raise Exception(f'database with name {key} already init.')
             db_type, config, parameters = cls._parse_db_url(value)
+            parameters.pop('replica_of', None)
             cls._databases[key] = await cls._init_database(key, db_type, config, parameters)
             current_transaction_map[key] = ContextVar("TransactedConnection", default=None)
+            if getattr(cls._databases[key], 'hedge_hosts', None):
+                current_write_map[key] = ContextVar("LastWrite", default=0)
+                cls._databases[key].read_your_writes = read_your_writes
+
+        for primary, names in replica_names.items():
+            for key in names:
+                cls._databases[key].replica_of = primary
+            current_write_map[primary] = ContextVar("LastWrite", default=0)
+            cls._db_groups[primary] = DatabaseGroup(cls._databases[primary],
+                [cls._databases[key] for key in names],
+                policy=replica_policy, read_your_writes=read_your_writes, max_lag=max_replica_lag)
+        await cls._start_lag_sampling(replica_lag_interval)
+
+        if router is not None:
+            cls._router = router
+            cls._routes.clear()
+
+        if query_stages and cls._stage_stats is None:
+            cls._stage_stats = StageStats()
+
+        if cache_url:
+            cls._cache_manager = CacheManager.from_urls(cache_url)
+        if cls._query_cache is None:
+            cls._query_cache = QueryCache(max_entries=query_cache_size)
+
+        if invalidation_bus:
+            for key in db_urls.keys():
+                if key not in replicas:
+                    await cls._start_invalidation_bus(key)
 
         for module in modules:
             models = await cls._load_models(module)
             cls._models.update(models)
 
+        await cls._start_replicas()
+
+        if statement_stats:
+            if cls._statement_stats is None:
+                cls._statement_stats = StatementStats()
+            cls.add_query_hook(cls._statement_stats)
+            cls._statement_stats.models = {model_class._meta.table: model_class.__name__
+                for model_class in cls._models.values()}
+            if statement_stats_file:
+                cls._statement_stats.start_snapshots(statement_stats_file, statement_stats_interval)
+
         cls._inited = True
 
 
@@ -129,16 +241,307 @@ class Postmodel:
         return models
 
     @classmethod
-    def get_mapper(cls, model_class, db_name='default'):
+    def db_for_read(cls, model_class, queryset):
+        """
+        Returns name of database ``queryset`` of model reads, decided by
+        router of model, ``Meta.db_name`` without router or its decision.
+        """
+        router = model_class._meta.router or cls._router
+        if router is None:
+            return model_class._meta.db_name
+        return cls._route(router, router.db_for_read, model_class, queryset)
+
+    @classmethod
+    def db_for_write(cls, model_class, instance):
+        """
+        Returns name of database ``instance`` of model, or an update or delete
+        query, is written to.
+        """
+        router = model_class._meta.router or cls._router
+        if router is None:
+            return model_class._meta.db_name
+        return cls._route(router, router.db_for_write, model_class, instance)
+
+    @classmethod
+    def _route(cls, router, method, model_class, target):
+        if not getattr(router, 'cache_by_shape', False):
+            return method(model_class, target) or model_class._meta.db_name
+        shape = target.route_shape() if hasattr(target, 'route_shape') else None
+        key = (router, method.__name__, model_class, shape)
+        db_name = cls._routes.get(key)
+        if db_name is None:
+            db_name = cls._routes[key] = method(model_class, target) or model_class._meta.db_name
+            if len(cls._routes) > cls.MAX_ROUTES:
+                cls._routes.popitem(last=False)
+        return db_name
+
+    @classmethod
+    def get_read_db_name(cls, db_name, max_lag=None):
+        """
+        Returns name of database reads of ``db_name`` go to, one of its
+        replicas if it has them. With ``max_lag``, reads of a replica more than
+        ``max_lag`` seconds behind go to its primary.
+        """
+        group = cls._db_groups.get(db_name)
+        if group is not None:
+            return group.read_database(max_lag).name
+        if max_lag is not None:
+            db = cls.get_database(db_name)
+            if not db.within_lag(max_lag):
+                return db.replica_of
+        return db_name
+
+    @classmethod
+    async def _start_lag_sampling(cls, interval):
+        for name, db in cls._databases.items():
+            if db.replica_of is None or name in cls._lag_tasks:
+                continue
+            primary = cls._databases[db.replica_of]
+            db.lag_interval = interval
+            await db.sample_lag(primary)
+            cls._lag_tasks[name] = asyncio.ensure_future(cls._sample_lag(db, primary))
+
+    @staticmethod
+    async def _sample_lag(db, primary):
+        while True:
+            await asyncio.sleep(db.lag_interval)
+            await db.sample_lag(primary)
+
+    @classmethod
+    def get_replica_lag(cls):
+        """
+        Returns replication lag of replicas by name, seconds and bytes behind
+        primary, age of the sample, failed samples and reads which skipped
+        replica for lag.
+        """
+        return {name: db.lag_stats() for name, db in cls._databases.items()
+            if db.replica_of is not None}
+
+    @classmethod
+    def add_query_hook(cls, hook, db_name=None):
+        """
+        Adds ``QueryHook`` to database ``db_name``, or to all databases.
+        """
+        for name, db in cls._databases.items():
+            if db_name is None or name == db_name:
+                db.add_query_hook(hook)
+
+    @classmethod
+    def remove_query_hook(cls, hook, db_name=None):
+        for name, db in cls._databases.items():
+            if db_name is None or name == db_name:
+                db.remove_query_hook(hook)
+
+    @classmethod
+    def get_query_stages(cls):
+        """
+        Returns seconds spent in stages of queries, compile, acquire, execute,
+        decode and hydrate, by model and by fingerprint of SQL, if enabled by
+        ``init(query_stages=True)``.
+        """
+        if cls._stage_stats is None:
+            return None
+        return cls._stage_stats.stats()
+
+    @classmethod
+    def get_statement_stats(cls, n=20, order_by='total_time'):
+        """
+        Returns ``n`` statements with largest ``order_by``, ``total_time``,
+        ``calls``, ``mean_time``, ``p99`` or ``rows_per_call``, if enabled by
+        ``init(statement_stats=True)``.
+        """
+        if cls._statement_stats is None:
+            return None
+        return cls._statement_stats.top(n, order_by)
+
+    @classmethod
+    def reset_statement_stats(cls):
+        if cls._statement_stats is not None:
+            cls._statement_stats.reset()
+
+    @classmethod
+    def get_metrics(cls):
+        """
+        Returns metrics of databases by name, pool connections, histograms of
+        seconds waited to acquire connections and of statements by operation,
+        rows by operation and errors by exception.
+        """
+        return {name: db.metrics_snapshot() for name, db in cls._databases.items()}
+
+    @classmethod
+    def get_metrics_text(cls):
+        """
+        Returns metrics of databases in prometheus text format.
+        """
+        return prometheus_text(cls.get_metrics())
+
+    @classmethod
+    def get_mapper(cls, model_class, db_name='default', shard=False):
+        """
+        Returns mapper of model in database ``db_name``. Mapper of models with
+        ``Meta.shard_key`` places rows in all their shards, unless ``shard`` is
+        set and ``db_name`` is one of the shards, or a replica of one.
+        """
+        meta = model_class._meta
+        if meta.shard_key:
+            db = cls._databases.get(db_name)
+            # replicas of shards are shards too
+            if not shard or (db_name not in meta.shards and (
+                    db is None or db.replica_of not in meta.shards)):
+                key = (model_class, None)
+                if key not in cls._mapper_cache:
+                    from postmodel.sqldb.sharding import ShardedMapper
+                    for name in meta.shards:
+                        if name not in cls._databases:
+                            raise ConfigurationError(f"Unknown shard database: {name}")
+                    cls._mapper_cache[key] = ShardedMapper(model_class, meta.shards)
+                return cls._mapper_cache[key]
         key = (model_class, db_name)
         if key not in cls._mapper_cache:
             db = cls.get_database(db_name)
             mapper = db.get_mapper(model_class)
+            if db.replica_of is not None:
+                # replicas share caches of primary, which are invalidated by its writes
+                primary = cls.get_mapper(model_class, db.replica_of, shard=True)
+                mapper.model_cache = primary.model_cache
+                mapper.query_cache = primary.query_cache
+                mapper.negative_cache = primary.negative_cache
+                mapper.replica = primary.replica
+            else:
+                mapper.model_cache = cls.get_model_cache(model_class)
+                mapper.query_cache = cls._query_cache
+                mapper.negative_cache = cls.get_negative_cache(model_class)
             cls._mapper_cache[key] = mapper
             return mapper
         else:
             return cls._mapper_cache[key]
 
+    @classmethod
+    def get_model_cache(cls, model_class):
+        """
+        Model cache of models with ``Meta.cache``, cached rows are kept by cache
+        nodes for ``Meta.cache_expire`` seconds, and in process for
+        ``Meta.cache_local_ttl`` seconds if it is set, at most
+        ``Meta.cache_local_size`` rows.
+        """
+        meta = model_class._meta
+        if cls._cache_manager is None or not meta.cache:
+            return None
+        local = None
+        if meta.cache_local_ttl:
+            local = LocalCache(max_entries=meta.cache_local_size, ttl=meta.cache_local_ttl)
+        return ModelCache(model_class, cls._cache_manager, expire=meta.cache_expire,
+            local=local, serializer=meta.cache_serializer)
+
+    @classmethod
+    def get_negative_cache(cls, model_class):
+        """
+        ``Meta.negative_cache`` is True or the max number of missing primary
+        keys remembered, ``Meta.negative_cache_ttl`` is seconds they are kept.
+        """
+        size = model_class._meta.negative_cache
+        if not size:
+            return None
+        ttl = model_class._meta.negative_cache_ttl
+        if size is True:
+            return NegativeCache(model_class, ttl=ttl)
+        return NegativeCache(model_class, max_entries=size, ttl=ttl)
+
+    @classmethod
+    async def _start_invalidation_bus(cls, db_name):
+        db = cls._databases[db_name]
+        bus = InvalidationBus(db)
+
+        async def invalidate(table, pks):
+            query_cache = cls._query_cache
+            if query_cache is not None:
+                if table is None:
+                    query_cache.clear()
+                else:
+                    query_cache.invalidate_table(table)
+            for (model_class, mapper_db_name), mapper in list(cls._mapper_cache.items()):
+                negative_cache = mapper.negative_cache
+                if mapper_db_name != db_name or negative_cache is None:
+                    continue
+                if table is None or (model_class._meta.table == table and not pks):
+                    negative_cache.clear()
+                elif model_class._meta.table == table:
+                    try:
+                        negative_cache.discard([negative_cache.decode_pk(pk) for pk in pks])
+                    except (TypeError, ValueError):
+                        negative_cache.clear()
+            if cls._cache_manager is not None and table is None:
+                await cls._cache_manager.clear_local()
+                for mapper in list(cls._mapper_cache.values()):
+                    if mapper.model_cache is not None:
+                        mapper.model_cache.clear_local()
+                return
+            for (model_class, mapper_db_name), mapper in list(cls._mapper_cache.items()):
+                if (mapper_db_name == db_name and mapper.model_cache is not None
+                        and model_class._meta.table == table):
+                    model_cache = mapper.model_cache
+                    if not pks:
+                        model_cache.clear_local()
+                    try:
+                        decoded = [model_cache.decode_pk(pk) for pk in pks]
+                    except (TypeError, ValueError):
+                        model_cache.clear_local()
+                        continue
+                    for pk in decoded:
+                        await model_cache.evict_local(pk)
+
+        bus.subscribe(invalidate)
+        await bus.start()
+        db.invalidation_bus = bus
+
+    @classmethod
+    async def _start_replicas(cls):
+        """
+        Load tables of models with ``Meta.replicate_in_memory`` into memory, the
+        replicas are kept fresh by notifications of triggers on the tables.
+        """
+        from postmodel.sqldb.sharding import ShardedMapper
+        replicas = {}
+        for model_class in cls._models.values():
+            db_name = model_class._meta.db_name
+            if not model_class._meta.replicate_in_memory or db_name not in cls._databases:
+                continue
+            mapper = cls.get_mapper(model_class, db_name)
+            if isinstance(mapper, ShardedMapper):
+                raise ConfigurationError(
+                    f"sharded model {model_class.__name__} can't be replicated in memory")
+            if mapper.replica is None:
+                mapper.replica = ReplicaTable(model_class, mapper.db)
+            replicas.setdefault(db_name, {})[model_class._meta.table] = mapper.replica
+
+        for db_name, tables in replicas.items():
+            async def on_message(payload, tables=tables):
+                if payload is None:
+                    for replica in tables.values():
+                        await replica.load()
+                    return
+                try:
+                    table, values = ReplicaTable.decode_message(payload)
+                except (TypeError, ValueError):
+                    await logger.error('postmodel_invalid_notification', payload=payload)
+                    return
+                replica = tables.get(table)
+                if replica is not None:
+                    await replica.on_message(values)
+
+            # listen first, rows changed while loading are fetched again after load
+            await cls._databases[db_name].listen(REPLICATE_CHANNEL, on_message)
+            for replica in tables.values():
+                await replica.load()
+
+    @classmethod
+    def get_query_cache(cls):
+        """
+        Returns ``QueryCache`` of ``QuerySet.cached()``, its ``stats()`` reports
+        entries, memory bytes, hits, misses and hit rate.
+        """
+        return cls._query_cache
+
     @classmethod
     async def generate_schemas(cls, safe = True) -> None:
         """
@@ -153,14 +556,46 @@ class Postmodel:
         """
         if not cls._inited:
             raise ConfigurationError("You have to call .init() first before generating schemas")
-        for name, model in cls._models.items():
+        for model in cls._sorted_models():
             mapper = model.get_mapper()
             await mapper.create_table()
 
+    @classmethod
+    def _sorted_models(cls):
+        # related models must be created before the models referring to them.
+        sorted_models = []
+        def visit(model, visiting):
+            if model in sorted_models or model in visiting:
+                return
+            visiting.add(model)
+            for field in model._meta.fk_fields.values():
+                visit(field.related_model, visiting)
+            sorted_models.append(model)
+        for model in cls._models.values():
+            visit(model, set())
+        return sorted_models
+
     @classmethod
     async def _reset(cls):
+        for task in cls._lag_tasks.values():
+            task.cancel()
+        await asyncio.gather(*cls._lag_tasks.values(), return_exceptions=True)
+        cls._lag_tasks = {}
         await cls.close_databases()
+        if cls._cache_manager is not None:
+            await cls._cache_manager.close()
+            cls._cache_manager = None
+        if cls._query_cache is not None:
+            await cls._query_cache.close()
+            cls._query_cache = None
         cls._databases = {}
+        cls._db_groups = {}
+        cls._router = None
+        cls._routes.clear()
+        cls._stage_stats = None
+        if cls._statement_stats is not None:
+            cls._statement_stats.stop_snapshots()
+            cls._statement_stats = None
         cls._mapper_cache = {}
         cls._models = {}
         cls._inited = False
@@ -15,7 +15,8 @@ from .fields import(
     FloatField,
     JSONField,
     UUIDField,
-    BinaryField
+    BinaryField,
+    ForeignKeyField
 )
 
 from .model import Model
@@ -28,4 +29,11 @@ from .query import (
 
 from .functions import (
     Function
-)
\ No newline at end of file
+)
+from .expressions import (
+    F
+)
+from .evaluator import (
+    Predicate,
+    compile_predicate
+)
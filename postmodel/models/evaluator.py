@@ -0,0 +1,675 @@
+
+import datetime
+import json
+import math
+import operator
+import re
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
+from functools import partial
+
+from postmodel.exceptions import FieldError, OperationalError, ParamsError
+from .fields import JSONField, DecimalField, TimeDeltaField
+from .functions import Function
+from .query import QuerySet, expressions_shape
+
+
+class _Missing:
+    """
+    SQL NULL of a json path which does not exist, json ``null`` is None.
+    """
+    def __repr__(self):
+        return "MISSING"
+
+MISSING = _Missing()
+
+COMPARE_OPERATORS = {
+    'greater_equal': operator.ge,
+    'greater_than': operator.gt,
+    'less_equal': operator.le,
+    'less_than': operator.lt,
+}
+JSON_COMPARE_OPERATORS = {
+    'gte': operator.ge,
+    'gt': operator.gt,
+    'lte': operator.le,
+    'lt': operator.lt,
+}
+
+
+def like_regex(pattern):
+    """
+    Compile sql ``LIKE`` pattern, ``%`` and ``_`` are wildcards and backslash
+    escapes the next character.
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        elif char == '%':
+            parts.append('.*')
+        elif char == '_':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return re.compile(''.join(parts), re.DOTALL)
+
+
+def sql_upper(value):
+    # upper() of "C" ctype only maps ascii letters
+    return value.translate(_ASCII_UPPER)
+
+_ASCII_UPPER = {c: c - 32 for c in range(ord('a'), ord('z') + 1)}
+
+
+def _float_text(value):
+    # float8 output of postgres 12+, shortest exact digits
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if value == 0:
+        return '-0' if math.copysign(1, value) < 0 else '0'
+    sign, digits, exponent = Decimal(repr(value)).normalize().as_tuple()
+    digits = ''.join(map(str, digits))
+    point = len(digits) + exponent
+    sign = '-' if sign else ''
+    if point - 1 < -4 or point - 1 >= 15:
+        mantissa = digits[0] + ('.' + digits[1:] if len(digits) > 1 else '')
+        return '{}{}e{}{:02d}'.format(sign, mantissa, '-' if point - 1 < 0 else '+', abs(point - 1))
+    if point <= 0:
+        return '{}0.{}{}'.format(sign, '0' * -point, digits)
+    if point >= len(digits):
+        return sign + digits + '0' * (point - len(digits))
+    return '{}{}.{}'.format(sign, digits[:point], digits[point:])
+
+
+def sql_text(field, value):
+    """
+    Text of value cast to ``VARCHAR`` by postgres.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(field, TimeDeltaField):
+        return str(field.to_db_value(value))
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return _float_text(value)
+    if isinstance(value, Decimal):
+        if isinstance(field, DecimalField) and value.is_finite():
+            value = value.quantize(Decimal(1).scaleb(-field.decimal_places), rounding=ROUND_HALF_UP)
+        return format(value, 'f') if value.is_finite() else 'NaN'
+    if isinstance(value, datetime.datetime):
+        text = value.strftime('%Y-%m-%d %H:%M:%S')
+        if value.microsecond:
+            text += '.{:06d}'.format(value.microsecond).rstrip('0')
+        return text
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return '\\x' + value.hex()
+    return str(value)
+
+
+def _sort_key(value):
+    # postgres orders NaN after every number and NaN equals NaN
+    if isinstance(value, (float, Decimal)) and value != value:
+        return (1, 0)
+    return (0, value)
+
+
+def _json_number(value):
+    return Decimal(repr(value)) if isinstance(value, float) else Decimal(value)
+
+
+def _json_key_order(key):
+    # jsonb stores object keys by length and then bytes
+    data = key.encode('utf-8')
+    return (len(data), data)
+
+
+def _json_string_text(value):
+    parts = ['"']
+    for char in value:
+        if char == '"':
+            parts.append('\\"')
+        elif char == '\\':
+            parts.append('\\\\')
+        elif char == '\b':
+            parts.append('\\b')
+        elif char == '\f':
+            parts.append('\\f')
+        elif char == '\n':
+            parts.append('\\n')
+        elif char == '\r':
+            parts.append('\\r')
+        elif char == '\t':
+            parts.append('\\t')
+        elif char < ' ':
+            parts.append('\\u{:04x}'.format(ord(char)))
+        else:
+            parts.append(char)
+    parts.append('"')
+    return ''.join(parts)
+
+
+def json_text(value):
+    """
+    Text of jsonb value cast to ``VARCHAR`` by postgres.
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return format(_json_number(value), 'f')
+    if isinstance(value, str):
+        return _json_string_text(value)
+    if isinstance(value, (list, tuple)):
+        return '[{}]'.format(', '.join(json_text(v) for v in value))
+    if isinstance(value, dict):
+        return '{{{}}}'.format(', '.join(
+            '{}: {}'.format(_json_string_text(k), json_text(value[k]))
+            for k in sorted(value, key=_json_key_order)
+        ))
+    raise ParamsError(f'unsupported json value {value!r}')
+
+
+def _json_rank(value):
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return 1
+    if isinstance(value, bool):
+        return 3
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, (list, tuple)):
+        return 4
+    return 5
+
+
+def json_compare(left, right, top=True):
+    """
+    Compare jsonb values like postgres, returns -1, 0 or 1.
+
+    null < string < number < boolean < array < object, an empty top level
+    array sorts before null. Arrays and objects with more elements sort
+    after those with less, then elements are compared in storage order.
+    """
+    if top:
+        left_empty = isinstance(left, (list, tuple)) and not left
+        right_empty = isinstance(right, (list, tuple)) and not right
+        if left_empty or right_empty:
+            if left_empty and right_empty:
+                return 0
+            return -1 if left_empty else 1
+    left_rank, right_rank = _json_rank(left), _json_rank(right)
+    if left_rank != right_rank:
+        return -1 if left_rank < right_rank else 1
+    if left_rank == 0:
+        return 0
+    if left_rank == 2:
+        left, right = _json_number(left), _json_number(right)
+    elif left_rank == 4:
+        if len(left) != len(right):
+            return -1 if len(left) < len(right) else 1
+        for l, r in zip(left, right):
+            result = json_compare(l, r, top=False)
+            if result:
+                return result
+        return 0
+    elif left_rank == 5:
+        if len(left) != len(right):
+            return -1 if len(left) < len(right) else 1
+        left_keys = sorted(left, key=_json_key_order)
+        right_keys = sorted(right, key=_json_key_order)
+        for lk, rk in zip(left_keys, right_keys):
+            result = json_compare(lk, rk, top=False)
+            if result:
+                return result
+            result = json_compare(left[lk], right[rk], top=False)
+            if result:
+                return result
+        return 0
+    return (left > right) - (left < right)
+
+
+def json_contains(container, contained, top=True):
+    """
+    ``container @> contained`` of jsonb.
+    """
+    if isinstance(container, dict):
+        if not isinstance(contained, dict):
+            return False
+        for key, value in contained.items():
+            if key not in container:
+                return False
+            if not _json_contains_element(container[key], value):
+                return False
+        return True
+    if isinstance(container, (list, tuple)):
+        if isinstance(contained, (list, tuple)):
+            return all(
+                any(_json_contains_element(element, value) for element in container)
+                for value in contained
+            )
+        if top and not isinstance(contained, dict):
+            # a top level array contains a primitive value
+            return any(_json_rank(e) < 4 and json_compare(e, contained, top=False) == 0 for e in container)
+        return False
+    if isinstance(contained, (list, tuple, dict)):
+        return False
+    return json_compare(container, contained, top=False) == 0
+
+
+def _json_contains_element(container, contained):
+    if _json_rank(container) < 4 or _json_rank(contained) < 4:
+        return (_json_rank(container) == _json_rank(contained)
+            and json_compare(container, contained, top=False) == 0)
+    if type(container) is not type(contained) and not (
+            isinstance(container, (list, tuple)) and isinstance(contained, (list, tuple))):
+        return False
+    return json_contains(container, contained, top=False)
+
+
+def json_has_key(value, key):
+    """
+    ``value ? key`` of jsonb.
+    """
+    if isinstance(value, dict):
+        return key in value
+    if isinstance(value, (list, tuple)):
+        return any(isinstance(e, str) and e == key for e in value)
+    return isinstance(value, str) and value == key
+
+
+def json_extract(value, attributes):
+    if not attributes:
+        return value
+    if len(attributes) == 1:
+        # ``->`` with a text key
+        if isinstance(value, dict):
+            return value.get(attributes[0], MISSING)
+        return MISSING
+    for name in attributes:
+        # ``#>`` path, array elements by index
+        if isinstance(value, dict):
+            value = value.get(name, MISSING)
+        elif isinstance(value, (list, tuple)):
+            try:
+                index = int(name)
+            except ValueError:
+                return MISSING
+            if index < 0:
+                index += len(value)
+            if not 0 <= index < len(value):
+                return MISSING
+            value = value[index]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def _json_type_name(value):
+    return ('null', 'string', 'numeric', 'boolean', 'array', 'object')[_json_rank(value)]
+
+
+def _json_cast(value, target):
+    """
+    Cast jsonb value to boolean or numeric, postgres raises an error for
+    values of other types.
+    """
+    if target == 'boolean' and isinstance(value, bool):
+        return value
+    if target == 'numeric' and _json_rank(value) == 2:
+        return _json_number(value)
+    raise OperationalError(f'cannot cast jsonb {_json_type_name(value)} to type {target}')
+
+
+def _and(parts):
+    def evaluate(obj, get, tests):
+        result = True
+        for part in parts:
+            value = part(obj, get, tests)
+            if value is False:
+                return False
+            if value is None:
+                result = None
+        return result
+    return evaluate
+
+
+def _or(parts):
+    def evaluate(obj, get, tests):
+        result = False
+        for part in parts:
+            value = part(obj, get, tests)
+            if value is True:
+                return True
+            if value is None:
+                result = None
+        return result
+    return evaluate
+
+
+def _not(part):
+    def evaluate(obj, get, tests):
+        value = part(obj, get, tests)
+        return None if value is None else not value
+    return evaluate
+
+
+def _leaf(index, name):
+    def evaluate(obj, get, tests):
+        return tests[index](get(obj, name))
+    return evaluate
+
+
+class Predicate:
+    """
+    Expressions bound to filter values, evaluated in Python.
+
+    ``evaluate()`` returns True, False or None for unknown, like a SQL boolean,
+    objects are matched only when it is True. Values are read by ``get(obj, name)``
+    with field names, ``getattr`` for instances.
+    """
+
+    __slots__ = ("node", "tests", "collation_sensitive")
+
+    def __init__(self, node, tests, collation_sensitive=False):
+        self.node = node
+        self.tests = tests
+        self.collation_sensitive = collation_sensitive
+
+    def evaluate(self, obj, get=getattr):
+        if self.node is None:
+            return True
+        return self.node(obj, get, self.tests)
+
+    def __call__(self, obj, get=getattr):
+        return self.evaluate(obj, get) is True
+
+    def filter(self, objects, get=getattr):
+        if self.node is None:
+            return list(objects)
+        node, tests = self.node, self.tests
+        return [obj for obj in objects if node(obj, get, tests) is True]
+
+    def filter_rows(self, rows):
+        """
+        Returns rows matched, rows are mappings of field names to values.
+        """
+        return self.filter(rows, get=operator.getitem)
+
+    def filter_columns(self, columns):
+        """
+        Returns indexes of rows matched, ``columns`` maps field names to lists
+        of values.
+        """
+        size = len(next(iter(columns.values()))) if columns else 0
+
+        def get(i, name):
+            return columns[name][i]
+
+        return self.filter(range(size), get=get)
+
+
+class CompiledExpression:
+    """
+    Expression tree of a model compiled once by shape, the filter keys and
+    structure without values, and bound to values of each query by ``bind()``.
+    """
+
+    def __init__(self, model_class, shape):
+        self.model_class = model_class
+        self.meta = model_class._meta
+        self.leaves = []  # (make_test, collation_sensitive)
+        self.filters = {}
+        for field_filters in self.meta.filters.values():
+            self.filters.update(field_filters)
+        self.node = self._compile(shape)
+
+    def _compile(self, shape):
+        if isinstance(shape, list):
+            parts = [p for p in (self._compile(s) for s in shape) if p is not None]
+            return _and(parts) if parts else None
+        join_type, negated, children, keys = shape
+        parts = []
+        if children:
+            for child in children:
+                part = self._compile(child)
+                if part is not None:
+                    parts.append(part)
+        else:
+            for key in keys:
+                parts.append(_leaf(len(self.leaves), self._compile_leaf(key)))
+        if not parts:
+            return None
+        node = parts[0] if len(parts) == 1 else (_and(parts) if join_type == "AND" else _or(parts))
+        return _not(node) if negated else node
+
+    def _compile_leaf(self, key):
+        ff = self.filters.get(key)
+        if ff is not None:
+            field = self.meta.fields_map[ff['field']]
+            op = ff['operator']
+            sensitive = op.startswith('insensitive') or (op in COMPARE_OPERATORS and field.type is str)
+            self.leaves.append((partial(self._plain_test, field, op, ff.get('value_encoder')), sensitive))
+            return ff['field']
+        field_name, op, attributes = self._parse_json_key(key)
+        field = self.meta.fields_map.get(field_name)
+        if not isinstance(field, JSONField):
+            raise FieldError(f"Unknown filter {key} for model {self.model_class.__name__}")
+        if op not in JSON_OPERATORS:
+            raise FieldError(f"Unknown json filter operator {op} of {key}")
+        sensitive = op in JSON_COMPARE_OPERATORS
+        self.leaves.append((partial(self._json_test, field, op, attributes), sensitive))
+        return field_name
+
+    @staticmethod
+    def _parse_json_key(key):
+        parts = key.split('__')
+        if len(parts) == 1:
+            op, key_name = 'equal', key
+        else:
+            op, key_name = parts[-1], '__'.join(parts[:-1])
+        names = key_name.split('.')
+        return names[0], op, names[1:]
+
+    @staticmethod
+    def _python_value(field, value):
+        if isinstance(value, float) and isinstance(field, DecimalField):
+            return Decimal(repr(value))
+        try:
+            return field.to_python_value(value)
+        except (TypeError, ValueError, ArithmeticError):
+            raise ParamsError(f"invalid value {value!r} for field {field.model_field_name}")
+
+    @classmethod
+    def _plain_test(cls, field, op, encoder, value):
+        if op in ('equal', 'not_equal') or op in COMPARE_OPERATORS:
+            arg = None if value is None else _sort_key(cls._python_value(field, value))
+            if op == 'equal':
+                return lambda v: None if v is None or arg is None else _sort_key(v) == arg
+            if op == 'not_equal':
+                return lambda v: True if v is None else (None if arg is None else _sort_key(v) != arg)
+            compare = COMPARE_OPERATORS[op]
+            return lambda v: None if v is None or arg is None else compare(_sort_key(v), arg)
+        if op in ('is_in', 'not_in'):
+            values = list(value)
+            has_null = any(v is None for v in values)
+            keys = {_sort_key(cls._python_value(field, v)) for v in values if v is not None}
+            if op == 'is_in':
+                if not values:
+                    return lambda v: False
+                return lambda v: None if v is None else (
+                    True if _sort_key(v) in keys else (None if has_null else False))
+            if not values:
+                return lambda v: True
+            return lambda v: None if v is None else (
+                False if _sort_key(v) in keys else (None if has_null else True))
+        if op == 'is_null':
+            return (lambda v: v is None) if value else (lambda v: v is not None)
+        if op == 'not_null':
+            return (lambda v: v is not None) if value else (lambda v: v is None)
+        if op == 'insensitive_exact':
+            arg = sql_upper(encoder(value))
+            return lambda v: None if v is None else sql_upper(sql_text(field, v)) == arg
+        pattern = encoder(value)
+        if op.startswith('insensitive'):
+            regex = like_regex(sql_upper(pattern))
+            return lambda v: None if v is None else regex.fullmatch(sql_upper(sql_text(field, v))) is not None
+        regex = like_regex(pattern)
+        return lambda v: None if v is None else regex.fullmatch(sql_text(field, v)) is not None
+
+    @classmethod
+    def _json_test(cls, field, op, attributes, value):
+        def extract(v):
+            if v is None:
+                return MISSING
+            return json_extract(v, attributes)
+
+        if op in ('has_keys', 'has_anykeys'):
+            if not isinstance(value, (list, tuple)):
+                raise ParamsError(f'{op} parameter value must be list or tuple.')
+            keys = list(value)
+            check = all if op == 'has_keys' else any
+
+            def test(v):
+                v = extract(v)
+                return None if v is MISSING else check(json_has_key(v, k) for k in keys)
+            return test
+        if op == 'has_key':
+            return lambda v: None if extract(v) is MISSING else json_has_key(extract(v), value)
+        if op in ('startswith', 'endswith'):
+            regex = like_regex(f'"{value}%' if op == 'startswith' else f'%{value}"')
+            return lambda v: None if extract(v) is MISSING else regex.fullmatch(json_text(extract(v))) is not None
+        if op in ('contains', 'in'):
+            arg = json.loads(json.dumps(value))
+            if op == 'contains':
+                return lambda v: None if extract(v) is MISSING else json_contains(extract(v), arg)
+            return lambda v: None if extract(v) is MISSING else json_contains(arg, extract(v))
+
+        if value is None:
+            # compared with NULL
+            if op == 'not':
+                return lambda v: True if extract(v) is MISSING else None
+            return lambda v: None
+        if isinstance(value, bool):
+            arg = value
+            convert = partial(_json_cast, target='boolean')
+        elif isinstance(value, (int, float)):
+            arg = _json_number(value)
+            convert = partial(_json_cast, target='numeric')
+        elif isinstance(value, str):
+            arg = json.dumps(value)
+            convert = json_text
+        elif isinstance(value, (dict, list, tuple)):
+            arg = json.loads(json.dumps(value))
+            convert = None
+        else:
+            raise ParamsError(f'unsupported json value {value} to encode')
+
+        if convert is None:
+            def compare(v, compare_op):
+                return compare_op(json_compare(v, arg), 0)
+        else:
+            def compare(v, compare_op):
+                return compare_op(convert(v), arg)
+
+        if op == 'not':
+            def test(v):
+                v = extract(v)
+                return True if v is MISSING else compare(v, operator.ne)
+            return test
+        compare_op = operator.eq if op == 'equal' else JSON_COMPARE_OPERATORS[op]
+
+        def test(v):
+            v = extract(v)
+            return None if v is MISSING else compare(v, compare_op)
+        return test
+
+    def bind(self, values):
+        tests = [make_test(value) for (make_test, _), value in zip(self.leaves, values)]
+        sensitive = any(s for _, s in self.leaves)
+        return Predicate(self.node, tests, sensitive)
+
+
+JSON_OPERATORS = {'equal', 'not', 'has_key', 'has_keys', 'has_anykeys', 'contains', 'in',
+    'startswith', 'endswith', *JSON_COMPARE_OPERATORS}
+
+
+def _filter_values(expression, values):
+    """
+    Appends filter values of expression in order of leaves of its shape.
+    """
+    if expression.children:
+        for child in expression.children:
+            _filter_values(child, values)
+        return
+    for key, value in expression.filters.items():
+        if isinstance(value, (QuerySet, Function)):
+            raise OperationalError(f"filter {key} can only be evaluated by database")
+        values.append(value)
+
+
+class ExpressionEvaluator:
+    """
+    Compiles ``QueryExpression`` trees into ``Predicate`` evaluated in Python
+    with the semantics of the SQL generated for them:
+
+    * NULL makes comparisons unknown, ``AND``, ``OR`` and ``NOT`` follow three
+      valued logic and only rows evaluated to true are matched;
+    * ``contains``, ``startswith`` and ``endswith`` are ``LIKE`` patterns, so
+      ``%`` and ``_`` in values are wildcards;
+    * non text values are compared as their text for text lookups;
+    * json lookups cast json values like postgres, and raise ``OperationalError``
+      where postgres fails to cast.
+
+    Text is compared and upper cased like postgres with the "C" collation,
+    predicates comparing text by order or ignoring case are marked
+    ``collation_sensitive``. Compiled trees are cached by shape.
+    """
+
+    MAX_SHAPES = 1000
+
+    def __init__(self):
+        self.compiled = OrderedDict()
+
+    def compile(self, model_class, *expressions):
+        values = []
+        for expression in expressions:
+            _filter_values(expression, values)
+        shape = expressions_shape(expressions)
+        key = (model_class, shape)
+        compiled = self.compiled.get(key)
+        if compiled is None:
+            compiled = self.compiled[key] = CompiledExpression(model_class, list(shape))
+            if len(self.compiled) > self.MAX_SHAPES:
+                self.compiled.popitem(last=False)
+        else:
+            self.compiled.move_to_end(key)
+        return compiled.bind(values)
+
+
+evaluator = ExpressionEvaluator()
+
+
+def compile_predicate(model_class, *expressions):
+    """
+    Returns ``Predicate`` of expressions joined by AND, e.g.::
+
+        predicate = compile_predicate(Book, Q(name__startswith="a") | Q(price__gt=10))
+        books = predicate.filter(books)
+    """
+    return evaluator.compile(model_class, *expressions)
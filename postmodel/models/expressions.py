@@ -0,0 +1,76 @@
+
+from typing import Any
+
+
+class Combinable:
+    """
+    Arithmetic operators for expressions which are evaluated by the database.
+    """
+    ADD = "+"
+    SUB = "-"
+    MUL = "*"
+    DIV = "/"
+    MOD = "%"
+
+    def _combine(self, other, connector, reversed=False):
+        if reversed:
+            return CombinedExpression(other, connector, self)
+        return CombinedExpression(self, connector, other)
+
+    def __add__(self, other):
+        return self._combine(other, self.ADD)
+
+    def __sub__(self, other):
+        return self._combine(other, self.SUB)
+
+    def __mul__(self, other):
+        return self._combine(other, self.MUL)
+
+    def __truediv__(self, other):
+        return self._combine(other, self.DIV)
+
+    def __mod__(self, other):
+        return self._combine(other, self.MOD)
+
+    def __radd__(self, other):
+        return self._combine(other, self.ADD, True)
+
+    def __rsub__(self, other):
+        return self._combine(other, self.SUB, True)
+
+    def __rmul__(self, other):
+        return self._combine(other, self.MUL, True)
+
+    def __rtruediv__(self, other):
+        return self._combine(other, self.DIV, True)
+
+    def __rmod__(self, other):
+        return self._combine(other, self.MOD, True)
+
+
+class F(Combinable):
+    """
+    Reference to the current database value of a field.
+
+    Used for atomic updates that are computed in database:
+
+    .. code-block:: python3
+
+        await Book.filter(id=1).update(read_count=F("read_count") + 1)
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __repr__(self) -> str:
+        return f"F({self.name})"
+
+
+class CombinedExpression(Combinable):
+    def __init__(self, left: Any, connector: str, right: Any) -> None:
+        self.left = left
+        self.connector = connector
+        self.right = right
+
+    def __repr__(self) -> str:
+        return f"({self.left!r} {self.connector} {self.right!r})"
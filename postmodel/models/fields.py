@@ -353,4 +353,98 @@ class BinaryField(Field):  # type: ignore
         if isinstance(value, str):
             return self.type(value, encoding='utf-8')
         else:
-            raise FieldValueError(f'BinaryField require str, bytes type, provided value type {type(value)}, content: {value}')
\ No newline at end of file
+            raise FieldValueError(f'BinaryField require str, bytes type, provided value type {type(value)}, content: {value}')
+
+class ForeignKeyField(Field):
+    """
+    ForeignKey relation field.
+
+    The primary key of related object is stored in field ``{name}_id``, and the related
+    object can be fetched with ``QuerySet.select_related()``.
+
+    You must provide the following:
+
+    ``model`` (Model or "self"):
+        The related model, or ``"self"`` for relation to the model itself.
+
+    ``on_delete`` (str):
+        Action when related row is deleted, one of ``CASCADE``, ``RESTRICT``,
+        ``SET NULL``, ``SET DEFAULT`` and ``NO ACTION``.
+    ``db_constraint`` (bool):
+        Create FOREIGN KEY constraint in database. Default is True.
+    """
+
+    __slots__ = ("related_model", "relation_name", "on_delete", "db_constraint")
+
+    ON_DELETE_ACTIONS = ("CASCADE", "RESTRICT", "SET NULL", "SET DEFAULT", "NO ACTION")
+
+    def __init__(self, model, on_delete: str = "CASCADE", db_constraint: bool = True, **kwargs) -> None:
+        on_delete = on_delete.upper()
+        if on_delete not in self.ON_DELETE_ACTIONS:
+            raise ConfigurationError(f"'on_delete' must be one of {', '.join(self.ON_DELETE_ACTIONS)}")
+        if on_delete == "SET NULL" and not kwargs.get("null", False):
+            raise ConfigurationError("If on_delete is SET NULL, then field must have null=True set")
+        kwargs.pop("pk", None)
+        super().__init__(None, **kwargs)
+        self.related_model = model
+        self.relation_name = ""  # type: str
+        self.on_delete = on_delete
+        self.db_constraint = db_constraint
+        if isinstance(model, str):
+            # only relations to the model itself are resolved by name, when it is created
+            if model != "self":
+                raise ConfigurationError(f'ForeignKeyField model must be a Model or "self", not {model!r}')
+        else:
+            self.resolve(model)
+
+    def resolve(self, model) -> None:
+        related_pk = model._meta.primary_key
+        if not isinstance(related_pk, str):
+            raise ConfigurationError("ForeignKeyField can only relate to model with single primary key")
+        self.related_model = model
+        self.type = model._meta.fields_map[related_pk].type
+
+    @property
+    def related_field(self):
+        return self.related_model._meta.pk
+
+    def to_db_value(self, value: Any) -> Any:
+        return self.related_field.to_db_value(value)
+
+    def to_python_value(self, value: Any) -> Any:
+        return self.related_field.to_python_value(value)
+
+
+class RelationDescriptor:
+    """
+    Access related object of ``ForeignKeyField`` on model instance.
+    """
+
+    def __init__(self, field: ForeignKeyField) -> None:
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        name = self.field.relation_name
+        related_objects = instance._related_objects
+        related_id = getattr(instance, self.field.model_field_name)
+        if name in related_objects:
+            related = related_objects[name]
+            if related is None and related_id is None:
+                return None
+            if related is not None and related.pk == related_id:
+                return related
+        if related_id is None:
+            return None
+        raise NoValuesFetched(
+            f"Related object '{name}' is not fetched, use select_related() or fetch_related()"
+        )
+
+    def __set__(self, instance, value) -> None:
+        if value is not None and not isinstance(value, self.field.related_model):
+            raise FieldValueError(
+                f"'{self.field.relation_name}' requires {self.field.related_model.__name__} instance"
+            )
+        setattr(instance, self.field.model_field_name, value.pk if value is not None else None)
+        instance._related_objects[self.field.relation_name] = value
@@ -1,15 +1,17 @@
 from copy import copy, deepcopy
 from collections.abc import Iterable
 
-from postmodel.exceptions import ConfigurationError, OperationalError, StaleObjectError
+from postmodel.exceptions import ConfigurationError, OperationalError, StaleObjectError, DoesNotExist, FieldError
 from postmodel.exceptions import (
+    ParamsError,
     PrimaryKeyChangedError,
     PrimaryKeyIntegrityError
 )
 from postmodel.main import Postmodel
 from collections import OrderedDict
-from .query import QuerySet, FilterBuilder
-from .fields import Field, DataVersionField
+from .query import QuerySet, QueryExpression, FilterBuilder
+from .fields import Field, DataVersionField, DatetimeField, ForeignKeyField, RelationDescriptor
+from .expressions import F
 import re
 import datetime
 import uuid
@@ -46,7 +48,19 @@ class MetaInfo:
         "table_description",
         "pk",
         "db_pk_field",
-        "filters"
+        "fk_fields",
+        "filters",
+        "cache",
+        "cache_expire",
+        "cache_local_ttl",
+        "cache_local_size",
+        "cache_serializer",
+        "replicate_in_memory",
+        "negative_cache",
+        "negative_cache_ttl",
+        "shard_key",
+        "shards",
+        "router"
     )
 
     def __init__(self, meta) -> None:
@@ -72,7 +86,19 @@ class MetaInfo:
         self.table_description = getattr(meta, "table_description", "")  # type: str
         self.pk = None  # type: fields.Field | Tuple[fields.Field]
         self.db_pk_field = ""  # type: str | Tuple[str]
+        self.fk_fields = OrderedDict()  # type: Dict[str, fields.ForeignKeyField]
         self.filters = {}
+        self.cache = getattr(meta, "cache", False)  # type: bool
+        self.cache_expire = getattr(meta, "cache_expire", 86400)  # type: int
+        self.cache_local_ttl = getattr(meta, "cache_local_ttl", 0)  # type: float
+        self.cache_local_size = getattr(meta, "cache_local_size", 1000)  # type: int
+        self.cache_serializer = getattr(meta, "cache_serializer", None)
+        self.replicate_in_memory = getattr(meta, "replicate_in_memory", False)  # type: bool
+        self.negative_cache = getattr(meta, "negative_cache", False)  # type: bool | int
+        self.negative_cache_ttl = getattr(meta, "negative_cache_ttl", 60)  # type: float
+        self.shard_key = getattr(meta, "shard_key", None)  # type: Optional[str]
+        self.shards = tuple(getattr(meta, "shards", ()))  # type: Tuple[str]
+        self.router = getattr(meta, "router", None)  # type: Optional[DatabaseRouter]
 
     def _get_together(self, meta, together: str):
         _together = getattr(meta, together, ())
@@ -118,6 +144,8 @@ class MetaInfo:
             self.finalise_pk()
         self.finalize_filters()
         self.finalise_fields()
+        if self.shard_key and (self.shard_key not in self.fields_map or not self.shards):
+            raise ConfigurationError('shard_key must be a field of model with shards.')
 
     def finalise_fields(self) -> None:
         self.db_fields = set(self.fields_db_projection.values())
@@ -134,6 +162,9 @@ class MetaInfo:
                     self.dataversion_field = field_name
                 else:
                     raise Exception('model class can only have one DataVersionField.')
+        for field_name, field in self.fields_map.items():
+            if isinstance(field, ForeignKeyField):
+                self.fk_fields[field.relation_name] = field
 
 
 class ModelMeta(type):
@@ -153,7 +184,12 @@ class ModelMeta(type):
 
         pk_attr = meta.primary_key
 
+        relations = {}
         for key, value in attrs.items():
+            if isinstance(value, ForeignKeyField):
+                relations[key] = value
+                value.relation_name = key
+                key = f"{key}_id"
             if isinstance(value, Field):
                 fields_map[key] = value
                 value.model_field_name = key
@@ -164,7 +200,9 @@ class ModelMeta(type):
                 fields_db_projection[key] = value.db_field or key
 
         for key in fields_map.keys():
-            attrs.pop(key)
+            attrs.pop(key, None)
+        for key, value in relations.items():
+            attrs[key] = RelationDescriptor(value)
 
         for base in bases:
             _meta = getattr(base, "_meta", None)
@@ -186,6 +224,10 @@ class ModelMeta(type):
 
         attrs["_meta"] = meta
         new_class = super().__new__(mcs, name, bases, attrs)  # type: "Model"  # type: ignore
+        for field in fields_map.values():
+            if isinstance(field, ForeignKeyField) and field.related_model == "self":
+                meta.finalise_pk()
+                field.resolve(new_class)
         meta.finalise_model()
         new_class.check()
         return new_class
@@ -215,6 +257,7 @@ class Model(metaclass=ModelMeta):
         # self._meta is a very common attribute lookup, lets cache it.
         meta = self._meta
         self._saved_in_db = load_from_db
+        self._related_objects = {}
 
         # Assign values and do type conversions
         passed_fields = {*kwargs.keys()}
@@ -229,7 +272,9 @@ class Model(metaclass=ModelMeta):
         # Assign defaults for missing fields
         for key in meta.fields.difference(passed_fields):
             field = meta.fields_map[key]
-            if callable(field.default):
+            if isinstance(field, ForeignKeyField) and field.relation_name in passed_fields:
+                setattr(self, field.relation_name, kwargs[field.relation_name])
+            elif callable(field.default):
                 setattr(self, key, field.default())
             else:
                 setattr(self, key, field.default)
@@ -315,16 +360,13 @@ class Model(metaclass=ModelMeta):
 
     def __setattr__(self, name, val):
         primary_key = self._meta.primary_key
-        old_val = getattr(self, name, None)
         isprimary = False
         if isinstance(primary_key, str):
-            if name == primary_key and old_val != None:
-                isprimary = True
+            isprimary = name == primary_key
         elif isinstance(primary_key, tuple):
-            if name in primary_key:
-                isprimary = True
+            isprimary = name in primary_key
 
-        if isprimary and old_val != None:
+        if isprimary and getattr(self, name, None) != None:
             raise PrimaryKeyChangedError(f'"{name}" is primary key, can not be changed.')
         else:
             super().__setattr__(name, val)
@@ -432,6 +474,26 @@ class Model(metaclass=ModelMeta):
         cls.check_primary_key(**kwargs)
         return QuerySet(cls).filter(**kwargs).first()
 
+    async def fetch_related(self, *relations) -> None:
+        """
+        Fetch related objects of ``ForeignKeyField`` relations.
+
+        .. code-block:: python3
+
+            await order.fetch_related("user")
+            print(order.user.name)
+        """
+        for relation in relations:
+            field = self._meta.fk_fields.get(relation)
+            if not field:
+                raise FieldError(f"Unknown relation {relation} for model {self.__class__.__name__}")
+            related_id = getattr(self, field.model_field_name)
+            related = None
+            if related_id is not None:
+                related_model = field.related_model
+                related = await related_model.load(**{related_model._meta.primary_key: related_id})
+            self._related_objects[relation] = related
+
     async def save(self, update_fields = None, force=False) -> int:
         changed = self.changed()
         if len(changed) == 0:
@@ -446,7 +508,7 @@ class Model(metaclass=ModelMeta):
 
         fileds = list(set(update_fields or ()) | set(self.changed()))
 
-        mapper = self.get_mapper()
+        mapper = self.get_mapper(instance=self)
         if self._saved_in_db:
             ret = await mapper.update(self, update_fields=fileds, condition_fields=condition_fields)
             if ret == 0:
@@ -459,6 +521,42 @@ class Model(metaclass=ModelMeta):
 
         self.make_snapshot()
 
+    async def update_fields_atomic(self, **kwargs) -> None:
+        """
+        Updates fields of the current model object in database, values may be ``F``
+        expressions which are computed by database. The new values are fetched back
+        in the same statement and assigned to the object.
+
+        .. code-block:: python3
+
+            await book.update_fields_atomic(read_count=F("read_count") + 1)
+
+        ``DataVersionField`` is increased and ``auto_now`` fields are refreshed, so
+        concurrent ``save()`` with stale data will fail.
+
+        :raises OperationalError: If object has never been persisted.
+        :raises DoesNotExist: If object has been deleted from database.
+        """
+        if not self._saved_in_db:
+            raise OperationalError("Can't update unpersisted record")
+        for field in self._meta.auto_fields:
+            field_name = field.model_field_name
+            if field_name in kwargs:
+                continue
+            if isinstance(field, DataVersionField):
+                kwargs[field_name] = F(field_name) + 1
+            elif isinstance(field, DatetimeField) and field.auto_now:
+                kwargs[field_name] = datetime.datetime.utcnow()
+
+        mapper = self.get_mapper(instance=self)
+        new_values = await mapper.update_atomic(self, kwargs)
+        if new_values is None:
+            raise DoesNotExist("Object does not exist")
+        for key, value in new_values.items():
+            value = self._meta.fields_map[key].to_python_value(value)
+            setattr(self, key, value)
+            self._snapshot_data[key] = deepcopy(value)
+
     async def delete(self) -> int:
         """
         Deletes the current model object.
@@ -467,7 +565,7 @@ class Model(metaclass=ModelMeta):
         """
         if not self._saved_in_db:
             raise OperationalError("Can't delete unpersisted record")
-        mapper = self.get_mapper()
+        mapper = self.get_mapper(instance=self)
         return await mapper.delete(self)
 
     @classmethod
@@ -502,7 +600,7 @@ class Model(metaclass=ModelMeta):
         """
         instance = cls(**kwargs)
         instance._auto_values()
-        mapper = cls.get_mapper()
+        mapper = cls.get_mapper(instance=instance)
         await mapper.insert(instance)
         instance._saved_in_db = True
         instance.make_snapshot()
@@ -540,9 +638,49 @@ class Model(metaclass=ModelMeta):
             obj.make_snapshot()
 
     @classmethod
-    def get_mapper(cls, using_db=None):
-        db_name = using_db or cls._meta.db_name
-        mapper = Postmodel.get_mapper(cls, db_name)
+    async def claim(cls, batch=1, where=None, lease=None, order_by=()):
+        """
+        Claim up to ``batch`` rows for processing and mark them with ``lease`` values
+        in one statement. Rows locked by other workers are skipped, so many workers
+        can consume a table as job queue concurrently.
+
+        .. code-block:: python3
+
+            jobs = await Job.claim(
+                batch=10,
+                where=Q(status="pending"),
+                lease={"status": "running", "worker": worker_id},
+                order_by=("id",)
+            )
+
+        :param batch: Max number of rows to claim
+        :param where: ``QueryExpression`` or dict of filters for claimable rows
+        :param lease: Dict of field values (or ``F`` expressions) set on claimed rows
+        :param order_by: Orderings in which rows are claimed
+        :raises ParamsError: If lease is empty.
+        """
+        if not lease:
+            raise ParamsError("claim() requires lease values to mark claimed rows")
+        queryset = QuerySet(cls)
+        if isinstance(where, QueryExpression):
+            queryset = queryset.filter(where)
+        elif where:
+            queryset = queryset.filter(**where)
+        if order_by:
+            queryset = queryset.order_by(*order_by)
+        queryset = queryset.limit(batch).select_for_update(skip_locked=True)
+        mapper = cls.get_mapper()
+        return await mapper.claim(queryset, lease)
+
+    @classmethod
+    def get_mapper(cls, using_db=None, instance=None):
+        """
+        Returns mapper of database ``using_db``, or of database where router
+        writes ``instance``. Only ``using_db`` chooses one shard of models with
+        ``Meta.shard_key``.
+        """
+        db_name = using_db or Postmodel.db_for_write(cls, instance)
+        mapper = Postmodel.get_mapper(cls, db_name, shard=using_db is not None)
         return mapper
 
     @classmethod
@@ -3,7 +3,8 @@ from copy import copy
 from typing import Any, Dict, List, Optional, Tuple
 from enum import Enum
 
-from postmodel.exceptions import FieldError, OperationalError
+from postmodel.exceptions import FieldError, OperationalError, ParamsError
+from postmodel.main import Postmodel
 from .fields import Field
 from functools import partial
 
@@ -210,6 +211,19 @@ class QueryExpression:
 
 Q = QueryExpression
 
+
+def _expression_shape(expression):
+    return (expression.join_type, expression._is_negated,
+        tuple(_expression_shape(child) for child in expression.children), tuple(expression.filters))
+
+
+def expressions_shape(expressions):
+    """
+    Returns shape of expressions, their filters without values.
+    """
+    return tuple(_expression_shape(expression) for expression in expressions)
+
+
 class QuerySet:
     def __init__(self, model_class):
         self.model_class = model_class
@@ -224,6 +238,17 @@ class QuerySet:
         self._orderings: List[Tuple[str, Any]] = []
         self._expressions: List[QueryExpression] = []
         self._distinct: bool = False
+        self._select_for_update: bool = False
+        self._select_for_update_skip_locked: bool = False
+        self._select_for_update_nowait: bool = False
+        self._select_for_update_of: Tuple[str, ...] = ()
+        self._values_fields: Tuple[str, ...] = ()
+        self._select_related: Tuple[str, ...] = ()
+        self._prefetch: List[Tuple[Any, str, str, str]] = []
+        self._cache_ttl: Optional[float] = None
+        self._cache_stale_ttl: float = 0
+        self._max_lag: Optional[float] = None
+        self._using_db: bool = False
 
     def _clone(self):
         return self
@@ -324,17 +349,152 @@ class QuerySet:
         queryset._distinct = True
         return queryset
 
+    def select_related(self, *relations: str):
+        """
+        Fetch related objects of ``ForeignKeyField`` relations with JOIN in the same
+        query. Related objects with the same primary key are shared.
+
+        .. code-block:: python3
+
+            orders = await Order.filter(status="paid").select_related("user")
+            print(orders[0].user.name)
+        """
+        fk_fields = self.model_class._meta.fk_fields
+        for relation in relations:
+            if relation not in fk_fields:
+                raise FieldError(f"Unknown relation {relation} for model {self.model_class.__name__}")
+        queryset = self._clone()
+        queryset._select_related = tuple(dict.fromkeys(queryset._select_related + relations))
+        return queryset
+
+    def prefetch(self, child, on: str, to_attr: Optional[str] = None):
+        """
+        Fetch child objects of the result with one ``ANY($1)`` query per relation,
+        the child lists are assigned to attribute ``to_attr`` of each object.
+        Relations are fetched concurrently on separate connections.
+
+        .. code-block:: python3
+
+            authors = await Author.all().prefetch(Article, on="author_id")
+            print(authors[0].article_set)
+
+        ``child`` (Model or QuerySet):
+            Child model, or QuerySet of child model to filter and order children,
+            without limit or offset, which would apply to children of all objects.
+        ``on`` (str):
+            Field or ``ForeignKeyField`` relation of child refering to primary key.
+        ``to_attr`` (str):
+            Attribute name for child lists, default is ``{child table}_set``.
+        """
+        child_queryset = child if isinstance(child, QuerySet) else QuerySet(child)
+        if child_queryset._limit is not None or child_queryset._offset is not None:
+            raise ParamsError("prefetch() child QuerySet can't have limit or offset")
+        child_meta = child_queryset.model_class._meta
+        relation = ""
+        if on in child_meta.fk_fields:
+            relation = on
+            on = child_meta.fk_fields[on].model_field_name
+        if on not in child_meta.fields_map:
+            raise FieldError(f"Unknown field {on} for model {child_queryset.model_class.__name__}")
+        to_attr = to_attr or f"{child_meta.table}_set"
+        if to_attr in self.model_class._meta.fields_map or to_attr in self.model_class._meta.fk_fields:
+            raise FieldError(f"to_attr {to_attr} conflicts with field of model {self.model_class.__name__}")
+        queryset = self._clone()
+        queryset._prefetch = queryset._prefetch + [(child_queryset, on, to_attr, relation)]
+        return queryset
+
+    def values(self, *fields: str):
+        """
+        Return dicts of given fields instead of model instances.
+
+        A QuerySet restricted to one field can be used as subquery of ``__in`` and
+        ``__not_in`` filters, which is run by database in the same query:
+
+        .. code-block:: python3
+
+            Order.filter(user_id__in=User.filter(active=True).values("id"))
+        """
+        for field_name in fields:
+            if field_name not in self.model_class._meta.fields_map:
+                raise FieldError(f"Unknown field {field_name} for model {self.model_class.__name__}")
+        queryset = self._clone()
+        queryset._values_fields = fields or tuple(self.model_class._meta.fields_map.keys())
+        return queryset
+
+    def select_for_update(self, skip_locked=False, nowait=False, of=()):
+        """
+        Lock the selected rows with ``SELECT ... FOR UPDATE`` until the end of
+        the transaction, so it must be run inside ``in_transaction()``.
+
+        ``skip_locked`` (bool):
+            Skip rows locked by other transactions instead of waiting for them.
+        ``nowait`` (bool):
+            Raise ``OperationalError`` instead of waiting for locked rows.
+        ``of`` (tuple):
+            Models or table names whose rows should be locked.
+        """
+        if skip_locked and nowait:
+            raise ParamsError("select_for_update() can not use both skip_locked and nowait")
+        queryset = self._clone()
+        queryset._select_for_update = True
+        queryset._select_for_update_skip_locked = skip_locked
+        queryset._select_for_update_nowait = nowait
+        queryset._select_for_update_of = tuple(
+            table if isinstance(table, str) else table._meta.table for table in of
+        )
+        return queryset
+
+    def cached(self, ttl: float = 60, stale_ttl: float = 0):
+        """
+        Cache result rows of this query in process for ``ttl`` seconds, for tables
+        which are read often but rarely written. Cached rows are dropped when the
+        tables are written by this process, and not used inside transactions.
+
+        Concurrent misses run the query once, and rows are refreshed in
+        background shortly before they expire. Rows expired less than
+        ``stale_ttl`` seconds ago are returned while they are refreshed.
+
+        .. code-block:: python3
+
+            currencies = await Currency.filter(enabled=True).cached(ttl=300)
+        """
+        if ttl <= 0:
+            raise ParamsError("cached() requires positive ttl")
+        if stale_ttl < 0:
+            raise ParamsError("cached() requires non-negative stale_ttl")
+        queryset = self._clone()
+        queryset._cache_ttl = ttl
+        queryset._cache_stale_ttl = stale_ttl
+        return queryset
+
+    def match(self, objects):
+        """
+        Returns objects matching filters of this QuerySet, evaluated in Python
+        with the same semantics as the database, e.g. to filter instances
+        already loaded. Ordering, limit and offset are not applied.
+
+        .. code-block:: python3
+
+            cheap = Book.filter(price__lt=10).match(books)
+        """
+        from .evaluator import compile_predicate
+        return compile_predicate(self.model_class, *self._expressions).filter(objects)
+
+    def _chosen_db_name(self):
+        # None lets queries of this queryset be routed
+        return self.db_name if self._using_db else None
+
     def delete(self):
         return DeleteQuery(
             model_class=self.model_class,
-            db_name = self.db_name,
+            db_name = self._chosen_db_name(),
             expressions = self._expressions
         )
 
     def update(self, **kwargs):
         return UpdateQuery(
             model_class=self.model_class,
-            db_name = self.db_name,
+            db_name = self._chosen_db_name(),
             expressions = self._expressions,
             update_kwargs=kwargs
         )
@@ -342,10 +502,11 @@ class QuerySet:
     def count(self):
         return CountQuery(
             model_class=self.model_class,
-            db_name = self.db_name,
+            db_name = self._chosen_db_name(),
             expressions = self._expressions,
             limit=self._limit,
             offset=self._offset,
+            max_lag=self._max_lag,
         )
 
     def all(self):
@@ -395,16 +556,21 @@ class QuerySet:
             and query optimization.
             **The output format may (and will) vary greatly depending on the database backend.**
         """
-        mapper = self.model_class.get_mapper(self.db_name)
+        mapper = Postmodel.get_mapper(self.model_class, self.db_name, shard=self._using_db)
         return await mapper.explain(self)
 
-    def using_db(self, db_name):
+    def using_db(self, db_name, max_lag=None):
         """
         Executes query in provided db client.
         Useful for transactions workaround.
+
+        With ``max_lag``, reads of replicas more than ``max_lag`` seconds behind
+        their primary go to the primary.
         """
         queryset = self._clone()
         queryset.db_name = db_name
+        queryset._max_lag = max_lag
+        queryset._using_db = True
         return queryset
 
     def __await__(self):
@@ -414,59 +580,110 @@ class QuerySet:
         for val in await self:
             yield val
 
+    def route_shape(self):
+        return ('query', expressions_shape(self._expressions), self._values_fields,
+            self._select_related, self._select_for_update)
+
     async def _execute(self):
-        mapper = self.model_class.get_mapper(self.db_name)
+        db_name = self.db_name
+        if not self._using_db:
+            db_name = Postmodel.db_for_read(self.model_class, self)
+        if not self._select_for_update:
+            db_name = Postmodel.get_read_db_name(db_name, self._max_lag)
+        mapper = Postmodel.get_mapper(self.model_class, db_name, shard=self._using_db)
         return await mapper.query(self)
 
 
 class UpdateQuery:
-    __slots__ = ("model_class", "db_name", "expressions", "update_kwargs")
+    __slots__ = ("model_class", "db_name", "expressions", "update_kwargs", "returning_fields")
 
     def __init__(self, model_class, db_name, expressions, update_kwargs) -> None:
         self.model_class = model_class
         self.db_name = db_name
         self.update_kwargs = update_kwargs
         self.expressions = expressions
+        self.returning_fields = None
+
+    def returning(self, *fields):
+        """
+        Return the updated rows instead of rows count. Without fields the updated
+        model instances are returned, otherwise dicts of the given fields.
+
+        .. code-block:: python3
+
+            jobs = await Job.filter(status="new").update(status="running").returning()
+        """
+        for field_name in fields:
+            if field_name not in self.model_class._meta.fields_map:
+                raise FieldError(f"Unknown field {field_name} for model {self.model_class.__name__}")
+        self.returning_fields = fields
+        return self
 
     def __await__(self):
         return self._execute().__await__()
 
-    async def _execute(self) -> int:
-        mapper = self.model_class.get_mapper(self.db_name)
+    def route_shape(self):
+        return ('update', expressions_shape(self.expressions), tuple(self.update_kwargs))
+
+    async def _execute(self):
+        db_name = self.db_name or Postmodel.db_for_write(self.model_class, self)
+        mapper = Postmodel.get_mapper(self.model_class, db_name, shard=self.db_name is not None)
         return await mapper.query_update(self)
 
 
 class DeleteQuery:
-    __slots__ = ("model_class", "db_name", "expressions")
+    __slots__ = ("model_class", "db_name", "expressions", "returning_fields")
 
     def __init__(self, model_class, db_name, expressions) -> None:
         self.model_class = model_class
         self.db_name = db_name
         self.expressions = expressions
+        self.returning_fields = None
+
+    def returning(self, *fields):
+        """
+        Return the deleted rows instead of rows count. Without fields the deleted
+        model instances are returned, otherwise dicts of the given fields.
+        """
+        for field_name in fields:
+            if field_name not in self.model_class._meta.fields_map:
+                raise FieldError(f"Unknown field {field_name} for model {self.model_class.__name__}")
+        self.returning_fields = fields
+        return self
 
     def __await__(self):
         return self._execute().__await__()
 
-    async def _execute(self) -> int:
-        mapper = self.model_class.get_mapper(self.db_name)
+    def route_shape(self):
+        return ('delete', expressions_shape(self.expressions))
+
+    async def _execute(self):
+        db_name = self.db_name or Postmodel.db_for_write(self.model_class, self)
+        mapper = Postmodel.get_mapper(self.model_class, db_name, shard=self.db_name is not None)
         return await mapper.query_delete(self)
 
 
 class CountQuery:
-    __slots__ = ("model_class", "db_name", "expressions", "limit", "offset")
+    __slots__ = ("model_class", "db_name", "expressions", "limit", "offset", "max_lag")
 
-    def __init__(self, model_class, db_name, expressions, limit, offset) -> None:
+    def __init__(self, model_class, db_name, expressions, limit, offset, max_lag=None) -> None:
         self.model_class = model_class
         self.db_name = db_name
         self.expressions = expressions
         self.limit = limit
         self.offset = offset
+        self.max_lag = max_lag
 
 
     def __await__(self):
         return self._execute().__await__()
 
+    def route_shape(self):
+        return ('count', expressions_shape(self.expressions))
+
     async def _execute(self) -> int:
-        mapper = self.model_class.get_mapper(self.db_name)
+        db_name = self.db_name or Postmodel.db_for_read(self.model_class, self)
+        mapper = Postmodel.get_mapper(self.model_class, Postmodel.get_read_db_name(db_name, self.max_lag),
+            shard=self.db_name is not None)
         count = await mapper.query_count(self)
         return count
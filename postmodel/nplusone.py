@@ -0,0 +1,91 @@
+import os
+import sys
+import warnings
+from contextvars import ContextVar
+from postmodel.exceptions import NPlusOneError
+from postmodel.sqldb.hooks import fingerprint
+
+current_query_detector = ContextVar('current_query_detector', default=None)
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class NPlusOneWarning(UserWarning):
+    """
+    Warning of the same query run with different parameters too many times.
+    """
+
+
+def _call_site():
+    """
+    Returns file name and line of the innermost frame outside of postmodel.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not os.path.abspath(filename).startswith(_PACKAGE_DIR):
+            return filename, frame.f_lineno
+        frame = frame.f_back
+    return "<unknown>", 0  # pragma: nocoverage
+
+
+class QueryDetector:
+    """
+    Counts queries of mappers by fingerprint of their SQL and reports those
+    run with more than ``threshold`` different parameters, usually loads of
+    related rows one per item of a loop. Reports warn with ``NPlusOneWarning``,
+    or raise ``NPlusOneError`` with ``raise_error``, at the call site of the
+    query, once per fingerprint.
+    """
+
+    def __init__(self, threshold=5, raise_error=False):
+        self.threshold = threshold
+        self.raise_error = raise_error
+        self.queries = {}  # fingerprint -> parameters seen, up to threshold + 1
+        self.reports = []
+
+    def record(self, model_class, sql, values):
+        key = fingerprint(sql)
+        seen = self.queries.get(key)
+        if seen is None:
+            seen = self.queries[key] = set()
+        elif len(seen) > self.threshold:
+            return
+        seen.add(repr(values))
+        if len(seen) <= self.threshold:
+            return
+        filename, lineno = _call_site()
+        message = (f"{model_class.__name__} queried with {len(seen)} different parameters "
+            f"at {filename}:{lineno}, load them with one query: {key}")
+        self.reports.append((model_class.__name__, key, filename, lineno))
+        if self.raise_error:
+            raise NPlusOneError(message)
+        warnings.warn_explicit(message, NPlusOneWarning, filename, lineno)
+
+
+class QueryDetectorContext:
+    __slots__ = ("token", "detector")
+
+    def __init__(self, detector) -> None:
+        self.token = None
+        self.detector = detector
+
+    async def __aenter__(self):
+        self.token = current_query_detector.set(self.detector)
+        return self.detector
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        current_query_detector.reset(self.token)
+        self.token = None
+        return False
+
+
+def detect_nplusone(threshold=5, raise_error=False):
+    """
+    N+1 query detector context manager, for development and tests.
+
+    Inside ``async with detect_nplusone():`` statement, queries of the same
+    fingerprint run with more than ``threshold`` different parameters are
+    reported, see ``QueryDetector``. Use it around one web request.
+    """
+    return QueryDetectorContext(QueryDetector(threshold, raise_error))
@@ -0,0 +1,30 @@
+
+
+class DatabaseRouter:
+    """
+    Decides databases of models at run time, e.g. by tenant, archive or live
+    data, or to send reporting queries to another pool. Set for all models by
+    ``Postmodel.init(router=...)`` or for one model by ``Meta.router``.
+
+    Methods return name of database, or None for ``Meta.db_name``. Explicit
+    ``using_db()`` is never routed.
+
+    With ``cache_by_shape``, decisions are cached by model and shape of query,
+    its filters and options without their values, and by model for instances.
+    Routers which decide by filter or field values must not set it.
+    """
+
+    cache_by_shape = False
+
+    def db_for_read(self, model_class, queryset):
+        """
+        Database of ``QuerySet`` or ``CountQuery`` reads.
+        """
+        return None
+
+    def db_for_write(self, model_class, instance):
+        """
+        Database of model instance written, or of ``UpdateQuery`` and
+        ``DeleteQuery`` of querysets. ``instance`` is None for bulk creates.
+        """
+        return None
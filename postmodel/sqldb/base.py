@@ -1,9 +1,67 @@
 
 from typing import Any, List, Optional, Sequence, Tuple, Type, Union, Set
 import copy
+import time
 import asyncio
+from postmodel.cache.flight import SingleFlight
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # pragma: nocoverage
+    from aiocontextvars import ContextVar  # pragma: nocoverage
 
 current_transaction_map: dict = {}
+current_write_map: dict = {}
+current_identity_map = ContextVar("IdentityMap", default=None)
+
+
+class IdentityMap:
+    """
+    Map of loaded model instances by primary key, so the same row is always
+    represented by the same instance in one context.
+    """
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, model_class, pk):
+        return self.objects.get((model_class, pk))
+
+    def add(self, instance, refresh=False):
+        """
+        Add instance to map and return the instance which represents the row, it is
+        the previously loaded one if exists. With ``refresh`` the previous instance
+        takes the values of the new one.
+        """
+        key = (type(instance), instance.pk)
+        current = self.objects.get(key)
+        if current is None or current is instance:
+            self.objects[key] = instance
+            return instance
+        if refresh:
+            for field_name in instance._meta.fields_db_projection.keys():
+                if not instance._meta.in_primarykey(field_name):
+                    setattr(current, field_name, getattr(instance, field_name))
+            current.make_snapshot()
+        return current
+
+    def put(self, instance):
+        """
+        Make instance the one which represents its row, used after instance is written.
+        """
+        self.objects[(type(instance), instance.pk)] = instance
+
+    def remove(self, instance):
+        self.objects.pop((type(instance), instance.pk), None)
+
+    def clear(self, model_class=None):
+        if model_class is None:
+            self.objects.clear()
+            return
+        for key in [key for key in self.objects if key[0] is model_class]:
+            del self.objects[key]
+
+    def __len__(self):
+        return len(self.objects)
 
 class NestedTransaction:
     async def __aenter__(self):
@@ -16,6 +74,8 @@ class TransactedConnectionProxy:
     def __init__(self, connection):
         self.connection = connection
         self.lock = asyncio.Lock()
+        self.precommit_callbacks = []
+        self.commit_callbacks = []
     
     def __getattr__(self, attr):
         # Proxy all unresolved attributes to the wrapped Connection object.
@@ -53,10 +113,56 @@ class TransactedConnectionWrapper:
         self.lock.release()
 
 
+class DatabaseGroup:
+    """
+    Primary database and its read replicas. Reads outside transactions go to
+    replicas, in turn with ``round_robin`` policy or to the one with fewest
+    connections in use with ``least_loaded``, except in ``read_your_writes``
+    seconds after a write in the same context.
+
+    With ``max_lag``, replicas more than ``max_lag`` seconds behind primary are
+    skipped, and reads go to primary if all of them are.
+    """
+    POLICIES = ('round_robin', 'least_loaded')
+
+    def __init__(self, primary, replicas, policy='round_robin', read_your_writes=1.0, max_lag=None):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.policy = policy
+        self.read_your_writes = read_your_writes
+        self.max_lag = max_lag
+        self.turn = 0
+
+    def read_database(self, max_lag=None):
+        primary = self.primary
+        if not self.replicas or primary._current_transacted_conn():
+            return primary
+        written = current_write_map[primary.name].get()
+        if written and time.monotonic() - written < self.read_your_writes:
+            return primary
+        start = self.turn % len(self.replicas)
+        self.turn += 1
+        replicas = self.replicas[start:] + self.replicas[:start]
+        if max_lag is None:
+            max_lag = self.max_lag
+        if max_lag is not None:
+            replicas = [db for db in replicas if db.within_lag(max_lag)]
+            if not replicas:
+                return primary
+        if self.policy == 'least_loaded':
+            return min(replicas, key=lambda db: db.connections_in_use())
+        return replicas[0]
+
+
 class BaseDatabaseMapper(object):
     def __init__(self, model_class, db):
         self.model_class = model_class
         self.db = db
+        self.model_cache = None
+        self.query_cache = None
+        self.replica = None
+        self.negative_cache = None
+        self.loads = SingleFlight()
         self.init()
 
     def init(self):
@@ -106,6 +212,15 @@ class BaseDatabaseEngine(object):
         for k, v in self.parameters.items():
             if k in parameters:
                 self.parameters[k] = type(v)(parameters[k])
+        self.invalidation_bus = None
+        # replication lag of replicas, sampled every ``lag_interval`` seconds
+        self.replica_of = None
+        self.lag_interval = 1.0
+        self.lag = None
+        self.lag_bytes = None
+        self.lag_sampled_at = 0
+        self.lag_errors = 0
+        self.lag_skips = 0
 
 
     async def init(self):
@@ -123,5 +238,43 @@ class BaseDatabaseEngine(object):
     def acquire_connection(self):
         raise NotImplementedError()  # pragma: nocoverage
     
+    def connections_in_use(self):
+        raise NotImplementedError()  # pragma: nocoverage
+
+    def metrics_snapshot(self):
+        raise NotImplementedError()  # pragma: nocoverage
+
+    async def sample_lag(self, primary=None):
+        raise NotImplementedError()  # pragma: nocoverage
+
+    def within_lag(self, max_lag):
+        """
+        True if database is primary, or replica with lag sampled lately at most
+        ``max_lag`` seconds.
+        """
+        if self.replica_of is None:
+            return True
+        if self.lag is None or time.monotonic() - self.lag_sampled_at > 3 * self.lag_interval:
+            self.lag_skips += 1
+            return False
+        if self.lag > max_lag:
+            self.lag_skips += 1
+            return False
+        return True
+
+    def lag_stats(self):
+        sampled_at = self.lag_sampled_at
+        return {
+            "replica_of": self.replica_of,
+            "lag": self.lag,
+            "lag_bytes": self.lag_bytes,
+            "sample_age": time.monotonic() - sampled_at if sampled_at else None,
+            "errors": self.lag_errors,
+            "skips": self.lag_skips,
+        }
+
+    def mark_written(self):
+        raise NotImplementedError()  # pragma: nocoverage
+
     def get_mapper(self, model_class):
         return self.mapper_class(model_class, self)
\ No newline at end of file
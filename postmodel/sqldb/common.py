@@ -10,6 +10,10 @@ from pypika.utils import format_alias_sql
 from functools import partial
 from copy import deepcopy
 from postmodel.models.functions import Function
+from postmodel.models.expressions import F, CombinedExpression
+from postmodel.models.fields import ForeignKeyField
+from postmodel.exceptions import FieldError
+from postmodel.cache.replica import REPLICATE_CHANNEL
 import json
 
 def parameter(index: int) -> Parameter:
@@ -25,6 +29,8 @@ class BaseTableSchemaGenerator:
     PRIMARY_KEY_TEMPLATE = 'PRIMARY KEY ({primary_keys})'
     INDEX_CREATE_TEMPLATE = 'CREATE INDEX {exists}"{index_name}" ON "{table_name}" ({fields});'
     UNIQUE_CONSTRAINT_CREATE_TEMPLATE = 'CONSTRAINT "{index_name}" UNIQUE ({fields})'
+    FOREIGN_KEY_TEMPLATE = ('CONSTRAINT "{index_name}" FOREIGN KEY ("{field}") '
+        'REFERENCES "{related_table}" ("{related_field}") ON DELETE {on_delete}')
 
     FIELD_TYPE_MAP = {
         'IntField': 'INT',
@@ -44,6 +50,32 @@ class BaseTableSchemaGenerator:
         'UUIDField': 'UUID',
         'BinaryField': "BYTEA"
     }
+    REPLICATE_FUNCTION_TEMPLATE = (
+        'CREATE OR REPLACE FUNCTION "{function_name}"() RETURNS trigger AS $$\n'
+        'BEGIN\n'
+        '    IF TG_OP = \'TRUNCATE\' THEN\n'
+        '        PERFORM pg_notify(\'{channel}\', json_build_array(TG_TABLE_NAME, NULL)::text);\n'
+        '        RETURN NULL;\n'
+        '    END IF;\n'
+        '    IF TG_OP <> \'INSERT\' THEN\n'
+        '        PERFORM pg_notify(\'{channel}\', json_build_array(TG_TABLE_NAME, json_build_array({old_pk}))::text);\n'
+        '    END IF;\n'
+        '    IF TG_OP <> \'DELETE\' THEN\n'
+        '        PERFORM pg_notify(\'{channel}\', json_build_array(TG_TABLE_NAME, json_build_array({new_pk}))::text);\n'
+        '    END IF;\n'
+        '    RETURN NULL;\n'
+        'END;\n'
+        '$$ LANGUAGE plpgsql;'
+    )
+    REPLICATE_TRIGGER_TEMPLATE = (
+        'DROP TRIGGER IF EXISTS "{trigger_name}" ON "{table_name}";\n'
+        'CREATE TRIGGER "{trigger_name}" AFTER {events} ON "{table_name}" '
+        'FOR EACH {each} EXECUTE PROCEDURE "{function_name}"();'
+    )
+
+    RELATED_FIELD_TYPE_MAP = {
+        'AutoField': 'BIGINT'
+    }
     def __init__(self, meta_info) -> None:
         self.meta_info = meta_info
 
@@ -69,6 +101,17 @@ class BaseTableSchemaGenerator:
         return index_name
 
 
+    def _get_field_type(self, field):
+        if isinstance(field, ForeignKeyField):
+            field = field.related_field
+            field_type_name = type(field).__name__
+            field_type = self.RELATED_FIELD_TYPE_MAP.get(field_type_name) or self.FIELD_TYPE_MAP[field_type_name]
+        else:
+            field_type = self.FIELD_TYPE_MAP[type(field).__name__]
+        if callable(field_type):
+            field_type = field_type(field)
+        return field_type
+
     def get_create_schema_sql(self, safe=True) -> str:
         exists="IF NOT EXISTS " if safe else ""
         meta = self.meta_info
@@ -82,11 +125,11 @@ class BaseTableSchemaGenerator:
             nullable = "NOT NULL" if not field.null else ""
             unique = "UNIQUE" if field.unique else ""
             is_pk = field.pk or name == meta.primary_key
-            field_type = self.FIELD_TYPE_MAP[type(field).__name__]
-            if callable(field_type):
-                field_type = field_type(field)
+            field_type = self._get_field_type(field)
             if field.index and not field.pk:
                 fields_with_index.append(field)
+            elif isinstance(field, ForeignKeyField) and not field.unique:
+                fields_with_index.append(field)
             sql = self.FIELD_TEMPLATE.format(
                 name=db_field,
                 type=field_type,
@@ -102,6 +145,20 @@ class BaseTableSchemaGenerator:
             sql = self.PRIMARY_KEY_TEMPLATE.format(primary_keys=', '.join(db_pk_field))
             fields_sql.append(sql)
 
+        for field in meta.fk_fields.values():
+            related_meta = field.related_model._meta
+            if not field.db_constraint or related_meta.db_name != meta.db_name:
+                continue
+            db_field = meta.fields_db_projection[field.model_field_name]
+            sql = self.FOREIGN_KEY_TEMPLATE.format(
+                index_name=self._generate_index_name("fk", [db_field]),
+                field=db_field,
+                related_table=related_meta.table,
+                related_field=related_meta.db_pk_field,
+                on_delete=field.on_delete
+            )
+            fields_sql.append(sql)
+
         for unique_together_list in meta.unique_together:
             field_names = unique_together_list
             sql = self.UNIQUE_CONSTRAINT_CREATE_TEMPLATE.format(
@@ -139,24 +196,72 @@ class BaseTableSchemaGenerator:
             )
             schema_sql.append(sql)
 
+        if meta.replicate_in_memory:
+            schema_sql.extend(self.get_replicate_trigger_sql())
+
         return '\n'.join(schema_sql)
 
+    def get_replicate_trigger_sql(self) -> List[str]:
+        """
+        Trigger notifying primary keys of changed rows to in-memory replicas.
+        """
+        meta = self.meta_info
+        table_name = meta.table
+        db_pk_field = meta.db_pk_field
+        pk_names = (db_pk_field, ) if isinstance(db_pk_field, str) else db_pk_field
+        function_name = "postmodel_replicate_{}".format(table_name)
+        schema_sql = [self.REPLICATE_FUNCTION_TEMPLATE.format(
+            function_name=function_name,
+            channel=REPLICATE_CHANNEL,
+            old_pk=", ".join(f'OLD.{self.quote(name)}' for name in pk_names),
+            new_pk=", ".join(f'NEW.{self.quote(name)}' for name in pk_names),
+        )]
+        for prefix, events, each in (("rep", "INSERT OR UPDATE OR DELETE", "ROW"),
+                ("rept", "TRUNCATE", "STATEMENT")):
+            schema_sql.append(self.REPLICATE_TRIGGER_TEMPLATE.format(
+                trigger_name=self._generate_index_name(prefix, list(pk_names)),
+                table_name=table_name,
+                events=events,
+                each=each,
+                function_name=function_name,
+            ))
+        return schema_sql
+
 class PostgreInCriterion(Criterion):
     value_type_map = {
         int: "bigint",
         str: "text"
     }
-    def __init__(self, field_name, param, value_type):
-        self.field_name = field_name
+    def __init__(self, field, param, value_type):
+        self.field = field
         self.param = param
         self.value_type = self.value_type_map[value_type]
 
+    def get_field_sql(self, **kwargs):
+        return self.field.get_sql(quote_char='"', with_namespace=kwargs.get("with_namespace", False))
+
     def get_sql(self, **kwargs):
-        return f'"{self.field_name}" = ANY({self.param}::{self.value_type}[])'
+        return f'{self.get_field_sql(**kwargs)} = ANY({self.param}::{self.value_type}[])'
 
 class PostgreNotInCriterion(PostgreInCriterion):
     def get_sql(self, **kwargs):
-        return f'"{self.field_name}" <> ALL({self.param}::{self.value_type}[])'
+        return f'{self.get_field_sql(**kwargs)} <> ALL({self.param}::{self.value_type}[])'
+
+
+class SubqueryInCriterion(Criterion):
+    def __init__(self, field, subquery_sql, negated=False):
+        super().__init__()
+        self.field = field
+        self.subquery_sql = subquery_sql
+        self.negated = negated
+
+    def get_sql(self, **kwargs):
+        kwargs.setdefault("quote_char", '"')
+        return "{} {} ({})".format(
+            self.field.get_sql(**kwargs),
+            "NOT IN" if self.negated else "IN",
+            self.subquery_sql
+        )
 
 
 
@@ -452,12 +557,12 @@ class FieldFilterFunctions:
     @staticmethod
     def is_in(field, param=None, value=None, value_type=str, **kwargs):
         param_or_value = param or value
-        return PostgreInCriterion(field.name, param_or_value, value_type)
+        return PostgreInCriterion(field, param_or_value, value_type)
 
     @staticmethod
     def not_in(field, param=None, value=None, value_type=str, **kwargs):
         param_or_value = param or value
-        return PostgreNotInCriterion(field.name, param_or_value, value_type)
+        return PostgreNotInCriterion(field, param_or_value, value_type)
 
     @staticmethod
     def is_null(field, param=None, value=None, **kwargs):
@@ -546,6 +651,7 @@ class PikaTableFilters:
                     operator_func = partial(operator_func, value_type=value['field_type'])
                 new_value = deepcopy(value)
                 new_value['operator'] = operator_func
+                new_value['operator_name'] = operator
                 new_value['pika_field'] = pika_field
                 self.filters[key] = new_value
 
@@ -562,6 +668,12 @@ class PikaTableFilters:
         else:
             return JsonFieldFilter(self.table).get_criterion(key, param_index, value)
 
+    def get_subquery_criterion(self, key, subquery_sql):
+        ff = self.filters.get(key)
+        if not ff or ff['operator_name'] not in ('is_in', 'not_in'):
+            raise FieldError(f'subquery can only be used by __in or __not_in filter, not "{key}"')
+        return SubqueryInCriterion(ff['pika_field'], subquery_sql, ff['operator_name'] == 'not_in')
+
 
 
 class FunctionResolve:
@@ -601,3 +713,42 @@ class FunctionResolve:
             return fn, None
         else:
             return None, value
+
+
+
+class ExpressionResolve:
+    connectors_map = {
+        '+': operator.add,
+        '-': operator.sub,
+        '*': operator.mul,
+        '/': operator.truediv,
+        '%': operator.mod
+    }
+    def __init__(self, table, fields_db_projection):
+        self.table = table
+        self.fields_db_projection = fields_db_projection
+
+    def resolve(self, expr, param_index):
+        """
+        Resolve ``F`` expression to pypika term, literal values become parameters
+        numbered from ``param_index``. Returns the term and parameter values.
+        """
+        if isinstance(expr, F):
+            db_field = self.fields_db_projection.get(expr.name)
+            if not db_field:
+                raise FieldError(f'Unknown field {expr.name} in expression')
+            return self.table[db_field], []
+        elif isinstance(expr, CombinedExpression):
+            left, left_values = self.resolve(expr.left, param_index)
+            param_index += len(left_values)
+            right, right_values = self.resolve(expr.right, param_index)
+            term = self.connectors_map[expr.connector](left, right)
+            return term, left_values + right_values
+        elif isinstance(expr, Function):
+            return FunctionResolve(expr).resolve(self.table), []
+        else:
+            return parameter(param_index), [expr]
+
+    @classmethod
+    def is_expression(cls, value):
+        return isinstance(value, (F, CombinedExpression))
@@ -0,0 +1,91 @@
+
+import asyncio
+import time
+from collections import deque
+
+
+class HedgedReads:
+    """
+    Runs idempotent reads on one of several hosts, and if it does not answer in
+    ``percentile`` of recent read latencies, runs the read on the next host too.
+    The first answer wins and the other read is cancelled.
+
+    At most ``budget`` extra reads per read are hedged on average, in bursts of
+    at most ``burst`` reads. Reads are not hedged before ``min_samples``
+    latencies are known, or sooner than ``min_delay`` seconds.
+    """
+
+    def __init__(self, percentile=95, budget=0.05, min_delay=0.002, window=1000,
+            min_samples=20, burst=10):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.burst = burst
+        self.latencies = deque(maxlen=window)
+        self.delay = None
+        self.tokens = 0.0
+        self.turn = 0
+        self.reads = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self):
+        """
+        Returns seconds to wait before hedging, None if latencies are not known.
+        """
+        # sorting the window is amortized over reads
+        if self.delay is None or self.reads % 50 == 0:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+            index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+            self.delay = max(self.min_delay, latencies[index])
+        return self.delay
+
+    async def _timed(self, call):
+        started = time.monotonic()
+        result = await call()
+        self.latencies.append(time.monotonic() - started)
+        return result
+
+    async def run(self, calls):
+        """
+        Returns result of the first of ``calls``, coroutine functions reading
+        different hosts, which answers.
+        """
+        self.reads += 1
+        self.tokens = min(self.tokens + self.budget, self.burst)
+        start = self.turn % len(calls)
+        self.turn += 1
+        first = asyncio.ensure_future(self._timed(calls[start]))
+        tasks = {first}
+        try:
+            delay = self.hedge_delay() if len(calls) > 1 else None
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.hedged += 1
+                    tasks.add(asyncio.ensure_future(self._timed(calls[(start + 1) % len(calls)])))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "reads": self.reads,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "delay": self.delay,
+        }
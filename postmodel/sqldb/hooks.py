@@ -0,0 +1,87 @@
+
+import re
+from collections import OrderedDict
+from basepy.asynclog import logger
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\$\d+|\b\d+(?:\.\d+)?\b")
+_TUPLE = r"\(\s*\?(?:\s*,\s*\?)*\s*\)"
+_LIST = re.compile(rf"\b(IN|VALUES)\s*{_TUPLE}(?:\s*,\s*{_TUPLE})*", re.IGNORECASE)
+_SPACE = re.compile(r"\s+")
+
+MAX_FINGERPRINTS = 1000
+_fingerprints = OrderedDict()
+
+
+def fingerprint(sql):
+    """
+    Returns SQL with literals and parameters replaced by ``?``, and ``IN`` and
+    ``VALUES`` lists of them by ``(...)``, so statements of the same shape have
+    the same fingerprint.
+    """
+    found = _fingerprints.get(sql)
+    if found is not None:
+        _fingerprints.move_to_end(sql)
+        return found
+    found = _LIST.sub(r"\1 (...)", _LITERAL.sub("?", _SPACE.sub(" ", sql).strip()))
+    _fingerprints[sql] = found
+    if len(_fingerprints) > MAX_FINGERPRINTS:
+        _fingerprints.popitem(last=False)
+    return found
+
+
+class QueryEvent:
+    """
+    Statement run on database, passed to hooks before it runs and after.
+    ``duration``, ``rows`` and ``error`` are set after it runs.
+    """
+
+    __slots__ = ('db_name', 'sql', 'operation', 'params', 'in_transaction',
+        'duration', 'rows', 'error', '_fingerprint')
+
+    def __init__(self, db_name, sql, operation, params, in_transaction):
+        self.db_name = db_name
+        self.sql = sql
+        self.operation = operation
+        self.params = params
+        self.in_transaction = in_transaction
+        self.duration = None
+        self.rows = None
+        self.error = None
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self.sql)
+        return self._fingerprint
+
+
+class QueryHook:
+    """
+    Observes statements of a database, added by ``Postmodel.add_query_hook()``
+    or ``PostgresEngine.add_query_hook()``. Hooks run in the task of the query,
+    and errors of hooks are raised to it.
+    """
+
+    async def before_query(self, event):
+        pass
+
+    async def after_query(self, event):
+        pass
+
+
+class SlowQueryLog(QueryHook):
+    """
+    Logs statements running at least ``threshold`` seconds, added to databases
+    with ``slow_query`` parameter, e.g. ``?slow_query=0.5``.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    async def after_query(self, event):
+        if event.duration >= self.threshold:
+            await logger.warning('postmodel_slow_query', db=event.db_name,
+                fingerprint=event.fingerprint, duration=round(event.duration, 6),
+                rows=event.rows, params=event.params, in_transaction=event.in_transaction,
+                error=repr(event.error) if event.error else None)
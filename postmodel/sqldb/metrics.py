@@ -0,0 +1,145 @@
+
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """
+    Counts of observed values by upper bound of buckets, like prometheus
+    histograms.
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Returns estimate of quantile ``q`` of observed values, interpolated in
+        its bucket, or the last bound if it is above them.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]  # pragma: nocoverage
+
+    def snapshot(self):
+        """
+        Returns cumulative counts by upper bound, the last one is ``+Inf``.
+        """
+        cumulative = {}
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf", ), self.counts):
+            total += count
+            cumulative[bound] = total
+        return {"buckets": cumulative, "sum": self.sum, "count": self.count}
+
+
+class DatabaseMetrics:
+    """
+    Metrics of one database: seconds waited to acquire pool connections,
+    seconds statements ran by mapper operation, rows returned by operation,
+    and errors by exception class.
+    """
+
+    def __init__(self):
+        self.acquire_wait = Histogram()
+        self.operations = {}  # operation -> Histogram
+        self.rows = {}  # operation -> rows returned
+        self.errors = {}  # exception class name -> count
+
+    def observe(self, operation, seconds, rows=0):
+        histogram = self.operations.get(operation)
+        if histogram is None:
+            histogram = self.operations[operation] = Histogram()
+            self.rows[operation] = 0
+        histogram.observe(seconds)
+        self.rows[operation] += rows
+
+    def error(self, exc):
+        """
+        Count error and return it, e.g. ``raise metrics.error(IntegrityError(exc))``.
+        """
+        name = type(exc).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+        return exc
+
+    def snapshot(self):
+        return {
+            "acquire_wait": self.acquire_wait.snapshot(),
+            "operations": {name: h.snapshot() for name, h in self.operations.items()},
+            "rows": dict(self.rows),
+            "errors": dict(self.errors),
+        }
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def _histogram_lines(lines, name, snapshot, **labels):
+    for bound, count in snapshot["buckets"].items():
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {snapshot['sum']}")
+    lines.append(f"{name}_count{_labels(**labels)} {snapshot['count']}")
+
+
+def prometheus_text(snapshots):
+    """
+    Returns metrics snapshots of databases by name in prometheus text format.
+    """
+    families = [
+        ("postmodel_pool_size", "gauge", "Connections in pool."),
+        ("postmodel_pool_in_use", "gauge", "Connections acquired from pool."),
+        ("postmodel_pool_idle", "gauge", "Idle connections in pool."),
+        ("postmodel_pool_max_size", "gauge", "Max connections of pool."),
+    ]
+    lines = []
+    for name, kind, help_text in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        key = name[len("postmodel_pool_"):]
+        for db, snapshot in snapshots.items():
+            lines.append(f"{name}{_labels(db=db)} {snapshot['pool'][key]}")
+
+    lines.append("# HELP postmodel_acquire_wait_seconds Seconds waited to acquire connections.")
+    lines.append("# TYPE postmodel_acquire_wait_seconds histogram")
+    for db, snapshot in snapshots.items():
+        _histogram_lines(lines, "postmodel_acquire_wait_seconds", snapshot["acquire_wait"], db=db)
+
+    lines.append("# HELP postmodel_query_duration_seconds Seconds statements ran by operation.")
+    lines.append("# TYPE postmodel_query_duration_seconds histogram")
+    for db, snapshot in snapshots.items():
+        for operation, histogram in snapshot["operations"].items():
+            _histogram_lines(lines, "postmodel_query_duration_seconds", histogram,
+                db=db, operation=operation)
+
+    lines.append("# HELP postmodel_rows_total Rows returned by operation.")
+    lines.append("# TYPE postmodel_rows_total counter")
+    for db, snapshot in snapshots.items():
+        for operation, rows in snapshot["rows"].items():
+            lines.append(f"postmodel_rows_total{_labels(db=db, operation=operation)} {rows}")
+
+    lines.append("# HELP postmodel_errors_total Errors by exception.")
+    lines.append("# TYPE postmodel_errors_total counter")
+    for db, snapshot in snapshots.items():
+        for error, count in snapshot["errors"].items():
+            lines.append(f"postmodel_errors_total{_labels(db=db, error=error)} {count}")
+    return "\n".join(lines) + "\n"
@@ -1,31 +1,45 @@
 from typing import Any, Iterable, List, Optional, Sequence, Tuple, Type, Union
-from functools import wraps
+from functools import partial, wraps
 from .base import BaseDatabaseEngine, BaseDatabaseMapper
 from .base import (TransactedConnections,
         TransactedConnectionProxy,
-        TransactedConnectionWrapper)
+        TransactedConnectionWrapper,
+        current_identity_map,
+        current_write_map)
+import time
 import asyncio
+import inspect
+from basepy.asynclog import logger
+from .hedging import HedgedReads
+from .metrics import DatabaseMetrics
+from .hooks import QueryEvent, SlowQueryLog
+from .stages import QueryTiming, current_query_timing, start_query_timing, finish_query_timing
 import asyncpg
-from postmodel.exceptions import (OperationalError,
+from postmodel.exceptions import (BaseORMException,
+        OperationalError,
+        FieldError,
         DBConnectionError,
         IntegrityError,
         TransactionManagementError,
         MultipleObjectsReturned,
         DoesNotExist)
 from postmodel.main import Postmodel
-from postmodel.models.query import QueryExpression
+from postmodel.nplusone import current_query_detector
+from postmodel.models.query import QuerySet, QueryExpression, UpdateQuery
+from postmodel.models.evaluator import compile_predicate
 from .common import (
         get_json_field,
         BaseTableSchemaGenerator,
         PikaTableFilters,
-        FunctionResolve)
+        FunctionResolve,
+        ExpressionResolve)
 from pypika import Parameter
 from pypika import Criterion
 from pypika import Table, PostgreSQLQuery
 from pypika import functions as fn
 from pypika.terms import EmptyCriterion
 import operator
-from copy import deepcopy
+from copy import copy, deepcopy
 
 
 def translate_exceptions(func):
@@ -34,39 +48,82 @@ def translate_exceptions(func):
         try:
             return await func(self, *args)
         except asyncpg.SyntaxOrAccessError as exc: # pragma: nocoverage
-            raise OperationalError(exc)
+            raise self.metrics.error(OperationalError(exc))
         except asyncpg.IntegrityConstraintViolationError as exc:
-            raise IntegrityError(exc)
+            raise self.metrics.error(IntegrityError(exc))
         except asyncpg.InvalidTransactionStateError as exc:  # pragma: nocoverage
-            raise TransactionManagementError(exc)
+            raise self.metrics.error(TransactionManagementError(exc))
+        except asyncpg.LockNotAvailableError as exc:
+            raise self.metrics.error(OperationalError(exc))
+        except Exception as exc:
+            self.metrics.error(exc)
+            raise
 
     return translate_exceptions_
 
 
+class TimedAcquireContext:
+    """
+    Acquires connection of pool like ``pool.acquire()``, and observes seconds
+    waited for it.
+    """
+
+    __slots__ = ('pool', 'timeout', 'metrics', 'connection')
+
+    def __init__(self, pool, timeout, metrics):
+        self.pool = pool
+        self.timeout = timeout
+        self.metrics = metrics
+        self.connection = None
+
+    async def __aenter__(self):
+        started = time.monotonic()
+        self.connection = await self.pool._acquire(self.timeout)
+        self.metrics.acquire_wait.observe(time.monotonic() - started)
+        return self.connection
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        con = self.connection
+        self.connection = None
+        await self.pool.release(con)
+
+
 class PooledTransactionContext:
 
-    __slots__ = ('name', 'token', 'timeout', 'connection', 'transaction', 'done', 'pool')
+    __slots__ = ('name', 'token', 'timeout', 'connection', 'transaction', 'done', 'pool', 'conn_proxy',
+        'metrics')
 
-    def __init__(self, name, pool, timeout):
+    def __init__(self, name, pool, timeout, metrics):
         self.name = name
         self.pool = pool
         self.timeout = timeout
+        self.metrics = metrics
         self.connection = None
         self.done = False
         self.transaction = None
+        self.conn_proxy = None
 
     async def __aenter__(self):
         if self.connection is not None or self.done: # pragma: nocoverage
             raise Exception('a connection is already acquired')
+        started = time.monotonic()
         self.connection = await self.pool._acquire(self.timeout)
+        self.metrics.acquire_wait.observe(time.monotonic() - started)
         self.transaction = self.connection.transaction()
-        conn_proxy = TransactedConnectionProxy(self.connection)
+        conn_proxy = self.conn_proxy = TransactedConnectionProxy(self.connection)
         self.token = TransactedConnections.set(self.name, conn_proxy)
         await self.transaction.start()
         return conn_proxy
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if exc_type:
+        error = None
+        if not exc_type:
+            try:
+                for callback in self.conn_proxy.precommit_callbacks:
+                    await callback()
+            except Exception as e:
+                error = e
+        if exc_type or error:
             try:
                 await self.transaction.rollback()
             except: # pragma: nocoverage
@@ -78,6 +135,11 @@ class PooledTransactionContext:
         self.connection = None
         TransactedConnections.reset(self.name, self.token)
         await self.pool.release(con)
+        if error:
+            raise error
+        if not exc_type:
+            for callback in self.conn_proxy.commit_callbacks:
+                await callback()
 
 
 class PostgresMapper(BaseDatabaseMapper):
@@ -95,6 +157,7 @@ class PostgresMapper(BaseDatabaseMapper):
             columns.append(field)
 
         self.filters = PikaTableFilters(self.pika_table, self.meta.filters)
+        self.expression_resolve = ExpressionResolve(self.pika_table, self.meta.fields_db_projection)
 
         self.insert_all_sql = str(
             PostgreSQLQuery.into(self.pika_table)
@@ -145,6 +208,12 @@ class PostgresMapper(BaseDatabaseMapper):
                 values.extend(sub_values)
         else:
             for key, value in expr.filters.items():
+                if isinstance(value, QuerySet):
+                    sub_criterion, sub_values = self._get_subquery_criterion(key, value, param_index)
+                    criterion = self._join_criterion(criterion, sub_criterion, expr.join_type)
+                    param_index += len(sub_values)
+                    values.extend(sub_values)
+                    continue
                 fn, value = FunctionResolve.resolve_value(value, self.pika_table)
                 param = fn if fn else param_index
 
@@ -163,6 +232,24 @@ class PostgresMapper(BaseDatabaseMapper):
                 criterion = operator.invert(criterion)
         return criterion, values
 
+    def _get_subquery_criterion(self, key, queryset, param_index):
+        from postmodel.sqldb.sharding import ShardedMapper
+        sub_mapper = Postmodel.get_mapper(queryset.model_class, queryset.db_name, shard=queryset._using_db)
+        if isinstance(sub_mapper, ShardedMapper):
+            raise OperationalError(f"subquery of sharded model {queryset.model_class.__name__} "
+                "must choose one shard by using_db()")
+        if sub_mapper.db is not self.db:
+            raise OperationalError("subquery must be run in the same database")
+        fields = queryset._values_fields
+        if not fields and isinstance(sub_mapper.meta.primary_key, str):
+            fields = (sub_mapper.meta.primary_key, )
+        if len(fields) != 1:
+            raise OperationalError("subquery must select exactly one field by values()")
+        db_field = sub_mapper.meta.fields_db_projection[fields[0]]
+        sql, values = sub_mapper._get_query_sql(queryset, param_index, fields=[db_field])
+        criterion = self.filters.get_subquery_criterion(key, sql)
+        return criterion, values
+
     def _expressions_to_criterion(self, expressions, param_index, join_type="AND"):
         expr = QueryExpression(*expressions, join_type=join_type)
         return self._expression_to_criterion(expr, param_index)
@@ -171,17 +258,127 @@ class PostgresMapper(BaseDatabaseMapper):
     async def explain(self, queryset) -> Any:
         sql, values = self._get_query_sql(queryset)
         sql = " ".join((self.EXPLAIN_PREFIX, sql))
-        return (await self.db.execute_query(sql, values))[1]
+        return (await self.db.execute_query(sql, values, 'explain'))[1]
 
     async def create_table(self):
         sg = BaseTableSchemaGenerator(self.model_class._meta)
         await self.db.execute_script(sg.get_create_schema_sql())
+        if self.replica is not None:
+            await self.replica.load()
 
     async def clear_table(self):
         await self.db.execute_script(self.delete_table_sql)
 
     async def delete_table(self):
         await self.db.execute_script(self.drop_table_sql)
+        if self.replica is not None:
+            self.replica.reset()
+
+    def _track(self, instance, refresh=False):
+        identity_map = current_identity_map.get()
+        if identity_map is None:
+            return instance
+        return identity_map.add(instance, refresh=refresh)
+
+    def _track_written(self, *instances):
+        identity_map = current_identity_map.get()
+        if identity_map is not None:
+            for instance in instances:
+                identity_map.put(instance)
+
+    def _get_pk_lookup(self, queryset):
+        """
+        Returns primary key value if queryset only selects one row by primary key.
+        """
+        if (queryset._values_fields or queryset._select_related or queryset._prefetch
+                or queryset._select_for_update or queryset._offset or queryset._distinct):
+            return None
+        filters = {}
+        for expr in queryset._expressions:
+            if expr.children or expr._is_negated or (expr.join_type != "AND" and len(expr.filters) > 1):
+                return None
+            for key, value in expr.filters.items():
+                if key in filters:
+                    return None
+                filters[key] = value
+        primary_key = self.meta.primary_key
+        names = (primary_key, ) if isinstance(primary_key, str) else primary_key
+        if set(filters.keys()) != set(names):
+            return None
+        try:
+            values = tuple(self.meta.fields_map[name].to_python_value(filters[name]) for name in names)
+        except Exception:
+            return None
+        return values[0] if isinstance(primary_key, str) else values
+
+    def _get_row_pk(self, row):
+        db_pk_field = self.meta.db_pk_field
+        if isinstance(db_pk_field, str):
+            return row[db_pk_field]
+        return tuple(row[name] for name in db_pk_field)
+
+    def _with_cache_returning(self, returning):
+        if self.model_cache is None and self.db.invalidation_bus is None and self.replica is None:
+            return returning
+        db_pk_field = self.meta.db_pk_field
+        pk_names = (db_pk_field, ) if isinstance(db_pk_field, str) else db_pk_field
+        returning = list(returning or [])
+        return returning + [name for name in pk_names if name not in returning]
+
+    async def _cache_before_write(self, pk):
+        if self.model_cache is not None:
+            await self.model_cache.mark_dirty(pk)
+
+    async def _cache_after_write(self, pks, instance=None):
+        """
+        Invalidate cached rows and queries of table after commit, and write
+        instance through to cache.
+        """
+        table = self.meta.table
+        if self.db.invalidation_bus is not None:
+            await self.db.invalidation_bus.publish(table, pks)
+        model_cache = self.model_cache if pks else None
+        query_cache = self.query_cache
+        replica = self.replica
+        if model_cache is None and query_cache is None and replica is None:
+            return
+        item = model_cache.encode_item(instance) if model_cache and instance is not None else None
+
+        async def refresh():
+            if query_cache is not None:
+                query_cache.invalidate_table(table)
+            if replica is not None:
+                await replica.refresh(pks)
+            if model_cache is not None:
+                for pk in pks:
+                    write_version = await model_cache.mark_dirty(pk)
+                    if item is not None and write_version is not None:
+                        await model_cache.set_writethrough(pk, item, {}, write_version)
+
+        await self.db.after_commit(refresh)
+
+    async def _forget_missing(self, pks):
+        """
+        Drop inserted pks from negative cache now and again after commit, misses
+        of lookups running before commit are dropped too.
+        """
+        negative_cache = self.negative_cache
+        if negative_cache is None:
+            return
+        negative_cache.discard(pks)
+
+        async def forget():
+            negative_cache.discard(pks)
+
+        await self.db.after_commit(forget)
+
+    async def _cache_after_write_rows(self, rows, written):
+        if not written:
+            return
+        pks = []
+        if self.model_cache is not None or self.db.invalidation_bus is not None or self.replica is not None:
+            pks = [self._get_row_pk(row) for row in rows]
+        await self._cache_after_write(pks)
 
     async def insert(self, model_instance):
         values = [
@@ -189,6 +386,10 @@ class PostgresMapper(BaseDatabaseMapper):
             for column in self.columns
         ]
         await self.db.execute_insert(self.insert_all_sql, values)
+        self.db.mark_written()
+        self._track_written(model_instance)
+        await self._forget_missing([model_instance.pk])
+        await self._cache_after_write([model_instance.pk], model_instance)
 
     async def bulk_insert(self, instances):
         values_list = [
@@ -199,6 +400,11 @@ class PostgresMapper(BaseDatabaseMapper):
             for model_instance in instances
         ]
         await self.db.execute_many(self.insert_all_sql, values_list)
+        self.db.mark_written()
+        self._track_written(*instances)
+        await self._forget_missing([i.pk for i in instances])
+        # replica refreshes inserted rows at once, others learn them from notifications
+        await self._cache_after_write([] if self.replica is None else [i.pk for i in instances])
 
     def _get_update_cached(self, instance, update_fields, condition_fields={}):
         key = ",".join(update_fields) if update_fields else ""
@@ -269,16 +475,32 @@ class PostgresMapper(BaseDatabaseMapper):
 
     async def update(self, instance, update_fields, condition_fields=[]) -> int:
         sql, values = self._get_update_sql(instance, update_fields, condition_fields)
-        ret = await self.db.execute_query(sql, values)
+        await self._cache_before_write(instance.pk)
+        ret = await self.db.execute_query(sql, values, 'update')
+        self.db.mark_written()
+        if ret[0]:
+            self._track_written(instance)
+            # only a row guarded by data version is known to equal the instance
+            await self._cache_after_write([instance.pk], instance if condition_fields else None)
         return ret[0]
 
     async def delete(self, model_instance):
-
+        await self._cache_before_write(model_instance.pk)
         ret = await self.db.execute_query(
-            self.delete_sql, self._get_primary_key_values(model_instance)
+            self.delete_sql, self._get_primary_key_values(model_instance), 'delete'
         )
+        self.db.mark_written()
+        await self._cache_after_write([model_instance.pk])
+        identity_map = current_identity_map.get()
+        if identity_map is not None:
+            identity_map.remove(model_instance)
         return ret[0]
 
+    def _clear_tracked(self):
+        identity_map = current_identity_map.get()
+        if identity_map is not None:
+            identity_map.clear(self.model_class)
+
     def _get_primary_key_values(self, model_instance):
         pk_values = []
         pk_field = self.meta.pk
@@ -289,7 +511,22 @@ class PostgresMapper(BaseDatabaseMapper):
             pk_values.append(pk_field.to_db_value(model_instance.pk))
         return pk_values
 
-    def _get_query_update_sql(self, updatequery):
+    def _get_update_value(self, key, value, param_index):
+        field_object = self.meta.fields_map.get(key)
+        if not field_object:
+            raise FieldError(f"Unknown field {key} for model {self.model_class.__name__}")
+        if self.expression_resolve.is_expression(value):
+            return self.expression_resolve.resolve(value, param_index)
+        fn, value = FunctionResolve.resolve_value(value, self.pika_table)
+        if fn:
+            return fn, []
+        return self.parameter(param_index), [field_object.to_db_value(value)]
+
+    def _get_returning_sql(self, field_names):
+        db_fields = [self.meta.fields_db_projection[name] for name in field_names]
+        return " RETURNING {}".format(",".join(f'"{f}"' for f in db_fields))
+
+    def _get_query_update_sql(self, updatequery, returning=None):
         values = []
         table = self.pika_table
         query = PostgreSQLQuery.update(table)
@@ -303,18 +540,74 @@ class PostgresMapper(BaseDatabaseMapper):
         i += len(where_values)
 
         for key, value in updatequery.update_kwargs.items():
-            query = query.set(table[key], self.parameter(i))
-            values.append(value)
-            i += 1
+            db_field = self.meta.fields_db_projection.get(key, key)
+            term, term_values = self._get_update_value(key, value, i)
+            query = query.set(table[db_field], term)
+            values.extend(term_values)
+            i += len(term_values)
         sql = str(query.get_sql())
+        if returning:
+            sql += self._get_returning_sql(returning)
         return sql, values
 
+    def _get_returning_names(self, returning_fields):
+        if returning_fields is None:
+            return None
+        return list(returning_fields) or self.column_names
+
+    def _returning_result(self, returning_fields, rows, deleted=False):
+        if returning_fields:
+            projection = self.meta.fields_db_projection
+            fields_map = self.meta.fields_map
+            return [{name: fields_map[name].to_python_value(row[projection[name]])
+                for name in returning_fields} for row in rows]
+        instances = [self.model_class._init_from_db(**row) for row in rows]
+        if deleted:
+            for instance in instances:
+                instance._saved_in_db = False
+        return instances
+
     async def query_update(self, updatequery):
-        sql, values= self._get_query_update_sql(updatequery)
-        deleted, _ = await self.db.execute_query(sql, values)
-        return int(deleted)
+        returning = self._get_returning_names(updatequery.returning_fields)
+        sql, values= self._get_query_update_sql(updatequery, returning=self._with_cache_returning(returning))
+        updated, rows = await self.db.execute_query(sql, values, 'update')
+        self.db.mark_written()
+        self._clear_tracked()
+        await self._cache_after_write_rows(rows, updated)
+        if returning:
+            return self._returning_result(updatequery.returning_fields, rows)
+        return int(updated)
+
+    async def update_atomic(self, instance, update_kwargs):
+        """
+        Update fields of one row with values computed in database, the new values
+        are fetched back in the same statement.
+        """
+        pk_filters = {}
+        pk_names = self.meta.primary_key
+        pk_values = instance.pk
+        if isinstance(pk_names, str):
+            pk_names, pk_values = (pk_names, ), (pk_values, )
+        for name, value in zip(pk_names, pk_values):
+            pk_filters[name] = value
+        updatequery = UpdateQuery(
+            model_class=self.model_class,
+            db_name=self.db.name,
+            expressions=[QueryExpression(**pk_filters)],
+            update_kwargs=update_kwargs
+        )
+        sql, values = self._get_query_update_sql(updatequery, returning=list(update_kwargs.keys()))
+        await self._cache_before_write(instance.pk)
+        _, rows = await self.db.execute_query(sql, values, 'update')
+        self.db.mark_written()
+        if len(rows) == 0:
+            return None
+        self._track_written(instance)
+        await self._cache_after_write([instance.pk])
+        reverse = self.meta.fields_db_projection_reverse
+        return {reverse[key]: value for key, value in rows[0].items()}
 
-    def _get_query_delete_sql(self, deletequery):
+    def _get_query_delete_sql(self, deletequery, returning=None):
         values = []
         table = self.pika_table
         query = PostgreSQLQuery.from_(table)
@@ -329,11 +622,19 @@ class PostgresMapper(BaseDatabaseMapper):
 
         query = query.delete()
         sql = str(query.get_sql())
+        if returning:
+            sql += self._get_returning_sql(returning)
         return sql, values
 
     async def query_delete(self, deletequery):
-        sql, values= self._get_query_delete_sql(deletequery)
-        deleted, _ = await self.db.execute_query(sql, values)
+        returning = self._get_returning_names(deletequery.returning_fields)
+        sql, values= self._get_query_delete_sql(deletequery, returning=self._with_cache_returning(returning))
+        deleted, rows = await self.db.execute_query(sql, values, 'delete')
+        self.db.mark_written()
+        self._clear_tracked()
+        await self._cache_after_write_rows(rows, deleted)
+        if returning:
+            return self._returning_result(deletequery.returning_fields, rows, deleted=True)
         return int(deleted)
 
     def _get_query_count_sql(self, countquery):
@@ -354,14 +655,72 @@ class PostgresMapper(BaseDatabaseMapper):
 
     async def query_count(self, countquery):
         sql, values= self._get_query_count_sql(countquery)
-        _, rows = await self.db.execute_query(sql, values)
+        _, rows = await self.db.execute_read(sql, values, 'count')
         return int(rows[0]['count'])
 
-    def _get_query_sql(self, queryset):
+    def _get_select_related_query(self, queryset):
+        table = self.pika_table
+        query = PostgreSQLQuery.from_(table).select(*[table[name] for name in self.column_names])
+        for relation in queryset._select_related:
+            field = self.meta.fk_fields[relation]
+            related_meta = field.related_model._meta
+            related_table = Table(related_meta.table, alias=relation)
+            query = query.left_join(related_table).on(
+                table[self.meta.fields_db_projection[field.model_field_name]]
+                == related_table[related_meta.db_pk_field]
+            )
+            query = query.select(*[
+                related_table[name].as_(f"{relation}__{name}")
+                for name in related_meta.fields_db_projection.keys()
+            ])
+        return query
+
+    def _hydrate_related(self, queryset, rows):
+        shared = {}
+        instances = []
+        for row in rows:
+            instance = self._track(
+                self.model_class._init_from_db(**{name: row[name] for name in self.column_names}),
+                refresh=queryset._select_for_update
+            )
+            for relation in queryset._select_related:
+                related_model = self.meta.fk_fields[relation].related_model
+                related_meta = related_model._meta
+                prefix = f"{relation}__"
+                related_pk = row[prefix + related_meta.db_pk_field]
+                related = None
+                if related_pk is not None:
+                    key = (related_model, related_pk)
+                    related = shared.get(key)
+                    if related is None:
+                        related = self._track(related_model._init_from_db(**{
+                            name: row[prefix + name] for name in related_meta.fields_db_projection.keys()
+                        }))
+                        shared[key] = related
+                instance._related_objects[relation] = related
+            instances.append(instance)
+        return instances
+
+    def _get_lock_sql(self, queryset):
+        sql = " FOR UPDATE"
+        if queryset._select_for_update_of:
+            sql += " OF {}".format(",".join(f'"{t}"' for t in queryset._select_for_update_of))
+        if queryset._select_for_update_nowait:
+            sql += " NOWAIT"
+        elif queryset._select_for_update_skip_locked:
+            sql += " SKIP LOCKED"
+        return sql
+
+    def _get_query_sql(self, queryset, param_index=0, fields=None):
         values = []
         table = self.pika_table
-        query = PostgreSQLQuery.from_(table).select(*self.column_names)
-        i = 0
+        if not fields and queryset._values_fields:
+            fields = [self.meta.fields_db_projection[name] for name in queryset._values_fields]
+        if not fields and queryset._select_related:
+            query = self._get_select_related_query(queryset)
+        else:
+            query = PostgreSQLQuery.from_(table).select(*(fields or self.column_names))
+        i = param_index
 
         criterion, where_values = self._expressions_to_criterion(
             queryset._expressions, i
@@ -387,25 +746,268 @@ class PostgresMapper(BaseDatabaseMapper):
             query = query.offset(queryset._offset)
 
         sql = str(query.get_sql())
+        if queryset._select_for_update:
+            sql += self._get_lock_sql(queryset)
         return sql, values
 
-    async def query(self, queryset):
-        sql, values= self._get_query_sql(queryset)
+    def _get_claim_sql(self, queryset, lease):
+        db_pk_field = self.meta.db_pk_field
+        if isinstance(db_pk_field, str):
+            db_pk_field = (db_pk_field, )
+        sub_sql, values = self._get_query_sql(queryset, fields=db_pk_field)
+
+        table = self.pika_table
+        query = PostgreSQLQuery.update(table)
+        i = len(values)
+        for key, value in lease.items():
+            db_field = self.meta.fields_db_projection.get(key, key)
+            term, term_values = self._get_update_value(key, value, i)
+            query = query.set(table[db_field], term)
+            values.extend(term_values)
+            i += len(term_values)
+
+        pk_sql = ",".join(f'"{f}"' for f in db_pk_field)
+        if len(db_pk_field) > 1:
+            pk_sql = f"({pk_sql})"
+        sql = "{} WHERE {} IN ({}){}".format(
+            query.get_sql(), pk_sql, sub_sql, self._get_returning_sql(self.column_names)
+        )
+        return sql, values
 
-        # print('query', sql, values)
+    async def claim(self, queryset, lease):
+        """
+        Lock rows selected by queryset with ``SKIP LOCKED`` and update them with
+        lease values in one statement, returns the claimed instances.
+        """
+        sql, values = self._get_claim_sql(queryset, lease)
+        _, rows = await self.db.execute_query(sql, values, 'update')
+        self.db.mark_written()
+        await self._cache_after_write_rows(rows, len(rows))
+        return [self._track(self.model_class._init_from_db(**row), refresh=True) for row in rows]
 
-        _, rows = await self.db.execute_query(sql, values)
+    async def query(self, queryset):
+        stats = Postmodel._stage_stats
+        timing = start_query_timing(self.model_class.__name__, stats)
+        if timing is None:
+            return await self._query(queryset)
+        token = current_query_timing.set(timing)
+        try:
+            return await self._query(queryset)
+        finally:
+            current_query_timing.reset(token)
+            finish_query_timing(timing, stats)
+
+    async def _query(self, queryset):
+        if queryset._select_for_update and not self.db._current_transacted_conn():
+            raise TransactionManagementError("select_for_update() must be used inside in_transaction()")
+        identity_map = current_identity_map.get()
+        pk = None
+        if identity_map is not None or self.model_cache is not None or self.negative_cache is not None:
+            pk = self._get_pk_lookup(queryset)
+        single = queryset._return_single or queryset._expect_single
+        if identity_map is not None and pk is not None:
+            instance = identity_map.get(self.model_class, pk)
+            if instance is not None:
+                return instance if single else [instance]
+
+        if self.replica is not None and not self.db._current_transacted_conn():
+            rows = self._select_replica(queryset)
+            if rows is not None:
+                instances = await self._load_rows(queryset, rows)
+                if single:
+                    return instances[0] if instances else None
+                return instances
+
+        negative_cache = None
+        if pk is not None and self.negative_cache is not None and not self.db._current_transacted_conn():
+            negative_cache = self.negative_cache
+            if negative_cache.contains(pk):
+                instances = await self._load_rows(queryset, [])
+                return None if single else instances
+            negative_generation = negative_cache.generation
+
+        cached = None
+        if pk is not None and self.model_cache is not None and not self.db._current_transacted_conn():
+            # process local tier, then cache nodes
+            instance = self.model_cache.get_local(pk)
+            if instance is None:
+                local_generation = self.model_cache.local_generation()
+                cached, read_version, write_version = await self.model_cache.get_writethrough(pk)
+                if cached and read_version == write_version:
+                    instance = self.model_cache.load_instance(cached)
+                    if instance is not None:
+                        self.model_cache.set_local(pk, instance, local_generation)
+            if instance is not None:
+                instance = self._track(instance)
+                return instance if single else [instance]
+
+        timing = current_query_timing.get()
+        if timing is not None:
+            started = time.monotonic()
+        sql, values= self._get_query_sql(queryset)
+        if timing is not None:
+            timing.add('compile', time.monotonic() - started)
+            timing.sql = sql
+        detector = current_query_detector.get()
+        if detector is not None:
+            detector.record(self.model_class, sql, values)
+
+        shared = False
+        if cached is not None:
+            # concurrent misses of an item at the same write version share one
+            # query, and only the first one fills the cache
+            rows, shared = await self.loads.run(
+                (pk, write_version, sql), partial(self._fetch_query_rows, queryset, sql, values, False))
+        else:
+            rows = await self._fetch_query_rows(queryset, sql, values, negative_cache is None)
+        # rows of lagging replicas do not fill caches
+        filled = self.db.replica_of is None
+        if negative_cache is not None and not rows and filled:
+            negative_cache.add(pk, negative_generation)
+        instances = await self._load_rows(queryset, rows)
+        if cached is not None and instances and not shared and filled:
+            if await self.model_cache.set_writethrough(
+                    pk, self.model_cache.encode_item(instances[0]), cached, write_version):
+                self.model_cache.set_local(pk, instances[0], local_generation)
+        if single:
+            return instances[0] if instances else None
+        return instances
+
+    async def _load_rows(self, queryset, rows):
+        """
+        Returns instances of query result rows, only the first one if queryset
+        returns single instance.
+        """
         if queryset._expect_single:
             if len(rows) > 1:
                 raise MultipleObjectsReturned("Multiple objects returned, expected exactly one")
             elif len(rows) == 0:
                 raise DoesNotExist("Object does not exist")
         if queryset._return_single or queryset._expect_single:
-            if len(rows) == 0:
-                return None
-            return self.model_class._init_from_db(**rows[0])
+            rows = rows[:1]
+        timing = current_query_timing.get()
+        if timing is not None:
+            started = time.monotonic()
+        if queryset._select_related and not queryset._values_fields:
+            instances = self._hydrate_related(queryset, rows)
         else:
-            return [self.model_class._init_from_db(**row) for row in rows]
+            instances = [self._hydrate(queryset, row) for row in rows]
+        if timing is not None:
+            timing.add('decode' if queryset._values_fields else 'hydrate', time.monotonic() - started)
+        if queryset._prefetch and not queryset._values_fields:
+            await self._prefetch_children(instances, queryset._prefetch)
+        return instances
+
+    def _select_replica(self, queryset):
+        """
+        Returns rows of queryset selected from in-memory replica, or None if
+        it must be run by database.
+        """
+        if queryset._select_related or queryset._select_for_update or queryset._distinct:
+            return None
+        try:
+            predicate = compile_predicate(self.model_class, *queryset._expressions)
+        except BaseORMException:
+            return None
+        conditions = []
+        for expr in queryset._expressions:
+            if expr.children or expr._is_negated or (expr.join_type != "AND" and len(expr.filters) > 1):
+                continue
+            for key, value in expr.filters.items():
+                ff = self.filters.filters.get(key)
+                if ff is not None:
+                    conditions.append((ff['field'], ff['operator_name'], value))
+        rows = self.replica.select(predicate, conditions, queryset._orderings,
+            offset=queryset._offset, limit=queryset._limit)
+        if rows is not None and queryset._values_fields:
+            db_fields = [self.meta.fields_db_projection[name] for name in queryset._values_fields]
+            rows = [{name: row[name] for name in db_fields} for row in rows]
+        return rows
+
+    async def _fetch_query_rows(self, queryset, sql, values, hedged=True):
+        """
+        Fetch rows of query, hedged reads of replica hosts may be behind, so
+        rows filling model, negative and query caches are read from primary.
+        """
+        query_cache = self.query_cache
+        cache_key = None
+        if (queryset._cache_ttl and query_cache is not None and not queryset._select_for_update
+                and not self.db._current_transacted_conn()):
+            cache_key = query_cache.make_key(self.db.name, sql, values)
+        if cache_key is None:
+            execute = self.db.execute_read if hedged else self.db.execute_query
+            _, rows = await execute(sql, values)
+            return rows
+
+        async def load():
+            _, rows = await self.db.execute_query(sql, values)
+            return rows
+
+        return await query_cache.fetch(cache_key, self._get_queryset_tables(queryset),
+            queryset._cache_ttl, load, queryset._cache_stale_ttl)
+
+    def _get_queryset_tables(self, queryset):
+        tables = {queryset.model_class._meta.table}
+        for relation in queryset._select_related:
+            tables.add(queryset.model_class._meta.fk_fields[relation].related_model._meta.table)
+        expressions = list(queryset._expressions)
+        while expressions:
+            expression = expressions.pop()
+            expressions.extend(expression.children)
+            for value in expression.filters.values():
+                if isinstance(value, QuerySet):
+                    tables.update(self._get_queryset_tables(value))
+        return tuple(sorted(tables))
+
+    async def _prefetch_children(self, instances, prefetches):
+        if not isinstance(self.meta.primary_key, str):
+            raise OperationalError("prefetch() requires model with single primary key")
+        parents = {}
+        for instance in instances:
+            parents[instance.pk] = instance
+        keys = list(parents.keys())
+        results = await asyncio.gather(*[
+            self._fetch_children(child_queryset, on, keys)
+            for child_queryset, on, _, _ in prefetches
+        ])
+        for (_, on, to_attr, relation), children in zip(prefetches, results):
+            children_map = {key: [] for key in keys}
+            for child in children:
+                key = getattr(child, on)
+                children_map[key].append(child)
+                if relation:
+                    child._related_objects[relation] = parents[key]
+            for key, parent in parents.items():
+                setattr(parent, to_attr, children_map[key])
+
+    async def _fetch_children(self, child_queryset, on, keys):
+        if not keys:
+            return []
+        queryset = copy(child_queryset)
+        queryset._expressions = child_queryset._expressions + [QueryExpression(**{f"{on}__in": keys})]
+        return await queryset
+
+    def _hydrate(self, queryset, row):
+        if queryset._values_fields:
+            reverse = self.meta.fields_db_projection_reverse
+            fields_map = self.meta.fields_map
+            data = {}
+            for key, value in row.items():
+                field_name = reverse[key]
+                data[field_name] = fields_map[field_name].to_python_value(value)
+            return data
+        return self._track(self.model_class._init_from_db(**row), refresh=queryset._select_for_update)
+
+
+REPLICA_LAG_SQL = """SELECT
+    CASE WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag,
+    CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()::text END AS replay_lsn"""
+
+LSN_DIFF_SQL = "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), $1::pg_lsn) AS diff"
+
 
 class PostgresEngine(BaseDatabaseEngine):
     mapper_class = PostgresMapper
@@ -438,10 +1040,41 @@ class PostgresEngine(BaseDatabaseEngine):
             }
         self._pool = None
         self._db_url = f'postgresql://{self.user}:{self.password}@{self.host}:{self.port}/'
+        self._listener = None
+        self._listen_callbacks = {}
+        self._reconnect_task = None
+
+        # reads hedged across replica hosts, e.g. ?hedge_hosts=replica1:5432,replica2
+        self.hedge_hosts = []
+        for host in filter(None, parameters.get('hedge_hosts', '').split(',')):
+            hostname, _, port = host.strip().partition(':')
+            self.hedge_hosts.append((hostname, int(port or self.port)))
+        self.hedged_reads = None
+        if self.hedge_hosts:
+            self.hedged_reads = HedgedReads(
+                percentile=float(parameters.get('hedge_percentile', 95)),
+                budget=float(parameters.get('hedge_budget', 0.05)))
+        self._hedge_pools = []
+        # seconds after a write of the same context reads are not hedged
+        self.read_your_writes = 1.0
+        self.metrics = DatabaseMetrics()
+        self.query_hooks = []
+        if parameters.get('slow_query'):
+            self.add_query_hook(SlowQueryLog(float(parameters['slow_query'])))
 
     async def init(self, create_db=True):
         if not self._pool:
             await self._create_pool(create_db=create_db)
+            await self._create_hedge_pools()
+
+    async def _create_hedge_pools(self):
+        try:
+            for host, port in self.hedge_hosts:
+                self._hedge_pools.append(await asyncpg.create_pool(None, password=self.password,
+                    **dict(self._conn_params, host=host, port=port)))
+        except Exception as e:
+            await self._close_hedge_pools()
+            raise DBConnectionError(f"Can't establish connection to hedge hosts of {self.database}: {e}")
 
     async def _create_pool(self, create_db=True):
         if self._pool:
@@ -458,9 +1091,88 @@ class PostgresEngine(BaseDatabaseEngine):
             raise DBConnectionError(f"Can't establish connection to database {self.database}")
 
     async def close(self) -> None:
+        await self._close_listener()
         await self._close()
 
+    async def listen(self, channel, callback):
+        """
+        Listen to ``NOTIFY`` on channel with the dedicated listener connection of
+        database, ``callback(payload)`` may be a coroutine function. If listener
+        connection is lost it is reconnected, and callbacks are called with
+        ``None`` payload as messages may have been missed.
+        """
+        if self._listener is None:
+            await self._connect_listener()
+        if channel not in self._listen_callbacks:
+            self._listen_callbacks[channel] = []
+            await self._listener.add_listener(channel, self._on_notification)
+        self._listen_callbacks[channel].append(callback)
+
+    async def notify(self, channel, payload):
+        await self.execute_query("SELECT pg_notify($1, $2)", [channel, payload])
+
+    async def _connect_listener(self):
+        try:
+            self._listener = await asyncpg.connect(
+                host=self.host, port=self.port, user=self.user,
+                password=self.password, database=self.database
+            )
+        except Exception as e:
+            raise DBConnectionError(f"Can't establish listener connection to database {self.database}: {e}")
+        self._listener.add_termination_listener(self._on_listener_lost)
+
+    async def _on_notification(self, connection, pid, channel, payload):
+        for callback in self._listen_callbacks.get(channel, ()):
+            ret = callback(payload)
+            if inspect.isawaitable(ret):
+                await ret
+
+    def _on_listener_lost(self, connection):
+        if self._listener is connection:
+            self._listener = None
+            if self._reconnect_task is None or self._reconnect_task.done():
+                self._reconnect_task = asyncio.ensure_future(self._reconnect_listener())
+
+    async def _reconnect_listener(self, delay=1):
+        while self._listener is None and self._listen_callbacks:
+            try:
+                await self._connect_listener()
+                for channel in self._listen_callbacks:
+                    await self._listener.add_listener(channel, self._on_notification)
+            except Exception as e:
+                await logger.warning(f"reconnecting listener of {self.name} failed: {e!r}")
+                listener, self._listener = self._listener, None
+                if listener is not None:
+                    listener.terminate()
+                await asyncio.sleep(delay)
+                continue
+            for channel in list(self._listen_callbacks):
+                try:
+                    await self._on_notification(self._listener, None, channel, None)
+                except Exception as e:
+                    await logger.warning(f"listener callback of {channel} failed: {e!r}")
+
+    async def _close_listener(self):
+        listener = self._listener
+        self._listen_callbacks = {}
+        self._listener = None
+        task, self._reconnect_task = self._reconnect_task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.wait([task])
+        if listener is not None:
+            await listener.close()
+
+    async def _close_hedge_pools(self):
+        pools, self._hedge_pools = self._hedge_pools, []
+        for pool in pools:
+            try:
+                await asyncio.wait_for(pool.close(), 10)
+            except asyncio.TimeoutError:  # pragma: nocoverage
+                pool.terminate()
+
     async def _close(self) -> None:
+        await self._close_hedge_pools()
         if self._pool:  # pragma: nobranch
             try:
                 await asyncio.wait_for(self._pool.close(), 10)
@@ -492,7 +1204,7 @@ class PostgresEngine(BaseDatabaseEngine):
         if transacted_conn:
             raise Exception('nested in_transaction not allowed.')
         else:
-            return PooledTransactionContext(self.name, self._pool, timeout=None)
+            return PooledTransactionContext(self.name, self._pool, timeout=None, metrics=self.metrics)
 
     def _current_transacted_conn(self):
         try:
@@ -500,6 +1212,96 @@ class PostgresEngine(BaseDatabaseEngine):
         except: # pragma: nocoverage
             return None
 
+    async def before_commit(self, callback):
+        """
+        Run callback in current transaction right before commit, or run it now if
+        there is no transaction. The transaction rolls back if callback fails.
+        """
+        transacted_conn = self._current_transacted_conn()
+        if transacted_conn:
+            transacted_conn.precommit_callbacks.append(callback)
+        else:
+            await callback()
+
+    async def after_commit(self, callback):
+        """
+        Run callback after current transaction is committed, or run it now if
+        there is no transaction. Callback is dropped if transaction rolls back.
+        """
+        transacted_conn = self._current_transacted_conn()
+        if transacted_conn:
+            transacted_conn.commit_callbacks.append(callback)
+        else:
+            await callback()
+
+    def connections_in_use(self):
+        if not self._pool:
+            return 0
+        return self._pool.get_size() - self._pool.get_idle_size()
+
+    def add_query_hook(self, hook):
+        if hook not in self.query_hooks:
+            self.query_hooks.append(hook)
+
+    def remove_query_hook(self, hook):
+        if hook in self.query_hooks:
+            self.query_hooks.remove(hook)
+
+    def pool_stats(self):
+        if not self._pool:
+            return {"size": 0, "in_use": 0, "idle": 0, "max_size": 0}
+        size, idle = self._pool.get_size(), self._pool.get_idle_size()
+        return {"size": size, "in_use": size - idle, "idle": idle, "max_size": self._pool.get_max_size()}
+
+    def metrics_snapshot(self):
+        return {"pool": self.pool_stats(), **self.metrics.snapshot()}
+
+    async def sample_lag(self, primary=None):
+        """
+        Sample replication lag of replica, seconds since the last replayed
+        transaction unless all received WAL is replayed, and bytes of WAL behind
+        ``primary`` if it is given. Lag is unknown if sampling fails.
+        """
+        try:
+            row = (await self.execute_query_dict(REPLICA_LAG_SQL))[0]
+            lag_bytes = 0
+            if primary is not None and row["replay_lsn"] is not None:
+                rows = await primary.execute_query_dict(LSN_DIFF_SQL, [row["replay_lsn"]])
+                lag_bytes = int(rows[0]["diff"])
+        except Exception as e:
+            self.lag = self.lag_bytes = None
+            self.lag_errors += 1
+            await logger.warning(f"sampling replication lag of {self.name} failed: {e!r}")
+            return None
+        self.lag = float(row["lag"])
+        self.lag_bytes = lag_bytes
+        self.lag_sampled_at = time.monotonic()
+        return self.lag
+
+    def mark_written(self):
+        """
+        Start read-your-writes window of current context, reads of database
+        group go to primary in the window. In transaction it starts again
+        after commit.
+        """
+        last_write = current_write_map.get(self.name)
+        if last_write is None:
+            return
+        last_write.set(time.monotonic())
+        transacted_conn = self._current_transacted_conn()
+        if transacted_conn and self._mark_committed not in transacted_conn.commit_callbacks:
+            transacted_conn.commit_callbacks.append(self._mark_committed)
+
+    async def _mark_committed(self):
+        self.mark_written()
+
+    def _written_recently(self):
+        last_write = current_write_map.get(self.name)
+        if last_write is None:
+            return False
+        written = last_write.get()
+        return bool(written) and time.monotonic() - written < self.read_your_writes
+
     def acquire_connection(self, timeout=None):
         if not self._pool:
             raise Exception('Database init() not called.')
@@ -507,43 +1309,94 @@ class PostgresEngine(BaseDatabaseEngine):
         if transacted_conn:
             return TransactedConnectionWrapper(transacted_conn)
         else:
-            return self._pool.acquire(timeout=timeout)
+            return TimedAcquireContext(self._pool, timeout, self.metrics)
 
-    @translate_exceptions
-    async def execute_insert(self, query: str, values: list) -> int:
-        async with self.acquire_connection() as connection:
-            ret = await connection.execute(query, *values)
+    async def _execute(self, acquire, operation, query, params, run):
+        """
+        Runs ``run(connection)``, which returns count of rows and result, on
+        connection of ``acquire``, times it and passes it to query hooks.
+        """
+        timing = current_query_timing.get()
+        if timing is not None:
+            acquire_started = time.monotonic()
+        async with acquire as connection:
+            if timing is not None:
+                timing.add('acquire', time.monotonic() - acquire_started)
+            event = None
+            if self.query_hooks:
+                event = QueryEvent(self.name, query, operation, params,
+                    self._current_transacted_conn() is not None)
+                for hook in self.query_hooks:
+                    await hook.before_query(event)
+            started = time.monotonic()
             try:
-                rows_affected = int(ret.split(" ")[-1])
-            except Exception:  # pragma: nocoverage
-                rows_affected = 0
-            return rows_affected
+                rows, result = await run(connection)
+            except Exception as exc:
+                if event is not None:
+                    await self._after_query(event, time.monotonic() - started, None, exc)
+                raise
+            duration = time.monotonic() - started
+            self.metrics.observe(operation, duration, rows)
+            if timing is not None:
+                timing.add('execute', duration)
+            if event is not None:
+                await self._after_query(event, duration, rows, None)
+            return result
+
+    async def _after_query(self, event, duration, rows, error):
+        event.duration = duration
+        event.rows = rows
+        event.error = error
+        for hook in self.query_hooks:
+            await hook.after_query(event)
 
     @translate_exceptions
-    async def execute_many(self, query: str, values: list) -> None:
-        async with self.acquire_connection() as connection:
-            async with connection.transaction():
-                await connection.executemany(query, values)
+    async def execute_insert(self, query: str, values: list, operation='insert') -> int:
+        return await self._execute(self.acquire_connection(), operation, query, len(values),
+            partial(_run_insert, query, values))
+
+    @translate_exceptions
+    async def execute_many(self, query: str, values: list, operation='bulk') -> None:
+        params = len(values) * len(values[0]) if values else 0
+        return await self._execute(self.acquire_connection(), operation, query, params,
+            partial(_run_many, query, values))
 
     @translate_exceptions
     async def execute_query(
-        self, query: str, values: Optional[list] = None
+        self, query: str, values: Optional[list] = None, operation='query'
     ) -> Tuple[int, List[dict]]:
-        async with self.acquire_connection() as connection:
-            if values:
-                params = [query, *values]
-            else:
-                params = [query]
-            if query.startswith("UPDATE") or query.startswith("DELETE"):
-                ret = await connection.execute(*params)
-                try:
-                    rows_affected = int(ret.split(" ")[1])
-                except Exception:  # pragma: nocoverage
-                    rows_affected = 0
-                return rows_affected, []
-            else:
-                rows = await connection.fetch(*params)
-                return len(rows), rows
+        return await self._execute(self.acquire_connection(), operation, query, len(values or ()),
+            partial(_run_query, query, values))
+
+    async def execute_read(self, query: str, values: Optional[list] = None,
+            operation='query') -> Tuple[int, List[dict]]:
+        """
+        Executes idempotent read, hedged across primary and ``hedge_hosts``
+        if the database has them, except in transactions and in
+        ``read_your_writes`` seconds after a write of the same context.
+        """
+        if self.hedged_reads is None or self._current_transacted_conn() or self._written_recently():
+            return await self.execute_query(query, values, operation)
+        calls = [partial(self._fetch_on, pool, query, values or [], operation)
+            for pool in [self._pool] + self._hedge_pools]
+        result, hedge_timing = await self.hedged_reads.run(calls)
+        if hedge_timing is not None:
+            timing = current_query_timing.get()
+            for stage, seconds in hedge_timing.stages.items():
+                timing.add(stage, seconds)
+        return result
+
+    @translate_exceptions
+    async def _fetch_on(self, pool, query, values, operation):
+        # reads run in tasks of their own, stages are timed apart and only
+        # those of the read which answers are added to timing of the query
+        timing = current_query_timing.get()
+        if timing is not None:
+            timing = QueryTiming(timing.model)
+            current_query_timing.set(timing)
+        result = await self._execute(TimedAcquireContext(pool, None, self.metrics), operation, query,
+            len(values), partial(_run_query, query, values))
+        return result, timing
 
     @translate_exceptions
     async def execute_query_dict(self, query: str, values: Optional[list] = None) -> List[dict]:
@@ -553,6 +1406,41 @@ class PostgresEngine(BaseDatabaseEngine):
             return list(map(dict, await connection.fetch(query)))
 
     @translate_exceptions
-    async def execute_script(self, query: str) -> str:
-        async with self.acquire_connection() as connection:
-            return await connection.execute(query)
\ No newline at end of file
+    async def execute_script(self, query: str, operation='script') -> str:
+        return await self._execute(self.acquire_connection(), operation, query, 0,
+            partial(_run_script, query))
+
+
+async def _run_insert(query, values, connection):
+    ret = await connection.execute(query, *values)
+    try:
+        rows_affected = int(ret.split(" ")[-1])
+    except Exception:  # pragma: nocoverage
+        rows_affected = 0
+    return rows_affected, rows_affected
+
+
+async def _run_many(query, values, connection):
+    async with connection.transaction():
+        await connection.executemany(query, values)
+    return len(values), None
+
+
+async def _run_query(query, values, connection):
+    if values:
+        params = [query, *values]
+    else:
+        params = [query]
+    if (query.startswith("UPDATE") or query.startswith("DELETE")) and " RETURNING " not in query:
+        ret = await connection.execute(*params)
+        try:
+            rows_affected = int(ret.split(" ")[1])
+        except Exception:  # pragma: nocoverage
+            rows_affected = 0
+        return rows_affected, (rows_affected, [])
+    rows = await connection.fetch(*params)
+    return len(rows), (len(rows), rows)
+
+
+async def _run_script(query, connection):
+    return 0, await connection.execute(query)
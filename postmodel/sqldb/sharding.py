@@ -0,0 +1,189 @@
+
+import asyncio
+import zlib
+from copy import copy
+from postmodel.main import Postmodel
+from postmodel.exceptions import OperationalError, MultipleObjectsReturned, DoesNotExist
+from postmodel.models.query import Order
+from postmodel.models.evaluator import _sort_key
+
+
+class ShardedMapper:
+    """
+    Mapper of models with ``Meta.shard_key``, rows are placed in databases of
+    ``Meta.shards`` by hash of their shard key value.
+
+    Operations on instances and queries filtering shard key by ``=`` or
+    ``__in`` run on mappers of the shards they select. Other queries run on
+    all shards concurrently, and their results are merged by ordering of the
+    query before offset and limit are applied. Strings are merged in code point
+    order, as databases with C collation sort them.
+
+    Shard key of a row must not be changed, as the row is not moved.
+    """
+
+    def __init__(self, model_class, shards):
+        self.model_class = model_class
+        self.meta = model_class._meta
+        self.shards = list(shards)
+        self.shard_key = self.meta.shard_key
+        self.shard_field = self.meta.fields_map[self.shard_key]
+        self.model_cache = None
+        self.query_cache = None
+        self.negative_cache = None
+        self.replica = None
+
+    def shard_of(self, value):
+        """
+        Returns name of database of rows with shard key ``value``.
+        """
+        field = self.shard_field
+        value = field.to_db_value(field.to_python_value(value))
+        return self.shards[zlib.crc32(str(value).encode('utf-8')) % len(self.shards)]
+
+    def get_shard_mapper(self, db_name):
+        return Postmodel.get_mapper(self.model_class, db_name, shard=True)
+
+    def _read_mapper(self, db_name, max_lag=None):
+        return Postmodel.get_mapper(self.model_class, Postmodel.get_read_db_name(db_name, max_lag),
+            shard=True)
+
+    def _instance_mapper(self, instance):
+        value = getattr(instance, self.shard_key)
+        if value is None:
+            raise OperationalError(f"shard key {self.shard_key} of {self.model_class.__name__} is None")
+        return self.get_shard_mapper(self.shard_of(value))
+
+    def _query_shards(self, expressions):
+        """
+        Returns names of shards which may have rows matching expressions.
+        """
+        shards = None
+        for expr in expressions:
+            if expr.children or expr._is_negated or (expr.join_type != "AND" and len(expr.filters) > 1):
+                continue
+            for key, value in expr.filters.items():
+                if key == self.shard_key:
+                    values = [value]
+                elif key == f"{self.shard_key}__in" and isinstance(value, (list, tuple, set)):
+                    values = value
+                else:
+                    continue
+                try:
+                    names = {self.shard_of(v) for v in values}
+                except Exception:
+                    # invalid value is reported by the query
+                    continue
+                shards = names if shards is None else shards & names
+        if shards is None:
+            return list(self.shards)
+        return [name for name in self.shards if name in shards]
+
+    async def create_table(self):
+        for name in self.shards:
+            await self.get_shard_mapper(name).create_table()
+
+    async def clear_table(self):
+        for name in self.shards:
+            await self.get_shard_mapper(name).clear_table()
+
+    async def delete_table(self):
+        for name in self.shards:
+            await self.get_shard_mapper(name).delete_table()
+
+    async def explain(self, queryset):
+        shards = self._query_shards(queryset._expressions) or self.shards
+        return await self.get_shard_mapper(shards[0]).explain(queryset)
+
+    async def insert(self, model_instance):
+        return await self._instance_mapper(model_instance).insert(model_instance)
+
+    async def bulk_insert(self, instances):
+        by_shard = {}
+        for instance in instances:
+            by_shard.setdefault(self._instance_mapper(instance), []).append(instance)
+        await asyncio.gather(*(mapper.bulk_insert(items) for mapper, items in by_shard.items()))
+
+    async def update(self, instance, update_fields, condition_fields=[]):
+        return await self._instance_mapper(instance).update(instance, update_fields, condition_fields)
+
+    async def update_atomic(self, instance, update_kwargs):
+        return await self._instance_mapper(instance).update_atomic(instance, update_kwargs)
+
+    async def delete(self, model_instance):
+        return await self._instance_mapper(model_instance).delete(model_instance)
+
+    async def claim(self, queryset, lease):
+        shards = self._query_shards(queryset._expressions)
+        if len(shards) != 1:
+            raise OperationalError("claim() of sharded model requires filter of one shard key")
+        return await self.get_shard_mapper(shards[0]).claim(queryset, lease)
+
+    async def _write_all(self, query, method):
+        shards = self._query_shards(query.expressions)
+        results = await asyncio.gather(
+            *(getattr(self.get_shard_mapper(name), method)(query) for name in shards))
+        if query.returning_fields:
+            return [row for result in results for row in result]
+        return sum(results)
+
+    async def query_update(self, updatequery):
+        return await self._write_all(updatequery, 'query_update')
+
+    async def query_delete(self, deletequery):
+        return await self._write_all(deletequery, 'query_delete')
+
+    async def query_count(self, countquery):
+        shards = self._query_shards(countquery.expressions)
+        counts = await asyncio.gather(
+            *(self._read_mapper(name, countquery.max_lag).query_count(countquery) for name in shards))
+        return sum(counts)
+
+    async def query(self, queryset):
+        shards = self._query_shards(queryset._expressions)
+        if queryset._select_for_update:
+            if len(shards) != 1:
+                raise OperationalError("select_for_update() of sharded model requires filter of one shard key")
+            return await self.get_shard_mapper(shards[0]).query(queryset)
+        if len(shards) == 1:
+            return await self._read_mapper(shards[0], queryset._max_lag).query(queryset)
+
+        # every shard returns rows up to the limit, they are merged and sliced here
+        limit, offset = queryset._limit, queryset._offset or 0
+        part = copy(queryset)
+        part._return_single = part._expect_single = False
+        part._offset = None
+        if limit is not None:
+            part._limit = limit + offset
+        results = await asyncio.gather(
+            *(self._read_mapper(name, queryset._max_lag).query(part) for name in shards))
+        rows = [row for result in results for row in result]
+        if queryset._distinct and queryset._values_fields:
+            rows = list({tuple(row.items()): row for row in rows}.values())
+        for name, order in reversed(queryset._orderings):
+            rows.sort(key=lambda row: self._ordering_key(row, name), reverse=order == Order.desc)
+        rows = rows[offset:]
+        if limit is not None:
+            rows = rows[:limit]
+
+        if queryset._expect_single:
+            if len(rows) > 1:
+                raise MultipleObjectsReturned("Multiple objects returned, expected exactly one")
+            elif len(rows) == 0:
+                raise DoesNotExist("Object does not exist")
+        if queryset._return_single or queryset._expect_single:
+            return rows[0] if rows else None
+        return rows
+
+    def _ordering_key(self, row, name):
+        try:
+            if isinstance(row, dict):
+                value = row[name]
+            else:
+                value = row
+                for attr in name.split("."):
+                    value = getattr(value, attr)
+        except (KeyError, AttributeError):
+            raise OperationalError(f"can not order rows of shards by {name}")
+        # postgres puts nulls last in ascending order and first in descending
+        return (value is None, _sort_key(value) if value is not None else (0, 0))
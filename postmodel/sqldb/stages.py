@@ -0,0 +1,139 @@
+
+from collections import OrderedDict
+from contextvars import ContextVar
+from .hooks import fingerprint
+
+STAGES = ('compile', 'acquire', 'execute', 'decode', 'hydrate')
+
+# timing of query run by mapper in this context, and stages of queries of the request
+current_query_timing = ContextVar('current_query_timing', default=None)
+current_query_stages = ContextVar('current_query_stages', default=None)
+
+
+class QueryTiming:
+    """
+    Seconds spent in stages of one query: ``compile`` of SQL, ``acquire`` of
+    connection, ``execute`` on server including transfer and decoding of
+    records by the driver, ``decode`` of records to values of ``values()``
+    queries, and ``hydrate`` of records to model instances.
+    """
+
+    __slots__ = ('model', 'sql', 'stages')
+
+    def __init__(self, model):
+        self.model = model
+        self.sql = None
+        self.stages = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, stage, seconds):
+        self.stages[stage] += seconds
+
+
+class StageTotals:
+    """
+    Seconds by stage summed over queries.
+    """
+
+    __slots__ = ('queries', 'stages')
+
+    def __init__(self):
+        self.queries = 0
+        self.stages = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, timing):
+        self.queries += 1
+        for stage, seconds in timing.stages.items():
+            self.stages[stage] += seconds
+
+    def total(self):
+        return sum(self.stages.values())
+
+    def as_dict(self):
+        return {"queries": self.queries, "total": self.total(), **self.stages}
+
+
+class StageStats:
+    """
+    Stage totals of queries by model and by fingerprint of their SQL, of at
+    most ``max_fingerprints`` recently run fingerprints.
+    """
+
+    def __init__(self, max_fingerprints=1000):
+        self.max_fingerprints = max_fingerprints
+        self.models = {}
+        self.fingerprints = OrderedDict()
+
+    def add(self, timing):
+        totals = self.models.get(timing.model)
+        if totals is None:
+            totals = self.models[timing.model] = StageTotals()
+        totals.add(timing)
+        key = fingerprint(timing.sql)
+        totals = self.fingerprints.get(key)
+        if totals is None:
+            totals = self.fingerprints[key] = StageTotals()
+            if len(self.fingerprints) > self.max_fingerprints:
+                self.fingerprints.popitem(last=False)
+        else:
+            self.fingerprints.move_to_end(key)
+        totals.add(timing)
+
+    def clear(self):
+        self.models.clear()
+        self.fingerprints.clear()
+
+    def stats(self):
+        return {
+            "models": {name: totals.as_dict() for name, totals in self.models.items()},
+            "fingerprints": {key: totals.as_dict() for key, totals in self.fingerprints.items()},
+        }
+
+
+def start_query_timing(model, stats):
+    """
+    Returns timing of query of ``model`` if stages are aggregated by ``stats``
+    or collected for the current request, None otherwise.
+    """
+    if stats is None and current_query_stages.get() is None:
+        return None
+    return QueryTiming(model)
+
+
+def finish_query_timing(timing, stats):
+    if timing.sql is None:
+        # answered by caches
+        return
+    if stats is not None:
+        stats.add(timing)
+    totals = current_query_stages.get()
+    if totals is not None:
+        totals.add(timing)
+
+
+class QueryStagesContext:
+    __slots__ = ("token", "totals")
+
+    def __init__(self) -> None:
+        self.token = None
+        self.totals = None
+
+    async def __aenter__(self):
+        self.totals = StageTotals()
+        self.token = current_query_stages.set(self.totals)
+        return self.totals
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        current_query_stages.reset(self.token)
+        self.token = None
+        return False
+
+
+def query_stages():
+    """
+    Query stages context manager.
+
+    Inside ``async with query_stages() as totals:`` statement, seconds spent
+    in stages of queries are summed in ``totals``, also readable from
+    ``current_query_stages`` context variable, e.g. to log slow requests.
+    """
+    return QueryStagesContext()
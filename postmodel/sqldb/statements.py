@@ -0,0 +1,135 @@
+
+import asyncio
+import json
+import os
+import re
+import time
+from basepy.asynclog import logger
+from .hooks import QueryHook
+from .metrics import Histogram
+
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"([^"]+)"', re.IGNORECASE)
+
+ORDERINGS = ('total_time', 'calls', 'mean_time', 'p99', 'rows_per_call')
+
+
+class StatementEntry:
+    __slots__ = ('db_name', 'fingerprint', 'table', 'calls', 'errors', 'rows', 'total_time',
+        'max_time', 'histogram')
+
+    def __init__(self, db_name, fingerprint):
+        self.db_name = db_name
+        self.fingerprint = fingerprint
+        match = _TABLE.search(fingerprint)
+        self.table = match.group(1) if match else None
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = Histogram()
+
+    def as_dict(self, model=None):
+        return {
+            "db": self.db_name,
+            "fingerprint": self.fingerprint,
+            "model": model,
+            "calls": self.calls,
+            "errors": self.errors,
+            "rows": self.rows,
+            "total_time": self.total_time,
+            "mean_time": self.total_time / self.calls,
+            "max_time": self.max_time,
+            "p99": self.histogram.quantile(0.99),
+            "rows_per_call": self.rows / self.calls,
+        }
+
+
+class StatementStats(QueryHook):
+    """
+    Statistics of statements by database and fingerprint, like
+    ``pg_stat_statements`` of the application: calls, errors, rows, total,
+    mean, max and p99 seconds.
+
+    At most ``max_statements`` fingerprints are kept. When a new one does not
+    fit, the tenth of them with fewest calls is dropped, so memory stays
+    constant with SQL of many shapes and ``dropped`` counts them.
+    """
+
+    def __init__(self, max_statements=500):
+        self.max_statements = max_statements
+        self.entries = {}  # (db_name, fingerprint) -> StatementEntry
+        self.dropped = 0
+        self.reset_at = time.time()
+        self.models = {}  # table -> name of model
+        self._snapshot_task = None
+
+    async def after_query(self, event):
+        key = (event.db_name, event.fingerprint)
+        entry = self.entries.get(key)
+        if entry is None:
+            if len(self.entries) >= self.max_statements:
+                self._drop_least_called()
+            entry = self.entries[key] = StatementEntry(event.db_name, event.fingerprint)
+        entry.calls += 1
+        if event.error is not None:
+            entry.errors += 1
+        entry.rows += event.rows or 0
+        entry.total_time += event.duration
+        if event.duration > entry.max_time:
+            entry.max_time = event.duration
+        entry.histogram.observe(event.duration)
+
+    def _drop_least_called(self):
+        count = max(1, len(self.entries) // 10)
+        for key in sorted(self.entries, key=lambda key: self.entries[key].calls)[:count]:
+            del self.entries[key]
+        self.dropped += count
+
+    def top(self, n=20, order_by='total_time'):
+        """
+        Returns ``n`` statements with largest ``order_by``, one of
+        ``ORDERINGS``, with model of the table they run on.
+        """
+        if order_by not in ORDERINGS:
+            raise ValueError(f"unknown ordering of statements: {order_by}")
+        stats = [entry.as_dict(self.models.get(entry.table)) for entry in self.entries.values()]
+        stats.sort(key=lambda item: item[order_by] or 0, reverse=True)
+        return stats[:n]
+
+    def reset(self):
+        self.entries.clear()
+        self.dropped = 0
+        self.reset_at = time.time()
+
+    def snapshot(self, path):
+        """
+        Writes all statements to JSON file ``path``, replaced atomically.
+        """
+        data = {
+            "taken_at": time.time(),
+            "reset_at": self.reset_at,
+            "dropped": self.dropped,
+            "statements": self.top(len(self.entries)),
+        }
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    def start_snapshots(self, path, interval):
+        self.stop_snapshots()
+        self._snapshot_task = asyncio.ensure_future(self._snapshot_every(path, interval))
+
+    def stop_snapshots(self):
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+
+    async def _snapshot_every(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.snapshot(path)
+            except Exception as e:
+                await logger.warning(f"statement stats snapshot to {path} failed: {e!r}")
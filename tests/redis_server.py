@@ -0,0 +1,148 @@
+import asyncio
+import os
+import time
+
+
+class RedisStubServer:
+    """
+    Stand-in redis server for tests, speaks the redis protocol with the hash
+    and transaction commands used by the cache backend.
+    """
+
+    WRITE_COMMANDS = ("HSET", "HDEL", "HINCRBY", "EXPIRE", "DEL")
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.data = {}
+        self.versions = {}  # key -> count of writes, for WATCH
+        self.expires = {}
+        self.commands = []
+        self.process_id = os.getpid()
+        self.writers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+        self.server = None
+
+    @property
+    def url(self):
+        return f"redis://{self.host}:{self.port}/0"
+
+    async def read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    def encode(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, Exception):
+            return b"-ERR %s\r\n" % str(value).encode()
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(self.encode(v) for v in value)
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def get_hash(self, key):
+        expire_at = self.expires.get(key)
+        if expire_at is not None and expire_at <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def run(self, args, session):
+        """
+        Runs command of a connection, ``session`` keeps its watched keys and
+        queued transaction.
+        """
+        name = args[0].decode().upper()
+        if session["queue"] is not None and name != "EXEC":
+            session["queue"].append(args)
+            return "QUEUED"
+        if name == "WATCH":
+            for key in args[1:]:
+                session["watched"][key] = self.versions.get(key, 0)
+            return "OK"
+        if name == "UNWATCH":
+            session["watched"] = {}
+            return "OK"
+        if name == "MULTI":
+            session["queue"] = []
+            return "OK"
+        if name == "EXEC":
+            queue, watched = session["queue"] or [], session["watched"]
+            session["queue"], session["watched"] = None, {}
+            if any(self.versions.get(key, 0) != version for key, version in watched.items()):
+                return None
+            return [self.execute(queued) for queued in queue]
+        return self.execute(args)
+
+    def execute(self, args):
+        name = args[0].decode().upper()
+        self.commands.append(name)
+        if name in self.WRITE_COMMANDS:
+            self.versions[args[1]] = self.versions.get(args[1], 0) + 1
+        if name in ("PING", "AUTH", "SELECT"):
+            return "OK"
+        if name == "INFO":
+            return f"# Server\r\nprocess_id:{self.process_id}\r\n".encode()
+        if name == "HGETALL":
+            item = self.get_hash(args[1]) or {}
+            return [v for pair in item.items() for v in pair]
+        if name == "HSET":
+            item = self.data.setdefault(args[1], {})
+            for i in range(2, len(args), 2):
+                item[args[i]] = args[i + 1]
+            return (len(args) - 2) // 2
+        if name == "HDEL":
+            item = self.get_hash(args[1]) or {}
+            return len([item.pop(field) for field in args[2:] if field in item])
+        if name == "HINCRBY":
+            item = self.get_hash(args[1])
+            if item is None:
+                item = self.data[args[1]] = {}
+            value = int(item.get(args[2], b"0")) + int(args[3])
+            item[args[2]] = str(value).encode()
+            return value
+        if name == "EXPIRE":
+            self.expires[args[1]] = time.monotonic() + int(args[2])
+            return 1
+        if name == "DEL":
+            self.expires.pop(args[1], None)
+            return 1 if self.data.pop(args[1], None) is not None else 0
+        return Exception(f"unknown command '{name}'")
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        session = {"watched": {}, "queue": None}
+        try:
+            while True:
+                args = await self.read_command(reader)
+                if args is None:
+                    break
+                writer.write(self.encode(self.run(args, session)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
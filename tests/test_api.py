@@ -8,14 +8,19 @@ from postmodel.exceptions import (
     DoesNotExist,
     MultipleObjectsReturned,
     PrimaryKeyIntegrityError,
-    PrimaryKeyChangedError
+    PrimaryKeyChangedError,
+    FieldError,
+    ParamsError,
+    NoValuesFetched
 )
 import asyncio
-from postmodel.models import QueryExpression, Q
+from postmodel.models import QueryExpression, Q, F
 from postmodel.models import functions as fn
 from tests.testmodels import (Foo, Book,
-    CharFieldsModel, MultiPrimaryFoo)
-from datetime import datetime, date
+    CharFieldsModel, MultiPrimaryFoo, Counter, Job,
+    Author, Article, Category, EvaluatorSample)
+from datetime import datetime, date, timedelta
+from decimal import Decimal
 
 @pytest.mark.asyncio
 async def test_api_1(db_url):
@@ -266,3 +271,273 @@ async def test_api_multi_1(db_url):
     with pytest.raises(PrimaryKeyChangedError):
         foo.name = "n2"
     await Postmodel.close()
+
+
+@pytest.mark.asyncio
+async def test_api_f_expressions(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    mapper = Postmodel.get_mapper(Counter)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+
+    await Counter.bulk_create([
+        Counter(id=1, count=1, balance=Decimal("10.50")),
+        Counter(id=2, count=5),
+    ])
+    ret = await Counter.filter(id__in=[1, 2]).update(count=F("count") + 1)
+    assert ret == 2
+    c = await Counter.get(id=1)
+    assert c.count == 2
+    c2 = await Counter.get(id=2)
+    assert c2.count == 6
+
+    await Counter.filter(id=1).update(balance=F("balance") * 2 - Decimal("1.00"))
+    c = await Counter.get(id=1)
+    assert c.balance == Decimal("20.00")
+
+    data_ver = c.data_ver
+    stale = await Counter.get(id=1)
+    await asyncio.gather(*[Counter.filter(id=1).update(count=F("count") + 1) for _ in range(10)])
+    await c.update_fields_atomic(count=F("count") + 1)
+    assert c.count == 13
+    assert c.data_ver == data_ver + 1
+    assert len(c.changed()) == 0
+    c = await Counter.get(id=1)
+    assert c.count == 13
+
+    stale.count = 100
+    with pytest.raises(StaleObjectError):
+        await stale.save()
+
+    with pytest.raises(OperationalError):
+        await Counter(id=3).update_fields_atomic(count=F("count") + 1)
+
+    await c2.delete()
+    with pytest.raises(DoesNotExist):
+        await c2.update_fields_atomic(count=F("count") + 1)
+
+    await mapper.delete_table()
+    await Postmodel.close()
+
+@pytest.mark.asyncio
+async def test_api_returning(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    mapper = Postmodel.get_mapper(Counter)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+
+    await Counter.bulk_create([Counter(id=i, count=i) for i in range(1, 6)])
+
+    counters = await Counter.filter(id__lte=2).update(count=F("count") + 10).returning()
+    assert sorted([c.id for c in counters]) == [1, 2]
+    assert sorted([c.count for c in counters]) == [11, 12]
+    assert all(isinstance(c, Counter) for c in counters)
+
+    rows = await Counter.filter(id=3).update(count=0).returning("id", "count")
+    assert rows == [{"id": 3, "count": 0}]
+
+    rows = await Counter.filter(id=100).update(count=0).returning("id")
+    assert rows == []
+
+    counters = await Counter.filter(id__gte=4).delete().returning()
+    assert sorted([c.id for c in counters]) == [4, 5]
+    assert counters[0]._saved_in_db == False
+
+    rows = await Counter.filter(id=3).delete().returning("count")
+    assert rows == [{"count": 0}]
+    assert await Counter.all().count() == 2
+
+    with pytest.raises(FieldError):
+        Counter.all().update(count=1).returning("unknown")
+    with pytest.raises(FieldError):
+        Counter.all().delete().returning("unknown")
+
+    sample_mapper = Postmodel.get_mapper(EvaluatorSample)
+    await sample_mapper.delete_table()
+    await Postmodel.generate_schemas()
+    await EvaluatorSample.create(id=1, span=timedelta(seconds=5), data={"a": 1})
+    rows = await EvaluatorSample.filter(id=1).update(amount=1).returning("span", "data")
+    assert rows == [{"span": timedelta(seconds=5), "data": {"a": 1}}]
+    rows = await EvaluatorSample.filter(id=1).delete().returning("data")
+    assert rows == [{"data": {"a": 1}}]
+
+    await sample_mapper.delete_table()
+    await mapper.delete_table()
+    await Postmodel.close()
+
+@pytest.mark.asyncio
+async def test_api_claim(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    mapper = Postmodel.get_mapper(Job)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+
+    await Job.bulk_create([Job(id=i) for i in range(1, 21)])
+    await Job.filter(id=20).update(status="done")
+
+    async def worker(name):
+        return await Job.claim(
+            batch=5,
+            where=Q(status="pending"),
+            lease={"status": "running", "worker": name, "attempts": F("attempts") + 1},
+            order_by=("id",)
+        )
+
+    results = await asyncio.gather(*[worker(f"w{i}") for i in range(4)])
+    claimed = [job.id for jobs in results for job in jobs]
+    assert sorted(claimed) == list(range(1, 20))
+    for jobs in results:
+        assert len(set(job.worker for job in jobs)) <= 1
+        for job in jobs:
+            assert job.status == "running"
+            assert job.attempts == 1
+
+    jobs = await Job.claim(batch=5, where={"status": "pending"}, lease={"status": "running"})
+    assert jobs == []
+
+    with pytest.raises(ParamsError):
+        await Job.claim(batch=1)
+
+    await mapper.delete_table()
+    await Postmodel.close()
+
+@pytest.mark.asyncio
+async def test_api_subquery_and_values(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    await Postmodel.generate_schemas()
+    await Counter.all().delete()
+    await Job.all().delete()
+
+    await Counter.bulk_create([Counter(id=i, count=i * 10) for i in range(1, 6)])
+    await Job.bulk_create([Job(id=i) for i in range(1, 6)])
+
+    rows = await Counter.filter(count__gte=40).order_by("id").values("id", "count")
+    assert rows == [{"id": 4, "count": 40}, {"id": 5, "count": 50}]
+    row = await Counter.filter(id=1).values().first()
+    assert row["count"] == 10
+    assert set(row.keys()) == set(Counter._meta.fields_map.keys())
+
+    jobs = await Job.filter(id__in=Counter.filter(count__gte=40).values("id")).order_by("id")
+    assert [job.id for job in jobs] == [4, 5]
+    jobs = await Job.filter(id__not_in=Counter.filter(count__gte=20).values("id"))
+    assert [job.id for job in jobs] == [1]
+    jobs = await Job.exclude(id__in=Counter.filter(count__lte=30))
+    assert sorted([job.id for job in jobs]) == [4, 5]
+
+    count = await Job.filter(id__in=Counter.filter(count__gte=40).values("id")).count()
+    assert count == 2
+    ret = await Job.filter(id__in=Counter.filter(count=10).values("id")).update(status="done")
+    assert ret == 1
+    ret = await Job.filter(id__in=Counter.filter(count=10).values("id")).delete()
+    assert ret == 1
+
+    with pytest.raises(FieldError):
+        Counter.all().values("unknown")
+
+    await Counter.all().delete()
+    await Job.all().delete()
+    await Postmodel.close()
+
+@pytest.mark.asyncio
+async def test_api_select_related(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    for model in (Article, Category, Author):
+        await Postmodel.get_mapper(model).delete_table()
+    await Postmodel.generate_schemas()
+
+    tom = await Author.create(id=1, name="tom")
+    jerry = await Author.create(id=2, name="jerry")
+    await Article.create(id=1, title="a1", author=tom, editor=jerry)
+    await Article.create(id=2, title="a2", author=tom)
+    await Article.create(id=3, title="a3", author_id=2)
+    with pytest.raises(IntegrityError):
+        await Article.create(id=4, title="a4", author_id=100)
+
+    articles = await Article.all().select_related("author", "editor").order_by("id")
+    assert [a.id for a in articles] == [1, 2, 3]
+    assert articles[0].author.name == "tom"
+    assert articles[0].author is articles[1].author
+    assert articles[0].editor.name == "jerry"
+    assert articles[1].editor is None
+    assert articles[2].author.id == 2
+
+    articles = await Article.filter(id__in=[1, 3], title__not="a3").select_related("author")
+    assert len(articles) == 1
+    with pytest.raises(NoValuesFetched):
+        articles[0].editor
+
+    article = await Article.filter(author_id__in=Author.filter(name="jerry").values("id")).select_related("author").first()
+    assert article.id == 3
+    assert article.author.name == "jerry"
+    assert len(article.changed()) == 0
+
+    article = await Article.get(id=1)
+    with pytest.raises(NoValuesFetched):
+        article.author
+    await article.fetch_related("author", "editor")
+    assert article.author.name == "tom"
+    assert article.editor.name == "jerry"
+    with pytest.raises(FieldError):
+        await article.fetch_related("unknown")
+    with pytest.raises(FieldError):
+        Article.all().select_related("unknown")
+
+    await jerry.delete()
+    article = await Article.get(id=1)
+    assert article.editor_id is None
+    assert await Article.filter(id=3).count() == 0
+
+    root = await Category.create(id=1, name="root")
+    child = await Category.create(id=2, name="child", parent=root)
+    category = await Category.filter(name="child").select_related("parent").first()
+    assert category.parent.name == "root"
+    assert category.parent.parent_id is None
+
+    for model in (Article, Category, Author):
+        await Postmodel.get_mapper(model).delete_table()
+    await Postmodel.close()
+
+@pytest.mark.asyncio
+async def test_api_prefetch(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    for model in (Article, Category, Author):
+        await Postmodel.get_mapper(model).delete_table()
+    await Postmodel.generate_schemas()
+
+    tom = await Author.create(id=1, name="tom")
+    jerry = await Author.create(id=2, name="jerry")
+    spike = await Author.create(id=3, name="spike")
+    await Article.bulk_create([
+        Article(id=1, title="a1", author=tom, editor=jerry),
+        Article(id=2, title="a2", author=tom),
+        Article(id=3, title="a3", author=jerry, editor=jerry),
+    ])
+
+    authors = await Author.all().order_by("id").prefetch(
+        Article.all().order_by("-id"), on="author"
+    ).prefetch(Article, on="editor_id", to_attr="edited")
+    assert [a.id for a in authors] == [1, 2, 3]
+    assert [a.id for a in authors[0].article_set] == [2, 1]
+    assert authors[0].article_set[0].author is authors[0]
+    assert [a.id for a in authors[1].article_set] == [3]
+    assert authors[2].article_set == []
+    assert sorted([a.id for a in authors[1].edited]) == [1, 3]
+    assert authors[0].edited == []
+
+    author = await Author.filter(id=1).prefetch(Article, on="author").first()
+    assert len(author.article_set) == 2
+    authors = await Author.filter(id=100).prefetch(Article, on="author")
+    assert authors == []
+
+    with pytest.raises(FieldError):
+        Author.all().prefetch(Article, on="unknown")
+    with pytest.raises(FieldError):
+        Author.all().prefetch(Article, on="author", to_attr="name")
+    with pytest.raises(ParamsError):
+        Author.all().prefetch(Article.all().limit(1), on="author")
+    with pytest.raises(ParamsError):
+        Author.all().prefetch(Article.all().offset(1), on="author")
+
+    for model in (Article, Category, Author):
+        await Postmodel.get_mapper(model).delete_table()
+    await Postmodel.close()
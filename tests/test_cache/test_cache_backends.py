@@ -0,0 +1,104 @@
+from postmodel.cache import MemoryCacheBackend, RedisCacheBackend, CacheManager, CacheNode
+from postmodel.exceptions import ConfigurationError
+from tests.redis_server import RedisStubServer
+import asyncio
+import pytest
+
+
+async def check_backend(backend):
+    assert await backend.get_item("k:1:t") == {}
+    assert await backend.incr_field("k:1:t", "_wv", 1, 60) == 1
+    assert await backend.incr_field("k:1:t", "_wv", 2) == 3
+    await backend.set_item("k:1:t", {"a": "j:1", "b": "j:\"x\"", "_rv": 3}, (), 60)
+    assert await backend.get_item("k:1:t") == {"a": "j:1", "b": "j:\"x\"", "_rv": "3", "_wv": "3"}
+    await backend.set_item("k:1:t", {"a": "j:2"}, ["b"])
+    assert await backend.get_item("k:1:t") == {"a": "j:2", "_rv": "3", "_wv": "3"}
+    assert not await backend.set_item_if("k:1:t", lambda item: item["a"] == "j:1", {"a": "j:3"})
+    assert await backend.set_item_if("k:1:t", lambda item: item["a"] == "j:2", {"a": "j:3"}, ["_rv"], 60)
+    assert await backend.get_item("k:1:t") == {"a": "j:3", "_wv": "3"}
+    await backend.delete("k:1:t")
+    assert await backend.get_item("k:1:t") == {}
+    await backend.set_item("k:2:t", {"a": "j:1"}, (), 1)
+    assert "process_id" in await backend.info()
+
+
+@pytest.mark.asyncio
+async def test_memory_backend():
+    backend = MemoryCacheBackend()
+    await check_backend(backend)
+    backend.expires["k:2:t"] = 0
+    assert await backend.get_item("k:2:t") == {}
+
+
+@pytest.mark.asyncio
+async def test_redis_backend():
+    server = await RedisStubServer().start()
+    backend = RedisCacheBackend(port=server.port, db=1, password="secret")
+    await check_backend(backend)
+    assert server.commands[:2] == ["AUTH", "SELECT"]
+
+    # item changed after it is checked is not set
+    def changed(item):
+        server.execute([b"HSET", b"k:3:t", b"a", b"j:2"])
+        return True
+    assert not await backend.set_item_if("k:3:t", changed, {"a": "j:1"})
+    assert await backend.get_item("k:3:t") == {"a": "j:2"}
+    await backend.close()
+
+    await server.stop()
+    with pytest.raises(ConnectionError):
+        await backend.get_item("k:1:t")
+
+
+@pytest.mark.asyncio
+async def test_cache_manager():
+    manager = CacheManager.from_urls(["memory://", "redis://:pw@localhost:7000/2?check_interval=5&max_connections=3"])
+    assert len(manager.nodes) == 2
+    node = manager.nodes[1]
+    assert node.check_interval == 5
+    assert (node.backend.host, node.backend.port, node.backend.db, node.backend.password) == ("localhost", 7000, 2, "pw")
+    assert manager.cache_node(3) is node
+    assert manager.cache_node(4) is manager.nodes[0]
+
+    with pytest.raises(ConfigurationError):
+        CacheManager.from_urls("memcache://localhost")
+    with pytest.raises(ConfigurationError):
+        CacheManager.from_urls("redis://localhost/abc")
+    with pytest.raises(ConfigurationError):
+        CacheManager.from_urls([])
+
+
+@pytest.mark.asyncio
+async def test_cache_node_down_and_recover():
+    server = await RedisStubServer().start()
+    port = server.port
+    node = CacheNode(RedisCacheBackend(port=port), check_interval=0, start_cycle=0)
+    await node.check_status()
+    assert node.status == "up" and node.process_id == server.process_id
+
+    await server.stop()
+    with pytest.raises(ConnectionError):
+        await node.backend.get_item("k:1:t")
+    await node.node_down()
+    assert not node.enabled and node.get_client() is None
+    await node.mark_dirty_data("k:1:t")
+    assert node.dirty_keys == {("k:1:t", "_wv")}
+
+    # still down, dirty keys are kept
+    node.last_check_time = 0
+    await node.check_status()
+    assert node.status == "down"
+
+    server = await RedisStubServer(port=port).start()
+    await asyncio.sleep(0.01)
+    await node.check_status()
+    assert node.status == "starting"
+    assert node.enabled and node.writeonly
+    assert node.dirty_keys == set()
+    assert server.data[b"k:1:t"][b"_wv"] == b"1"
+
+    await asyncio.sleep(0.01)
+    await node.check_status()
+    assert node.status == "up" and not node.writeonly
+    await node.backend.close()
+    await server.stop()
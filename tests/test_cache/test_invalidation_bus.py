@@ -0,0 +1,122 @@
+from tests.testmodels import Foo, Tag, Badge
+from postmodel.cache import InvalidationBus
+from postmodel.sqldb.postgres import PostgresEngine
+from postmodel.transaction import in_transaction
+from postmodel import Postmodel
+import asyncio
+import json
+import pytest
+
+
+async def wait_for(predicate, timeout=3):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+def test_invalidation_bus_encode():
+    bus = InvalidationBus(None)
+    assert bus.encode("foo", []) == [json.dumps([bus.sender, "foo", []], separators=(',', ':'))]
+    assert json.loads(bus.encode("foo", [(1, "a")])[0])[2] == [[1, "a"]]
+    payloads = bus.encode("foo", list(range(5000)))
+    assert len(payloads) > 1
+    assert all(len(payload) <= bus.MAX_PAYLOAD for payload in payloads)
+    pks = []
+    for payload in payloads:
+        pks.extend(json.loads(payload)[2])
+    assert pks == list(range(5000))
+
+
+@pytest.mark.asyncio
+async def test_invalidation_bus(db_url):
+    await Postmodel.init(db_url, modules=["tests.testmodels"], cache_url="memory://", invalidation_bus=True)
+    await Postmodel.get_mapper(Tag).delete_table()
+    await Postmodel.get_mapper(Badge).delete_table()
+    await Postmodel.generate_schemas()
+    await Foo.all().delete()
+    db = Postmodel.get_database()
+    assert db.invalidation_bus is not None
+
+    # other process
+    _, config, parameters = Postmodel._parse_db_url(db_url)
+    other_db = PostgresEngine("other", config, parameters)
+    await other_db.init()
+    other = InvalidationBus(other_db)
+    received = []
+    other.subscribe(lambda table, pks: received.append((table, pks)))
+    await other.start()
+
+    # writes of this process are published
+    await Foo.create(foo_id=1, name="1", tag="a", memo="one")
+    assert await wait_for(lambda: ("single_primary_foo", [1]) in received)
+    await Foo.bulk_create([Foo(foo_id=2, name="2", tag="a", memo="two")])
+    assert await wait_for(lambda: ("single_primary_foo", []) in received)
+    received.clear()
+    await Foo.filter(tag="a").update(memo="x")
+    assert await wait_for(lambda: len(received) == 1)
+    assert sorted(received[0][1]) == [1, 2]
+
+    # transaction messages are sent in one notify at commit
+    received.clear()
+    async with in_transaction():
+        await Foo.filter(foo_id=1).update(memo="y")
+        await Foo.filter(foo_id=2).delete()
+        await asyncio.sleep(0.1)
+        assert received == []
+    assert await wait_for(lambda: len(received) == 1)
+    assert sorted(received[0][1]) == [1, 2]
+    # unknown rows of bulk inserts are not narrowed by keyed writes
+    received.clear()
+    async with in_transaction():
+        await Foo.bulk_create([Foo(foo_id=3, name="3", tag="b", memo="three")])
+        await Foo.filter(foo_id=1).update(memo="y")
+    assert await wait_for(lambda: len(received) == 1)
+    assert received[0] == ("single_primary_foo", [])
+    await Foo.filter(foo_id=3).delete()
+    assert await wait_for(lambda: len(received) == 2)
+    received.clear()
+    with pytest.raises(Exception):
+        async with in_transaction():
+            await Foo.filter(foo_id=1).update(memo="z")
+            raise Exception("rollback")
+    await asyncio.sleep(0.1)
+    assert received == []
+
+    # messages of other processes evict local caches
+    await Tag.create(id=1, name="a")
+    assert (await Tag.load(id=1)).name == "a"
+    assert (await Foo.filter(foo_id=1).cached())[0].memo == "y"
+    await db.execute_script("UPDATE tag SET name='b'; UPDATE single_primary_foo SET memo='b'")
+    assert (await Tag.load(id=1)).name == "a"
+    assert (await Foo.filter(foo_id=1).cached())[0].memo == "y"
+    await other.publish("tag", [1])
+    await other.publish("single_primary_foo", [])
+    assert await wait_for(lambda: db.invalidation_bus.received == 2)
+    assert (await Tag.load(id=1)).name == "b"
+    assert (await Foo.filter(foo_id=1).cached())[0].memo == "b"
+    # pks of messages are decoded to evict rows kept in process
+    badge = await Badge.create(name="a")
+    assert (await Badge.load(id=badge.id)).name == "a"
+    await db.execute_script("UPDATE badge SET name='b'")
+    assert (await Badge.load(id=badge.id)).name == "a"
+    await other.publish("badge", [badge.id])
+    assert await wait_for(lambda: db.invalidation_bus.received == 3)
+    assert (await Badge.load(id=badge.id)).name == "b"
+
+    # lost listener connection drops everything
+    await db.execute_script("UPDATE tag SET name='c'")
+    await other_db.execute_script(
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+        f"WHERE pid = {db._listener.get_server_pid()}")
+    assert await wait_for(lambda: db.invalidation_bus.received == 4)
+    assert (await Tag.load(id=1)).name == "c"
+    await Tag.filter(id=1).update(name="d")
+    assert await wait_for(lambda: ("tag", [1]) in received)
+
+    await other_db.close()
+    await Postmodel.get_mapper(Tag).delete_table()
+    await Postmodel.get_mapper(Badge).delete_table()
+    await Foo.all().delete()
+    await Postmodel.close()
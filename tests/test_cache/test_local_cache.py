@@ -0,0 +1,86 @@
+from tests.testmodels import Label, Profile
+from postmodel.cache import LocalCache
+from postmodel.cache import local
+from postmodel.transaction import in_transaction
+from postmodel import Postmodel
+from types import SimpleNamespace
+import time
+import pytest
+
+
+def test_local_cache(monkeypatch):
+    cache = LocalCache(max_entries=2, ttl=10)
+    assert cache.get(1) is None
+    assert cache.set(1, {"id": 1}, cache.generation)
+    assert cache.get(1) == {"id": 1}
+
+    # reads racing with writes are not kept
+    generation = cache.generation
+    cache.discard(2)
+    assert not cache.set(2, {"id": 2}, generation)
+    assert cache.get(2) is None
+
+    cache.set(2, {"id": 2}, cache.generation)
+    cache.set(3, {"id": 3}, cache.generation)
+    assert cache.get(1) is None and cache.get(3) == {"id": 3}
+    now = time.monotonic()
+    monkeypatch.setattr(local, "time", SimpleNamespace(monotonic=lambda: now + 11))
+    assert cache.get(2) is None
+    assert cache.stats() == {"entries": 1, "hits": 2, "misses": 4,
+        "hit_rate": 2 / 6, "evictions": 1}
+    cache.clear()
+    assert cache.entries == {}
+
+
+@pytest.mark.asyncio
+async def test_local_cache_lookups(db_url, monkeypatch):
+    await Postmodel.init(db_url, modules=["tests.testmodels"], cache_url="memory://")
+    await Postmodel.get_mapper(Label).delete_table()
+    await Postmodel.generate_schemas()
+    assert Profile.get_mapper().model_cache.local is None
+    model_cache = Label.get_mapper().model_cache
+    assert model_cache.local.max_entries == 2 and model_cache.local.ttl == 30
+
+    reads = []
+    get_writethrough = model_cache.get_writethrough
+
+    async def counted(pk):
+        reads.append(pk)
+        return await get_writethrough(pk)
+
+    monkeypatch.setattr(model_cache, "get_writethrough", counted)
+
+    # lookups fill both tiers, then are answered in process
+    await Label.create(id=1, name="a")
+    first = await Label.load(id=1)
+    assert first.name == "a" and reads == [1]
+    second = await Label.load(id=1)
+    assert second.name == "a" and second is not first and reads == [1]
+    second.name = "changed"
+    assert (await Label.load(id=1)).name == "a"
+
+    # writes invalidate both tiers
+    await second.save()
+    assert (await Label.load(id=1)).name == "changed"
+    await Label.filter(id=1).update(name="b")
+    assert (await Label.load(id=1)).name == "b"
+    async with in_transaction():
+        await Label.filter(id=1).update(name="c")
+    assert (await Label.load(id=1)).name == "c"
+
+    # valid items of the shared tier are promoted
+    await Label.create(id=2, name="x")
+    model_cache.local.clear()
+    del reads[:]
+    assert (await Label.load(id=2)).name == "x"
+    assert (await Label.load(id=2)).name == "x"
+    assert reads == [2]
+
+    # writes of other processes evict the process tier
+    await Postmodel.get_database().execute_script("UPDATE label SET name='y' WHERE id=2")
+    assert (await Label.load(id=2)).name == "x"
+    await model_cache.evict_local(2)
+    assert (await Label.load(id=2)).name == "y"
+
+    await Postmodel.get_mapper(Label).delete_table()
+    await Postmodel.close()
@@ -0,0 +1,188 @@
+from tests.testmodels import Profile, Tag, Foo
+from tests.redis_server import RedisStubServer
+from postmodel.transaction import in_transaction
+from postmodel import Postmodel
+from decimal import Decimal
+import asyncio
+import pytest
+
+
+async def init_cached(db_url, cache_url):
+    await Postmodel.init(db_url, modules=["tests.testmodels"], cache_url=cache_url)
+    for model in (Profile, Tag):
+        await Postmodel.get_mapper(model).delete_table()
+    await Postmodel.generate_schemas()
+
+
+async def drop_cached():
+    for model in (Profile, Tag):
+        await Postmodel.get_mapper(model).delete_table()
+    await Postmodel.close()
+
+
+async def raw(sql):
+    await Postmodel.get_database().execute_script(sql)
+
+
+async def check_model_cache():
+    assert Foo.get_mapper().model_cache is None
+    model_cache = Profile.get_mapper().model_cache
+
+    p = await Profile.create(id=1, name="tom", balance=Decimal("1.50"),
+        avatar=b"\x00\x01", settings={"a": [1, 2]})
+    item, rv, wv = await model_cache.get_writethrough(1)
+    assert rv == wv == 1
+
+    # created row is written through
+    await raw("UPDATE profile SET name='behind' WHERE id=1")
+    cached = await Profile.load(id=1)
+    assert cached is not p
+    assert cached.to_dict() == p.to_dict()
+    assert (await Profile.get(id=1)).name == "tom"
+    assert [x.name for x in await Profile.filter(id=1)] == ["tom"]
+    assert (await Profile.filter(name="behind").first()).name == "behind"
+
+    # save with data version writes through
+    cached.name = "jerry"
+    await cached.save()
+    await raw("UPDATE profile SET name='behind' WHERE id=1")
+    assert (await Profile.load(id=1)).name == "jerry"
+
+    # queryset update invalidates
+    await Profile.filter(id=1).update(name="spike")
+    assert (await Profile.load(id=1)).name == "spike"
+    await raw("UPDATE profile SET name='behind' WHERE id=1")
+    assert (await Profile.load(id=1)).name == "spike"
+
+    # atomic update invalidates
+    await cached.update_fields_atomic(balance=Decimal("3.00"))
+    loaded = await Profile.load(id=1)
+    assert loaded.name == "behind" and loaded.balance == Decimal("3.00")
+
+    # missed load fills cache
+    await Tag.create(id=1, name="a")
+    await Tag.filter(id=1).update(name="b")
+    assert (await Tag.load(id=1)).name == "b"
+    await raw("UPDATE tag SET name='behind' WHERE id=1")
+    tag = await Tag.load(id=1)
+    assert tag.name == "b"
+
+    # save without data version only invalidates
+    tag.name = "c"
+    await tag.save()
+    await raw("UPDATE tag SET name='behind' WHERE id=1")
+    assert (await Tag.load(id=1)).name == "behind"
+
+    # delete invalidates
+    await tag.delete()
+    assert await Tag.load(id=1) is None
+    await Tag.create(id=2, name="x")
+    await Tag.filter(id=2).delete()
+    assert await Tag.load(id=2) is None
+
+    # reads inside transaction bypass cache, commit invalidates
+    async with in_transaction():
+        await Profile.filter(id=1).update(name="in_tx")
+        assert (await Profile.load(id=1)).name == "in_tx"
+        item, rv, wv = await model_cache.get_writethrough(1)
+        assert rv == wv
+    assert (await Profile.load(id=1)).name == "in_tx"
+
+    # rollback leaves item dirty
+    loaded = await Profile.load(id=1)
+    try:
+        async with in_transaction():
+            loaded.name = "rollback"
+            await loaded.save()
+            raise Exception("rollback")
+    except Exception:
+        pass
+    item, rv, wv = await model_cache.get_writethrough(1)
+    assert rv != wv
+    assert (await Profile.load(id=1)).name == "in_tx"
+
+    # fills racing with writers stay invalid
+    item, rv, wv = await model_cache.get_writethrough(1)
+    await model_cache.mark_dirty(1)
+    await model_cache.set_writethrough(1, item, item, wv)
+    item, rv, wv = await model_cache.get_writethrough(1)
+    assert rv != wv
+
+    # fills older than cached data version are rejected
+    profile = await Profile.load(id=1)
+    item, rv, wv = await model_cache.get_writethrough(1)
+    profile.data_ver -= 1
+    profile.name = "stale"
+    assert not await model_cache.set_writethrough(1, model_cache.encode_item(profile), item, wv)
+    assert (await Profile.load(id=1)).name == "in_tx"
+
+    # concurrent misses share one query, filled once by the first caller
+    await model_cache.mark_dirty(1)
+    db = Postmodel.get_database()
+    execute_query = db.execute_query
+    queries = []
+
+    async def counted(*args, **kwargs):
+        queries.append(args)
+        await asyncio.sleep(0.05)
+        return await execute_query(*args, **kwargs)
+
+    db.execute_query = counted
+    try:
+        loaded = await asyncio.gather(*[Profile.load(id=1) for _ in range(5)])
+    finally:
+        del db.execute_query
+    assert len(queries) == 1
+    assert len({id(p) for p in loaded}) == 5
+    assert all(p.name == "in_tx" for p in loaded)
+    item, rv, wv = await model_cache.get_writethrough(1)
+    assert rv == wv
+
+    # after commit callbacks of writers run out of order, the older row is
+    # not written through
+    older = await Profile.load(id=1)
+    newer = await Profile.load(id=1)
+    older.name = "older"
+    newer.balance += 1
+    await newer.save()
+    await Profile.get_mapper()._cache_after_write([1], older)
+    item, rv, wv = await model_cache.get_writethrough(1)
+    assert rv != wv
+    assert (await Profile.load(id=1)).name == "in_tx"
+
+
+@pytest.mark.asyncio
+async def test_model_cache_memory(db_url):
+    await init_cached(db_url, "memory://")
+    await check_model_cache()
+    await drop_cached()
+
+
+@pytest.mark.asyncio
+async def test_model_cache_redis(db_url):
+    server = await RedisStubServer().start()
+    await init_cached(db_url, server.url)
+    await check_model_cache()
+
+    # node down, database is used and written keys are marked dirty on recovery
+    model_cache = Profile.get_mapper().model_cache
+    node = await model_cache.cache_instance(1)
+    node.check_interval = 0
+    node.start_cycle = 0
+    port = server.port
+    await server.stop()
+    assert (await Profile.load(id=1)).name == "in_tx"
+    assert node.status == "down"
+    await Profile.filter(id=1).update(name="down")
+    assert node.dirty_keys == {("profile:1:t", "_wv")}
+
+    server = await RedisStubServer(port=port).start()
+    assert (await Profile.load(id=1)).name == "down"
+    assert node.status == "starting"
+    assert node.dirty_keys == set()
+    assert (await Profile.load(id=1)).name == "down"
+    assert node.status == "up"
+    assert (await Profile.load(id=1)).name == "down"
+
+    await drop_cached()
+    await server.stop()
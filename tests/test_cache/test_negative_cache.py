@@ -0,0 +1,119 @@
+from tests.testmodels import Member, Foo
+from postmodel.cache import NegativeCache, InvalidationBus
+from postmodel.cache import negative
+from postmodel.sqldb.postgres import PostgresEngine
+from postmodel.transaction import in_transaction
+from postmodel.exceptions import DoesNotExist
+from postmodel import Postmodel
+from types import SimpleNamespace
+import asyncio
+import time
+import pytest
+
+
+async def wait_for(predicate, timeout=3):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+def test_negative_cache(monkeypatch):
+    cache = NegativeCache(Member, max_entries=2, ttl=10)
+    assert not cache.contains(1)
+    assert cache.add(1, cache.generation)
+    assert cache.contains(1)
+
+    # misses of lookups racing with inserts are not remembered
+    generation = cache.generation
+    cache.discard([2])
+    assert not cache.add(2, generation)
+    assert not cache.contains(2)
+
+    cache.add(2, cache.generation)
+    cache.add(3, cache.generation)
+    assert not cache.contains(1) and cache.contains(2) and cache.contains(3)
+    now = time.monotonic()
+    monkeypatch.setattr(negative, "time", SimpleNamespace(monotonic=lambda: now + 11))
+    assert not cache.contains(2)
+    assert cache.stats() == {"entries": 1, "hits": 3, "misses": 4}
+    cache.clear()
+    assert cache.entries == {}
+    assert cache.decode_pk("5") == 5
+
+
+class QueryCounter:
+    def __init__(self, db, monkeypatch):
+        self.count = 0
+        execute_query = db.execute_query
+
+        async def counted(*args, **kwargs):
+            self.count += 1
+            return await execute_query(*args, **kwargs)
+
+        monkeypatch.setattr(db, "execute_query", counted)
+
+
+@pytest.mark.asyncio
+async def test_negative_cache_lookups(db_url, monkeypatch):
+    await Postmodel.init(db_url, modules=["tests.testmodels"], invalidation_bus=True)
+    await Postmodel.get_mapper(Member).delete_table()
+    await Postmodel.generate_schemas()
+    assert Foo.get_mapper().negative_cache is None
+    cache = Member.get_mapper().negative_cache
+    assert cache.max_entries == 100 and cache.ttl == 30
+    db = Postmodel.get_database()
+    counter = QueryCounter(db, monkeypatch)
+
+    # repeated misses are answered in process
+    assert await Member.load(id=1) is None
+    assert counter.count == 1
+    assert await Member.load(id=1) is None
+    assert await Member.get_or_none(id=1) is None
+    assert await Member.filter(id=1) == []
+    with pytest.raises(DoesNotExist):
+        await Member.get(id=1)
+    assert counter.count == 1
+    # other lookups query database
+    assert await Member.filter(name="a") == []
+    assert counter.count == 2
+
+    # inserts of this process are visible at once
+    await Member.create(id=1, name="a")
+    assert (await Member.load(id=1)).name == "a"
+    for i in (2, 3):
+        assert await Member.load(id=i) is None
+    await Member.bulk_create([Member(id=2, name="b"), Member(id=3, name="c")])
+    assert (await Member.load(id=2)).name == "b"
+    assert (await Member.load(id=3)).name == "c"
+
+    # not used in transactions, inserts are visible after commit
+    assert await Member.load(id=4) is None
+    async with in_transaction():
+        await Member.create(id=4, name="d")
+        assert (await Member.load(id=4)).name == "d"
+        assert await Member.load(id=5) is None
+        assert not cache.contains(5)
+    assert (await Member.load(id=4)).name == "d"
+
+    # inserts of other processes come from invalidation bus
+    _, config, parameters = Postmodel._parse_db_url(db_url)
+    other_db = PostgresEngine("other", config, parameters)
+    await other_db.init()
+    other = InvalidationBus(other_db)
+    assert await Member.load(id=6) is None
+    assert await Member.load(id=7) is None
+    await db.execute_script("INSERT INTO member (id, name) VALUES (6, 'f'), (7, 'g')")
+    assert await Member.load(id=6) is None
+    await other.publish("member", [6])
+    assert await wait_for(lambda: not cache.contains(6))
+    assert (await Member.load(id=6)).name == "f"
+    assert cache.contains(7)
+    await other.publish("member", [])
+    assert await wait_for(lambda: not cache.contains(7))
+    assert (await Member.load(id=7)).name == "g"
+
+    await other_db.close()
+    await Postmodel.get_mapper(Member).delete_table()
+    await Postmodel.close()
@@ -0,0 +1,217 @@
+from tests.testmodels import Foo, Author, Article, Category
+from postmodel.cache import QueryCache, SingleFlight
+from postmodel.exceptions import ParamsError
+from postmodel.transaction import in_transaction
+from postmodel import Postmodel
+from postmodel.cache import query
+from functools import partial
+from types import SimpleNamespace
+import asyncio
+import time
+import pytest
+
+
+def test_query_cache_lru():
+    cache = QueryCache(max_entries=2)
+    rows = [{"id": 1, "name": "a"}]
+    key1 = cache.make_key("default", "SELECT 1", [1, [2, 3]])
+    assert key1 == ("default", "SELECT 1", (1, (2, 3)))
+    assert cache.make_key("default", "SELECT 1", [{"a": 1}]) is None
+
+    assert cache.get(key1) is None
+    assert cache.set(key1, ("foo", ), rows, 60, cache.generation(("foo", )))
+    assert cache.get(key1) is rows
+    generation = cache.generation(("foo", "bar"))
+    cache.set("k2", ("bar", ), rows, 60, cache.generation(("bar", )))
+    cache.get(key1)
+    cache.set("k3", ("bar", ), rows, 60, cache.generation(("bar", )))
+    # least recently used entry is evicted
+    assert cache.get("k2") is None
+    assert cache.get("k3") is rows
+    assert cache.stats()["evictions"] == 1
+
+    cache.invalidate_table("bar")
+    assert cache.get("k3") is None
+    assert cache.get(key1) is rows
+    # tables written after the query started are not stored
+    assert not cache.set("k4", ("foo", "bar"), rows, 60, generation)
+    assert cache.get("k4") is None
+
+    cache.set("k5", ("foo", ), rows, -1, cache.generation(("foo", )))
+    assert cache.get("k5") is None
+
+    stats = cache.stats()
+    assert stats["entries"] == 1
+    assert stats["bytes"] > 0
+    assert stats["hits"] == 4
+    assert stats["misses"] == 5
+    assert stats["hit_rate"] == 4 / 9
+    assert stats["invalidations"] == 1
+    cache.clear()
+    assert cache.stats()["entries"] == 0 and cache.bytes == 0
+
+    cache = QueryCache(max_bytes=cache._rows_size(rows) + 1)
+    cache.set("k1", ("foo", ), rows, 60, cache.generation(("foo", )))
+    cache.set("k2", ("foo", ), rows, 60, cache.generation(("foo", )))
+    assert cache.get("k1") is None and cache.get("k2") is rows
+    assert not cache.set("k3", ("foo", ), rows * 10, 60, cache.generation(("foo", )))
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+
+    async def call(result):
+        calls.append(result)
+        await asyncio.sleep(0.02)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    results = await asyncio.gather(*[flight.run("k", partial(call, i)) for i in range(3)])
+    assert results == [(0, False), (0, True), (0, True)]
+    assert calls == [0] and flight.collapsed == 2 and not flight.running("k")
+
+    error = ValueError("x")
+    results = await asyncio.gather(*[flight.run("k", partial(call, error)) for i in range(2)],
+        return_exceptions=True)
+    assert results == [error, error]
+
+    # callers waiting for a cancelled call run it themselves
+    calls.clear()
+    first = asyncio.ensure_future(flight.run("k", partial(call, 1)))
+    await asyncio.sleep(0)
+    second = asyncio.ensure_future(flight.run("k", partial(call, 2)))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == (2, False)
+    assert calls == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_query_cache_fetch(monkeypatch):
+    cache = QueryCache()
+    loads = []
+
+    async def loader(value):
+        loads.append(value)
+        await asyncio.sleep(0.02)
+        return [{"value": value}]
+
+    # concurrent misses load once
+    results = await asyncio.gather(*[
+        cache.fetch("k", ("foo", ), 60, partial(loader, 1)) for _ in range(5)])
+    assert results == [[{"value": 1}]] * 5 and loads == [1]
+    assert cache.stats()["collapsed"] == 4
+
+    # early refresh before expiry, callers get current rows meanwhile
+    now = time.monotonic()
+    monkeypatch.setattr(query, "time", SimpleNamespace(monotonic=lambda: now + 59.99))
+    monkeypatch.setattr(query, "random", SimpleNamespace(random=lambda: 0.99))
+    assert await cache.fetch("k", ("foo", ), 60, partial(loader, 2)) == [{"value": 1}]
+    assert await cache.fetch("k", ("foo", ), 60, partial(loader, 3)) == [{"value": 1}]
+    await asyncio.gather(*cache.tasks)
+    assert loads == [1, 2] and cache.stats()["early_refreshes"] == 1
+    assert cache.get("k") == [{"value": 2}]
+    monkeypatch.setattr(query, "random", SimpleNamespace(random=lambda: 0.0))
+    assert await cache.fetch("k", ("foo", ), 60, partial(loader, 3)) == [{"value": 2}]
+    assert not cache.tasks
+
+    # stale rows are returned while they are refreshed
+    await cache.fetch("s", ("foo", ), 60, partial(loader, 1), stale_ttl=30)
+    monkeypatch.setattr(query, "time", SimpleNamespace(monotonic=lambda: now + 130))
+    assert cache.get("s") is None
+    assert await cache.fetch("s", ("foo", ), 60, partial(loader, 4), stale_ttl=30) == [{"value": 1}]
+    await asyncio.gather(*cache.tasks)
+    assert cache.get("s") == [{"value": 4}] and cache.stats()["stale_hits"] == 1
+    monkeypatch.setattr(query, "time", SimpleNamespace(monotonic=lambda: now + 400))
+    assert await cache.fetch("s", ("foo", ), 60, partial(loader, 5), stale_ttl=30) == [{"value": 5}]
+
+    # failed refreshes keep the stale rows
+    async def failed():
+        raise ValueError("down")
+
+    monkeypatch.setattr(query, "time", SimpleNamespace(monotonic=lambda: now + 470))
+    assert await cache.fetch("s", ("foo", ), 60, failed, stale_ttl=30) == [{"value": 5}]
+    await asyncio.gather(*cache.tasks)
+    assert await cache.fetch("s", ("foo", ), 60, failed, stale_ttl=30) == [{"value": 5}]
+    await cache.close()
+
+    # written tables are not served stale
+    cache.invalidate_table("foo")
+    assert await cache.fetch("s", ("foo", ), 60, partial(loader, 6), stale_ttl=30) == [{"value": 6}]
+
+
+@pytest.mark.asyncio
+async def test_queryset_cached(db_url):
+    await Postmodel.init(db_url, modules=["tests.testmodels"])
+    for model in (Article, Category, Author):
+        await Postmodel.get_mapper(model).delete_table()
+    await Postmodel.generate_schemas()
+    await Foo.all().delete()
+    db = Postmodel.get_database()
+    cache = Postmodel.get_query_cache()
+
+    await Foo.bulk_create([
+        Foo(foo_id=1, name="1", tag="a", memo="one"),
+        Foo(foo_id=2, name="2", tag="a", memo="two"),
+    ])
+    foos = await Foo.filter(tag="a").order_by("foo_id").cached(ttl=60)
+    await db.execute_script("UPDATE single_primary_foo SET memo='behind'")
+    cached = await Foo.filter(tag="a").order_by("foo_id").cached(ttl=60)
+    assert [f.memo for f in cached] == ["one", "two"]
+    # every hit gets own instances
+    assert cached[0] is not foos[0]
+    cached[0].memo = "changed"
+    assert (await Foo.filter(tag="a").order_by("foo_id").cached())[0].memo == "one"
+    assert (await Foo.filter(tag="a").order_by("foo_id").values("memo").cached()) == [
+        {"memo": "behind"}, {"memo": "behind"}]
+    assert (await Foo.filter(tag="a").order_by("foo_id").first()).memo == "behind"
+    assert cache.stats()["hits"] == 2
+
+    # mapper writes invalidate the table
+    foo = await Foo.load(foo_id=1)
+    foo.name = "x"
+    await foo.save()
+    assert [f.memo for f in await Foo.filter(tag="a").order_by("foo_id").cached()] == ["behind", "behind"]
+    await db.execute_script("UPDATE single_primary_foo SET memo='again'")
+    await Foo.create(foo_id=3, name="3", tag="b", memo="three")
+    assert [f.memo for f in await Foo.filter(tag="a").order_by("foo_id").cached()] == ["again", "again"]
+    await db.execute_script("UPDATE single_primary_foo SET memo='3rd'")
+    await Foo.filter(foo_id=3).delete()
+    assert [f.memo for f in await Foo.filter(tag="a").order_by("foo_id").cached()] == ["3rd", "3rd"]
+
+    # transactions do not use cache, commit invalidates
+    async with in_transaction():
+        await Foo.filter(foo_id=1).update(memo="tx")
+        assert (await Foo.filter(foo_id=1).cached())[0].memo == "tx"
+        assert [f.memo for f in await Foo.filter(tag="a").order_by("foo_id").cached()] == ["tx", "3rd"]
+        sql, values = Foo.get_mapper()._get_query_sql(Foo.filter(tag="a").order_by("foo_id"))
+        assert [row["memo"] for row in cache.get(cache.make_key(db.name, sql, values))] == ["3rd", "3rd"]
+    assert [f.memo for f in await Foo.filter(tag="a").order_by("foo_id").cached()] == ["tx", "3rd"]
+
+    # joined tables are invalidated too
+    tom = await Author.create(id=1, name="tom")
+    await Article.create(id=1, title="a1", author=tom)
+    articles = await Article.all().select_related("author").cached()
+    assert articles[0].author.name == "tom"
+    tom.name = "jerry"
+    await tom.save()
+    articles = await Article.all().select_related("author").cached()
+    assert articles[0].author.name == "jerry"
+    articles = await Article.filter(author_id__in=Author.filter(name="jerry").values("id")).cached()
+    assert len(articles) == 1
+    await Author.filter(id=1).update(name="spike")
+    assert await Article.filter(author_id__in=Author.filter(name="jerry").values("id")).cached() == []
+
+    with pytest.raises(ParamsError):
+        Foo.all().cached(ttl=0)
+    with pytest.raises(ParamsError):
+        Foo.all().cached(stale_ttl=-1)
+
+    for model in (Article, Category, Author):
+        await Postmodel.get_mapper(model).delete_table()
+    await Foo.all().delete()
+    await Postmodel.close()
+    assert Postmodel.get_query_cache() is None
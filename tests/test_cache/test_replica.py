@@ -0,0 +1,200 @@
+from tests.testmodels import City, CityVisit, Foo
+from postmodel.sqldb.postgres import PostgresEngine
+from postmodel.sqldb.common import BaseTableSchemaGenerator
+from postmodel.transaction import in_transaction
+from postmodel import Postmodel
+from postmodel.models import Q
+import asyncio
+import datetime
+import pytest
+
+
+async def wait_for(predicate, timeout=3):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+class QueryCounter:
+    def __init__(self, db, monkeypatch):
+        self.count = 0
+        execute_query = db.execute_query
+
+        async def counted(*args, **kwargs):
+            self.count += 1
+            return await execute_query(*args, **kwargs)
+
+        monkeypatch.setattr(db, "execute_query", counted)
+
+
+async def check_local(counter, make_queryset):
+    count = counter.count
+    local = await make_queryset()
+    assert counter.count == count, "query is not answered locally"
+    async with in_transaction():
+        expected = await make_queryset()
+    assert counter.count == count + 1
+    if isinstance(local, list):
+        assert [x if isinstance(x, dict) else x.to_dict() for x in local] == \
+            [x if isinstance(x, dict) else x.to_dict() for x in expected]
+    else:
+        assert (local and local.to_dict()) == (expected and expected.to_dict())
+
+
+def test_replica_trigger_sql():
+    sql = "\n".join(BaseTableSchemaGenerator(City._meta).get_replicate_trigger_sql())
+    assert "CREATE OR REPLACE FUNCTION \"postmodel_replicate_city\"()" in sql
+    assert "json_build_array(OLD.\"id\")" in sql
+    assert "AFTER TRUNCATE ON \"city\" FOR EACH STATEMENT" in sql
+
+
+@pytest.mark.asyncio
+async def test_replica(db_url, monkeypatch):
+    await Postmodel.init(db_url, modules=["tests.testmodels"])
+    for model in (City, CityVisit):
+        await Postmodel.get_mapper(model).delete_table()
+    replica = City.get_mapper().replica
+    assert replica is not None and Foo.get_mapper().replica is None
+    assert not replica.ready
+    await Postmodel.generate_schemas()
+    assert replica.ready and replica.rows == {}
+
+    db = Postmodel.get_database()
+    counter = QueryCounter(db, monkeypatch)
+
+    # own writes are visible at once
+    await City.bulk_create([
+        City(id=i, name=f"c{i}", country="us" if i % 2 else "fr", population=i * 100,
+            founded=datetime.date(1900 + i, 1, 1) if i % 3 else None)
+        for i in range(1, 11)
+    ])
+    assert len(replica.rows) == 10
+    city = await City.create(id=11, name="c11", country="de", population=50)
+    assert replica.rows[11]["name"] == "c11"
+    city.population = 60
+    await city.save()
+    assert replica.rows[11]["population"] == 60
+    await City.filter(country="de").update(population=70)
+    assert replica.rows[11]["population"] == 70
+    await city.delete()
+    assert 11 not in replica.rows
+
+    for make_queryset in [
+        lambda: City.filter(id=3),
+        lambda: City.get_or_none(id=3),
+        lambda: City.get_or_none(id=100),
+        lambda: City.filter(id__in=[1, 5, 100]).order_by("id"),
+        lambda: City.filter(country="us", name="c3"),
+        lambda: City.filter(country="us").order_by("-population"),
+        lambda: City.filter(country__in=["fr"]).order_by("population"),
+        lambda: City.filter(country__not_in=["fr"]).order_by("id"),
+        lambda: City.filter(country__not="fr").order_by("id"),
+        lambda: City.filter(population__gte=300, population__lt=700).order_by("id"),
+        lambda: City.filter(population__gt=300).filter(population__lte=700).order_by("-id"),
+        lambda: City.filter(founded__isnull=True).order_by("id"),
+        lambda: City.filter(founded__not_isnull=True).order_by("-founded", "id"),
+        lambda: City.filter(founded__lt=datetime.date(1905, 1, 1)).order_by("founded"),
+        lambda: City.all().order_by("founded", "id"),
+        lambda: City.all().order_by("-founded", "id").offset(2).limit(3),
+        lambda: City.filter(country="us").order_by("id").first(),
+        lambda: City.filter(country="us").order_by("id").values("id", "name"),
+    ]:
+        await check_local(counter, make_queryset)
+
+    # text order and case folding are answered locally with "C" collation only
+    c_locale = replica.c_locale
+    replica.c_locale = True
+    for make_queryset in [
+        lambda: City.filter(name__gt="c5").order_by("id"),
+        lambda: City.all().order_by("name"),
+        lambda: City.filter(Q(name__startswith="c1") | ~Q(population__lt=900)).order_by("id"),
+        lambda: City.filter(name__iexact="C7"),
+    ]:
+        await check_local(counter, make_queryset)
+    replica.c_locale = False
+    count = counter.count
+    assert len(await City.filter(name__gt="c5")) == 4
+    assert len(await City.all().order_by("name")) == 10
+    assert len(await City.filter(name__icontains="C1")) == 2
+    assert len(await City.filter(name__startswith="c1")) == 2
+    assert counter.count == count + 3
+    replica.c_locale = c_locale
+
+    # composite primary key
+    await CityVisit.create(city_id=1, day=1, visitors=3)
+    await CityVisit.bulk_create([CityVisit(city_id=1, day=2), CityVisit(city_id=2, day=1)])
+    visit_replica = CityVisit.get_mapper().replica
+    assert sorted(visit_replica.rows.keys()) == [(1, 1), (1, 2), (2, 1)]
+    await check_local(counter, lambda: CityVisit.filter(city_id=1, day=1))
+    await check_local(counter, lambda: CityVisit.filter(city_id=1).order_by("day"))
+    await CityVisit.filter(city_id=1).delete()
+    assert list(visit_replica.rows.keys()) == [(2, 1)]
+
+    # changes made by others come from trigger notifications
+    await db.execute_script("UPDATE city SET population = 1 WHERE id = 2; DELETE FROM city WHERE id = 3;"
+        "INSERT INTO city (id, name, country, population) VALUES (20, 'c20', 'us', 2000)")
+    assert await wait_for(lambda: 3 not in replica.rows and 20 in replica.rows)
+    assert await wait_for(lambda: replica.rows[2]["population"] == 1)
+    await check_local(counter, lambda: City.filter(population__lte=100).order_by("id"))
+    await db.execute_script("UPDATE city SET id = 21 WHERE id = 20")
+    assert await wait_for(lambda: 21 in replica.rows and 20 not in replica.rows)
+    await db.execute_script("TRUNCATE city")
+    assert await wait_for(lambda: replica.ready and not replica.rows)
+    await db.execute_script("INSERT INTO city (id, name, country, population) VALUES (1, 'c1', 'us', 1)")
+    assert await wait_for(lambda: 1 in replica.rows)
+
+    # lost listener connection reloads the table
+    _, config, parameters = Postmodel._parse_db_url(db_url)
+    other_db = PostgresEngine("other", config, parameters)
+    await other_db.init()
+    listener = db._listener
+    await other_db.execute_script(
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+        f"WHERE pid = {listener.get_server_pid()}")
+    await other_db.execute_script("INSERT INTO city (id, name, country, population) VALUES (2, 'c2', 'us', 2)")
+    assert await wait_for(lambda: db._listener not in (None, listener) and 2 in replica.rows)
+    await other_db.close()
+
+    # dropped table is not answered locally
+    await Postmodel.get_mapper(City).delete_table()
+    assert not replica.ready
+    count = counter.count
+    with pytest.raises(Exception):
+        await City.filter(id=1)
+    assert counter.count == count + 1
+
+    await Postmodel.get_mapper(CityVisit).delete_table()
+    await Postmodel.close()
+
+
+@pytest.mark.asyncio
+async def test_replica_changed_while_loading(db_url, monkeypatch):
+    await Postmodel.init(db_url, modules=["tests.testmodels"])
+    await Postmodel.get_mapper(City).delete_table()
+    await Postmodel.generate_schemas()
+    replica = City.get_mapper().replica
+    db = Postmodel.get_database()
+    await City.create(id=1, name="c1", country="us", population=1)
+    assert replica.rows[1]["population"] == 1
+
+    # a row changes after the snapshot of the table, and its notification
+    # arrives before the load is done
+    execute_query = db.execute_query
+
+    async def slow_load(query, *args):
+        result = await execute_query(query, *args)
+        if query == replica.load_sql:
+            await db.execute_script("UPDATE city SET population = 2 WHERE id = 1")
+            assert await wait_for(lambda: 1 in replica.pending)
+        return result
+
+    monkeypatch.setattr(db, "execute_query", slow_load)
+    assert await replica.load()
+    monkeypatch.setattr(db, "execute_query", execute_query)
+    assert replica.ready and not replica.pending
+    assert replica.rows[1]["population"] == 2
+
+    await Postmodel.get_mapper(City).delete_table()
+    await Postmodel.close()
@@ -0,0 +1,99 @@
+from tests.testmodels import Foo, Author, Article, Category
+from postmodel.identity import identity_map, with_identity_map
+from postmodel.transaction import in_transaction
+from postmodel.sqldb.base import current_identity_map
+from postmodel import Postmodel
+import pytest
+
+
+@with_identity_map
+async def load_twice(foo_id):
+    return await Foo.load(foo_id=foo_id), await Foo.load(foo_id=foo_id)
+
+
+@pytest.mark.asyncio
+async def test_identity_map(db_url):
+    await Postmodel.init(db_url, modules=["tests.testmodels"])
+    await Postmodel.generate_schemas()
+    await Foo.all().delete()
+    await Foo.bulk_create([
+        Foo(foo_id=1, name="1", tag="a", memo="one"),
+        Foo(foo_id=2, name="2", tag="b", memo="two"),
+    ])
+
+    a = await Foo.load(foo_id=1)
+    b = await Foo.load(foo_id=1)
+    assert a is not b
+    assert current_identity_map.get() is None
+
+    async with identity_map() as imap:
+        a = await Foo.load(foo_id=1)
+        b = await Foo.get(foo_id=1)
+        assert a is b
+        foos = await Foo.all().order_by("foo_id")
+        assert foos[0] is a
+        assert len(imap) == 2
+
+        # loads by primary key are answered from the map
+        db = Postmodel.get_database()
+        await db.execute_script("DELETE FROM single_primary_foo WHERE foo_id = 2")
+        assert (await Foo.load(foo_id=2)) is foos[1]
+        assert (await Foo.filter(foo_id=2)) == [foos[1]]
+        assert await Foo.filter(foo_id=2, name="2").first() is None
+
+        async with identity_map() as inner:
+            assert inner is imap
+            assert (await Foo.load(foo_id=1)) is a
+
+        c = Foo(foo_id=3, name="3", tag="c", memo="three")
+        await c.save()
+        assert (await Foo.load(foo_id=3)) is c
+        await c.delete()
+        assert await Foo.get_or_none(foo_id=3) is None
+
+        await Foo.filter(foo_id=1).update(memo="updated")
+        assert len(imap) == 0
+        a2 = await Foo.load(foo_id=1)
+        assert a2 is not a
+        assert a2.memo == "updated"
+
+    assert current_identity_map.get() is None
+    assert len(imap) == 0
+
+    a, b = await load_twice(1)
+    assert a is b
+
+    async with in_transaction():
+        async with identity_map():
+            a = await Foo.filter(foo_id=1).select_for_update().first()
+            await db.execute_script("UPDATE single_primary_foo SET memo='raw' WHERE foo_id=1")
+            b = await Foo.filter(foo_id=1).select_for_update().first()
+            assert a is b
+            assert a.memo == "raw"
+
+    await Foo.all().delete()
+    await Postmodel.close()
+
+
+@pytest.mark.asyncio
+async def test_identity_map_related(db_url):
+    await Postmodel.init(db_url, modules=["tests.testmodels"])
+    for model in (Article, Category, Author):
+        await Postmodel.get_mapper(model).delete_table()
+    await Postmodel.generate_schemas()
+
+    tom = await Author.create(id=1, name="tom")
+    await Article.bulk_create([
+        Article(id=1, title="a1", author=tom),
+        Article(id=2, title="a2", author=tom),
+    ])
+
+    async with identity_map():
+        author = await Author.load(id=1)
+        articles = await Article.all().order_by("id").select_related("author")
+        assert articles[0].author is author
+        assert articles[1].author is author
+
+    for model in (Article, Category, Author):
+        await Postmodel.get_mapper(model).delete_table()
+    await Postmodel.close()
@@ -0,0 +1,239 @@
+from tests.testmodels import EvaluatorSample, Foo
+from postmodel.models import Q, compile_predicate
+from postmodel.models.evaluator import evaluator, json_text, sql_text, like_regex
+from postmodel.exceptions import FieldError, OperationalError, ParamsError
+from postmodel import Postmodel
+from decimal import Decimal
+import datetime
+import random
+import uuid
+import pytest
+
+
+NAMES = ["alpha", "Alpha", "ALPHA", "beta", "a_b", "axb", "50%", "500", "é", "É", "éa",
+    "", " ", "line\nbreak", "back\\slash", "zeta"]
+UUIDS = [uuid.UUID(int=i * 7919) for i in range(4)]
+RATIOS = [0.0, -0.0, 1.5, -2.25, 0.1, 1e20, 1e-5, 123456789012345.0, float("nan"), float("inf")]
+DATA = [
+    {"n": 1, "s": "abc", "tags": ["a", "b"], "flag": True, "nested": {"x": 1}},
+    {"n": 2.5, "s": "ab\"c", "tags": [], "nested": {"x": 5, "y": [1, 2]}},
+    {"n": -3, "s": "Zoo", "tags": ["c"], "flag": False},
+    {"s": "e\u0001", "tags": ["a"], "extra": None},
+    {"n": 10, "tags": ["b", "a"], "nested": {"x": -1}},
+    {"n": 1.0, "s": "abc"},
+    ["a", "b", 1, [3]],
+    [],
+    {},
+    {"n": 100000000000000000000, "s": "100", "flag": True, "tags": ["a", "d"]},
+]
+
+
+def make_samples():
+    rng = random.Random(3)
+
+    def maybe(value):
+        return None if rng.random() < 0.2 else value
+
+    samples = []
+    for i in range(60):
+        samples.append(EvaluatorSample(
+            id=i + 1,
+            name=maybe(rng.choice(NAMES)),
+            amount=maybe(rng.randint(-5, 120)),
+            ratio=maybe(rng.choice(RATIOS)),
+            price=maybe(Decimal(rng.randint(-500, 5000)) / 100),
+            day=maybe(datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randint(0, 60))),
+            at=maybe(datetime.datetime(2020, 1, 1, 12) + datetime.timedelta(
+                seconds=rng.randint(0, 100000), microseconds=rng.choice([0, 500000, 123456, 10]))),
+            flag=maybe(rng.random() < 0.5),
+            uid=maybe(rng.choice(UUIDS)),
+            span=maybe(datetime.timedelta(seconds=rng.randint(0, 100))),
+            data=maybe(rng.choice(DATA)),
+        ))
+    return samples
+
+
+def leaf_filters(rng):
+    name = rng.choice(NAMES)
+    return rng.choice([
+        {"name": name},
+        {"name__not": name},
+        {"name__in": rng.sample(NAMES, 3)},
+        {"name__in": [name, None]},
+        {"name__in": []},
+        {"name__not_in": rng.sample(NAMES, 2)},
+        {"name__not_in": [name, None]},
+        {"name__not_in": []},
+        {"name__isnull": rng.random() < 0.5},
+        {"name__not_isnull": rng.random() < 0.5},
+        {"name__gt": name},
+        {"name__lte": name},
+        {"name__contains": rng.choice(["a", "_", "%", "\\", "lph", "é", "\n"])},
+        {"name__startswith": rng.choice(["a", "A", "5", "a_", "é", ""])},
+        {"name__endswith": rng.choice(["a", "%", "0", "A"])},
+        {"name__iexact": rng.choice(["ALPHA", "é", "É", "ÉA"])},
+        {"name__icontains": rng.choice(["LP", "éA", "b"])},
+        {"name__istartswith": rng.choice(["a", "É"])},
+        {"name__iendswith": rng.choice(["HA", "B"])},
+        {"amount": rng.randint(-5, 120)},
+        {"amount__not": rng.randint(-5, 120)},
+        {"amount__in": [rng.randint(-5, 120) for _ in range(20)]},
+        {"amount__gte": rng.randint(-5, 120)},
+        {"amount__lt": rng.randint(-5, 120)},
+        {"amount__contains": str(rng.randint(0, 9))},
+        {"amount__startswith": "-"},
+        {"ratio": rng.choice(RATIOS)},
+        {"ratio__not": rng.choice(RATIOS)},
+        {"ratio__gt": rng.choice(RATIOS)},
+        {"ratio__lte": rng.choice(RATIOS)},
+        {"ratio__contains": rng.choice(["e", ".", "0", "N", "-"])},
+        {"price": Decimal(rng.randint(-500, 5000)) / 100},
+        {"price__gte": rng.randint(-5, 50)},
+        {"price__lt": rng.choice([Decimal("10.5"), 10.5, 0])},
+        {"price__contains": rng.choice([".5", ".00", "-"])},
+        {"price__endswith": "0"},
+        {"day": datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randint(0, 60))},
+        {"day__gt": datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randint(0, 60))},
+        {"day__contains": "-01"},
+        {"at__gt": datetime.datetime(2020, 1, 2)},
+        {"at__contains": rng.choice([".5", ".12", ":00", "2020-01-02"])},
+        {"flag": rng.random() < 0.5},
+        {"flag__not": rng.random() < 0.5},
+        {"flag__contains": "ru"},
+        {"flag__iexact": "TRUE"},
+        {"uid": rng.choice(UUIDS)},
+        {"uid__startswith": "0000"},
+        {"span__contains": "000"},
+        {"data": rng.choice(DATA)},
+        {"data.n": rng.choice([1, 2.5, 10, -3])},
+        {"data.n__gt": rng.choice([0, 1, 2.5, 1e20])},
+        {"data.n__lte": rng.choice([1, -3])},
+        {"data.s": rng.choice(["abc", "Zoo", "ab\"c", "e\u0001"])},
+        {"data.s__not": "abc"},
+        {"data.s__startswith": rng.choice(["a", "Z", "é"])},
+        {"data.s__endswith": rng.choice(["c", "o"])},
+        {"data.flag": rng.random() < 0.5},
+        {"data.flag__not": True},
+        {"data.nested": {"x": 1}},
+        {"data.nested.x__gte": rng.randint(-1, 5)},
+        {"data.nested.y.1": 2},
+        {"data.nested.y.-1": 2},
+        {"data.tags.0": rng.choice(["a", "b", "c"])},
+        {"data.tags": rng.choice([["a", "b"], [], ["b", "a"]])},
+        {"data.tags__gt": ["a"]},
+        {"data.nested__lt": {"x": 2}},
+        {"data__gte": rng.choice(DATA)},
+        {"data__has_key": rng.choice(["n", "a", "tags", "extra"])},
+        {"data__has_keys": rng.choice([["n", "s"], ["a", "b"]])},
+        {"data__has_anykeys": ["flag", "a"]},
+        {"data__contains": rng.choice([{"n": 1}, {"tags": ["a"]}, ["a"], [3], {"nested": {"x": 1}}])},
+        {"data__in": rng.choice([{"n": 1, "s": "abc", "flag": True}, ["a", "b", 1, [3], "c"], {}])},
+        {"data.tags__contains": ["a"]},
+        {"data.tags__in": ["a", "b"]},
+    ])
+
+
+def random_expression(rng, depth=0):
+    if depth >= 2 or rng.random() < 0.4:
+        filters = leaf_filters(rng)
+        if rng.random() < 0.3:
+            filters.update(leaf_filters(rng))
+            expression = Q(**filters, join_type=rng.choice([Q.AND, Q.OR]))
+        else:
+            expression = Q(**filters)
+    else:
+        children = [random_expression(rng, depth + 1) for _ in range(rng.randint(1, 3))]
+        expression = Q(*children, join_type=rng.choice([Q.AND, Q.OR]))
+    if rng.random() < 0.3:
+        expression = ~expression
+    return expression
+
+
+def test_sql_text():
+    field = EvaluatorSample._meta.fields_map
+    assert sql_text(field["ratio"], 1e20) == "1e+20"
+    assert sql_text(field["ratio"], 1e-5) == "1e-05"
+    assert sql_text(field["ratio"], 0.1) == "0.1"
+    assert sql_text(field["ratio"], 123456789012345.0) == "123456789012345"
+    assert sql_text(field["ratio"], -0.0) == "-0"
+    assert sql_text(field["price"], Decimal("1.5")) == "1.50"
+    assert sql_text(field["at"], datetime.datetime(2020, 1, 1, 1, 2, 3, 500000)) == "2020-01-01 01:02:03.5"
+    assert sql_text(field["span"], datetime.timedelta(seconds=1)) == "1000000"
+    assert sql_text(field["flag"], False) == "false"
+    assert json_text({"b": 1.50, "aa": [1, None, "\n"], "a": True}) == \
+        '{"a": true, "b": 1.5, "aa": [1, null, "\\n"]}'
+    assert like_regex("a\\%_%").fullmatch("a%bcd")
+    assert not like_regex("a\\%_%").fullmatch("abcd")
+
+
+def test_predicate():
+    samples = make_samples()
+    predicate = compile_predicate(EvaluatorSample, Q(amount__gte=50), Q(name__isnull=False))
+    assert predicate.filter(samples) == [
+        s for s in samples if s.amount is not None and s.amount >= 50 and s.name is not None]
+    assert predicate.evaluate(EvaluatorSample(amount=None, name="a")) is None
+    assert predicate.evaluate(EvaluatorSample(amount=1, name="a")) is False
+    assert not predicate(EvaluatorSample(amount=None, name="a"))
+    assert not predicate.collation_sensitive
+    assert compile_predicate(EvaluatorSample, Q(name__istartswith="a")).collation_sensitive
+    assert compile_predicate(EvaluatorSample).filter(samples) == samples
+    assert compile_predicate(EvaluatorSample, Q(), ~Q()).filter(samples) == samples
+
+    # compiled once by shape, bound to values of each call
+    size = len(evaluator.compiled)
+    for i in range(10):
+        assert compile_predicate(EvaluatorSample, Q(amount__lt=i) | Q(name=str(i))) is not None
+    assert len(evaluator.compiled) == size + 1
+
+    columns = {"amount": [1, None, 70], "name": ["a", "b", None]}
+    assert predicate.filter_columns(columns) == []
+    assert compile_predicate(EvaluatorSample, Q(amount__gte=1)).filter_columns(columns) == [0, 2]
+    assert compile_predicate(EvaluatorSample, ~Q(amount__gte=1)).filter_rows(
+        [{"amount": 1}, {"amount": None}, {"amount": 0}]) == [{"amount": 0}]
+    assert EvaluatorSample.filter(amount__in=[1, 2]).match(samples) == [
+        s for s in samples if s.amount in (1, 2)]
+
+    with pytest.raises(FieldError):
+        compile_predicate(EvaluatorSample, Q(unknown=1))
+    with pytest.raises(FieldError):
+        compile_predicate(EvaluatorSample, Q(data__unknown=1))
+    with pytest.raises(ParamsError):
+        compile_predicate(EvaluatorSample, Q(amount="x"))
+    with pytest.raises(ParamsError):
+        compile_predicate(EvaluatorSample, Q(data__has_keys="a"))
+    with pytest.raises(OperationalError):
+        compile_predicate(EvaluatorSample, Q(amount__in=Foo.filter(name="a").values("foo_id")))
+    with pytest.raises(OperationalError):
+        compile_predicate(EvaluatorSample, Q(**{"data.s__gt": 1})).filter(
+            [EvaluatorSample(data={"s": "a"})])
+
+
+@pytest.mark.asyncio
+async def test_evaluator_against_database(db_url):
+    await Postmodel.init(db_url, modules=["tests.testmodels"])
+    await EvaluatorSample.get_mapper().delete_table()
+    await Postmodel.generate_schemas()
+    await EvaluatorSample.bulk_create(make_samples())
+    samples = await EvaluatorSample.all().order_by("id")
+    assert len(samples) == 60
+
+    async def check(*expressions):
+        expected = [row["id"] for row in
+            await EvaluatorSample.filter(*expressions).order_by("id").values("id")]
+        local = [s.id for s in compile_predicate(EvaluatorSample, *expressions).filter(samples)]
+        assert local == expected, expressions
+
+    rng = random.Random(7)
+    for _ in range(80):
+        await check(Q(**leaf_filters(rng)))
+    for _ in range(300):
+        await check(*[random_expression(rng) for _ in range(rng.randint(1, 2))])
+
+    # postgres fails to cast the same json values
+    with pytest.raises(Exception):
+        await EvaluatorSample.filter(**{"data.s__gt": 1})
+    with pytest.raises(OperationalError):
+        compile_predicate(EvaluatorSample, Q(**{"data.s__gt": 1})).filter(samples)
+
+    await EvaluatorSample.get_mapper().delete_table()
+    await Postmodel.close()
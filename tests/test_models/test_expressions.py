@@ -0,0 +1,32 @@
+
+from postmodel.models import F
+from postmodel.models.expressions import CombinedExpression
+from postmodel.sqldb.common import ExpressionResolve
+from postmodel.exceptions import FieldError
+from tests.testmodels import Counter
+from pypika import Table
+import pytest
+
+def test_expressions_1():
+    expr = F("count") + 1
+    assert isinstance(expr, CombinedExpression)
+    assert expr.left.name == "count"
+    assert expr.connector == "+"
+    assert expr.right == 1
+
+    expr = 2 * F("count")
+    assert expr.left == 2
+    assert expr.connector == "*"
+    assert expr.right.name == "count"
+
+def test_expression_resolve():
+    table = Table("counter")
+    er = ExpressionResolve(table, Counter._meta.fields_db_projection)
+    term, values = er.resolve((F("count") + 1) * F("balance") - 3, 2)
+    assert term.get_sql(quote_char='"') == '("count"+$3)*"balance"-$4'
+    assert values == [1, 3]
+    assert er.is_expression(F("count"))
+    assert not er.is_expression(1)
+
+    with pytest.raises(FieldError):
+        er.resolve(F("unknown") + 1, 0)
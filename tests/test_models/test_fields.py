@@ -11,7 +11,10 @@ from tests.testmodels import (
     DateFieldsModel,
     TimeDeltaFieldsModel,
     JSONFieldsModel,
-    UUIDFieldsModel
+    UUIDFieldsModel,
+    Author,
+    Article,
+    Category
 )
 
 from postmodel.models.fields import (
@@ -19,10 +22,11 @@ from postmodel.models.fields import (
     CharField,
     DecimalField,
     DatetimeField,
-    UUIDField
+    UUIDField,
+    ForeignKeyField
 )
 
-from postmodel.exceptions import ConfigurationError, FieldValueError
+from postmodel.exceptions import ConfigurationError, FieldValueError, NoValuesFetched
 
 def test_int_field():
     model = IntFieldsModel(id=1, intnum=10)
@@ -129,4 +133,39 @@ def test_binary_field():
     assert f.to_db_value(b'hello') == bytes('hello', 'ascii')
     assert f.to_db_value('hello') == bytes('hello', 'ascii')
     with pytest.raises(FieldValueError):
-        assert f.to_db_value(10)
\ No newline at end of file
+        assert f.to_db_value(10)
+
+def test_foreign_key_field():
+    fields_map = Article._meta.fields_map
+    author_field = fields_map['author_id']
+    assert author_field.relation_name == 'author'
+    assert author_field.related_model == Author
+    assert author_field.type == int
+    assert author_field.to_db_value('3') == 3
+    assert Article._meta.fk_fields['editor'] is fields_map['editor_id']
+    assert Category._meta.fk_fields['parent'].related_model == Category
+
+    author = Author(id=1, name="tom")
+    article = Article(id=1, title="hello", author=author)
+    assert article.author_id == 1
+    assert article.author is author
+    assert article.editor is None
+
+    article.author_id = 2
+    with pytest.raises(NoValuesFetched):
+        article.author
+    article.author = None
+    assert article.author_id is None
+    with pytest.raises(FieldValueError):
+        article.author = Category(name="wrong")
+
+    article = Article(id=2, title="hello", author_id=1)
+    with pytest.raises(NoValuesFetched):
+        article.author
+
+    with pytest.raises(ConfigurationError):
+        ForeignKeyField(Author, on_delete="DROP")
+    with pytest.raises(ConfigurationError):
+        ForeignKeyField(Author, on_delete="SET NULL")
+    with pytest.raises(ConfigurationError):
+        ForeignKeyField("Author")
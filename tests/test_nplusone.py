@@ -0,0 +1,60 @@
+
+from postmodel import Postmodel
+from postmodel import models
+from postmodel.exceptions import NPlusOneError
+from postmodel.ext.pytest_plugin import nplusone
+from postmodel.nplusone import detect_nplusone, NPlusOneWarning
+import pytest
+
+
+class LoopedNote(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "looped_note"
+
+
+async def setup_notes(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    await Postmodel.get_mapper(LoopedNote).delete_table()
+    await Postmodel.generate_schemas()
+    await LoopedNote.bulk_create([LoopedNote(id=i, name=str(i)) for i in range(10)])
+
+
+async def teardown_notes():
+    await Postmodel.get_mapper(LoopedNote).delete_table()
+    await Postmodel.close()
+
+
+@pytest.mark.asyncio
+async def test_detect_nplusone(db_url):
+    await setup_notes(db_url)
+    async with detect_nplusone(threshold=3) as detector:
+        # the same parameters and queries in one go are fine
+        for _ in range(5):
+            await LoopedNote.get(id=1)
+        assert len(await LoopedNote.filter(id__in=list(range(10)))) == 10
+        assert detector.reports == []
+
+        with pytest.warns(NPlusOneWarning, match="LoopedNote queried with 4 different parameters") as record:
+            for i in range(6):
+                await LoopedNote.get(id=i)
+        assert len(record) == 1
+        assert record[0].filename == __file__
+        assert detector.reports == [("LoopedNote",
+            'SELECT "id","name" FROM "looped_note" WHERE "id"=? LIMIT ?', __file__, record[0].lineno)]
+
+    for i in range(6):
+        await LoopedNote.get(id=i)
+    await teardown_notes()
+
+
+@pytest.mark.asyncio
+async def test_nplusone_fixture(db_url, nplusone):
+    await setup_notes(db_url)
+    nplusone.threshold = 2
+    with pytest.raises(NPlusOneError, match="test_nplusone.py"):
+        for i in range(5):
+            await LoopedNote.filter(name=str(i)).first()
+    await teardown_notes()
@@ -0,0 +1,104 @@
+
+from postmodel import Postmodel
+from postmodel import models
+from postmodel.router import DatabaseRouter
+import pytest
+
+
+def archived_filter(expressions):
+    for expr in expressions:
+        if "archived" in expr.filters:
+            return expr.filters["archived"]
+    return None
+
+
+class ArchiveRouter(DatabaseRouter):
+    def db_for_read(self, model_class, queryset):
+        expressions = getattr(queryset, "expressions", None)
+        if expressions is None:
+            expressions = queryset._expressions
+        return "archive" if archived_filter(expressions) else None
+
+    def db_for_write(self, model_class, instance):
+        if instance is None:
+            return None
+        if isinstance(instance, model_class):
+            return "archive" if instance.archived else None
+        return "archive" if archived_filter(instance.expressions) else None
+
+
+class ReportRouter(DatabaseRouter):
+    cache_by_shape = True
+
+    def __init__(self):
+        self.calls = 0
+
+    def db_for_read(self, model_class, queryset):
+        self.calls += 1
+        if getattr(queryset, "_values_fields", None):
+            return "archive"
+        return None
+
+
+class Item(models.Model):
+    id = models.IntField(pk=True)
+    archived = models.BooleanField(default=False)
+
+    class Meta:
+        table = "router_item"
+
+
+class Report(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=32)
+
+    class Meta:
+        table = "router_report"
+        router = ReportRouter()
+
+
+async def ids(db_name, table):
+    rows = await Postmodel.get_database(db_name).execute_query_dict(f"SELECT id FROM {table} ORDER BY id")
+    return [row["id"] for row in rows]
+
+
+@pytest.mark.asyncio
+async def test_router(db_url, db_url2):
+    await Postmodel.init(db_url, extra_db_urls={"archive": db_url2}, modules=[__name__],
+        router=ArchiveRouter())
+    for db_name in ("default", "archive"):
+        for model in (Item, Report):
+            mapper = Postmodel.get_mapper(model, db_name)
+            await mapper.delete_table()
+            await mapper.create_table()
+
+    await Item.create(id=1)
+    await Item.create(id=2, archived=True)
+    assert await ids("default", "router_item") == [1]
+    assert await ids("archive", "router_item") == [2]
+    assert [i.id for i in await Item.filter(archived=True)] == [2]
+    assert [i.id for i in await Item.all()] == [1]
+    assert await Item.filter(archived=True).count() == 1
+    assert await Item.filter(archived=True).update(archived=True) == 1
+    item = await Item.get(id=2, archived=True)
+    await item.delete()
+    assert await ids("archive", "router_item") == []
+    # explicit database is not routed
+    assert [i.id for i in await Item.all().using_db("archive")] == []
+    assert await Item.filter(archived=False).delete() == 1
+
+    # decisions of routers with cache_by_shape are cached by query shape
+    router = Report._meta.router
+    await Report.create(id=1, name="live")
+    await Postmodel.get_database("archive").execute_script(
+        "INSERT INTO router_report (id, name) VALUES (1, 'archived')")
+    for i in range(3):
+        assert (await Report.get(id=1)).name == "live"
+        assert await Report.filter(id=i).values("name") == ([{"name": "archived"}] if i == 1 else [])
+    assert router.calls == 2
+
+    for db_name in ("default", "archive"):
+        for model in (Item, Report):
+            await Postmodel.get_mapper(model, db_name).delete_table()
+    await Postmodel.close()
+    assert Postmodel._router is None
@@ -49,6 +49,23 @@ def test_table_create_schema_2():
     print(create_sql)
     assert 'PRIMARY KEY (foo_id, name)' in create_sql
 
+class Owner(models.Model):
+    id = models.AutoField()
+    name = models.CharField(max_length=64)
+
+class Pet(models.Model):
+    id = models.IntField(pk=True)
+    owner = models.ForeignKeyField(Owner, on_delete="RESTRICT")
+    class Meta:
+        table = "pet"
+
+def test_table_create_schema_foreign_key():
+    sg = BaseTableSchemaGenerator(Pet._meta)
+    create_sql = sg.get_create_schema_sql()
+    assert '"owner_id" BIGINT NOT NULL' in create_sql
+    assert 'FOREIGN KEY ("owner_id") REFERENCES "owner" ("id") ON DELETE RESTRICT' in create_sql
+    assert 'ON "pet" ("owner_id");' in create_sql
+
 def test_function_resolve():
     table = Table('test_func_table')
     tc = CastFunction('field_a')
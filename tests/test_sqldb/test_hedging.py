@@ -0,0 +1,147 @@
+
+from postmodel import Postmodel
+from postmodel import models
+from postmodel.sqldb.hedging import HedgedReads
+from postmodel.sqldb.stages import QueryTiming, current_query_timing
+from postmodel.transaction import in_transaction
+import asyncio
+import pytest
+
+
+class HedgedNote(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "hedged_note"
+
+
+def host(result, delay=0, error=None, log=None):
+    async def read():
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            log.append(f"{result} cancelled")
+            raise
+        if error is not None:
+            raise error
+        return result
+    return read
+
+
+async def first_answer(hedged, *calls):
+    # reads start on hosts in turn, start on the first one here
+    hedged.turn = 0
+    result = await hedged.run(list(calls))
+    await asyncio.sleep(0)
+    return result
+
+
+@pytest.mark.asyncio
+async def test_hedged_reads():
+    hedged = HedgedReads(percentile=90, budget=1, min_delay=0.01, min_samples=5)
+    log = []
+    # not hedged before latencies are known
+    assert await first_answer(hedged, host("a", delay=0.05), host("b")) == "a"
+    assert hedged.hedge_delay() is None
+    hedged.latencies.extend([0.001] * 10)
+    assert hedged.hedge_delay() == 0.01
+
+    assert await first_answer(hedged, host("a", delay=5, log=log), host("b", log=log)) == "b"
+    assert log == ["a cancelled"]
+    assert hedged.stats() == {"reads": 2, "hedged": 1, "hedge_wins": 1, "delay": 0.01}
+
+    # answers in time are not hedged
+    assert await first_answer(hedged, host("c"), host("d")) == "c"
+    assert hedged.hedged == 1
+    hedged.turn = 1
+    assert await hedged.run([host("e"), host("f")]) == "f"
+
+    # the budget limits extra reads
+    hedged.budget = 0
+    hedged.tokens = 0
+    assert await first_answer(hedged, host("g", delay=0.05), host("h")) == "g"
+    assert hedged.hedged == 1
+
+    # failed read waits for the other one, errors are raised if both fail
+    hedged.budget = 1
+    assert await first_answer(hedged, host("k", delay=0.05, error=ValueError()), host("l", delay=0.1)) == "l"
+    with pytest.raises(ValueError):
+        await first_answer(hedged, host("m", error=ValueError()), host("n"))
+    with pytest.raises(ValueError):
+        await first_answer(hedged, host("m", delay=0.05, error=KeyError()), host("n", error=ValueError()))
+
+
+@pytest.mark.asyncio
+async def test_hedged_engine(db_url):
+    await Postmodel.init(db_url + "&hedge_hosts=localhost:5432,127.0.0.1&hedge_budget=0.5",
+        modules=[__name__], read_your_writes=0.05)
+    db = Postmodel.get_database()
+    assert db.hedge_hosts == [("localhost", 5432), ("127.0.0.1", 5432)]
+    assert db.hedged_reads.budget == 0.5
+    mapper = Postmodel.get_mapper(HedgedNote)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+
+    hosts = []
+    run = db.hedged_reads.run
+    async def run_calls(calls):
+        hosts.append(len(calls))
+        return await run(calls)
+    db.hedged_reads.run = run_calls
+
+    # reads after a write of the same context go to primary
+    await HedgedNote.create(id=1, name="a")
+    assert (await HedgedNote.get(id=1)).name == "a"
+    assert db.hedged_reads.reads == 0
+    await asyncio.sleep(0.1)
+    assert (await HedgedNote.get(id=1)).name == "a"
+    assert await HedgedNote.all().count() == 1
+    assert db.hedged_reads.reads == 2
+    # primary is one of the hosts
+    assert hosts == [3, 3]
+    async with in_transaction():
+        assert (await HedgedNote.get(id=1)).name == "a"
+    # query cache is filled from primary
+    assert len(await HedgedNote.filter(id=1).cached(ttl=10)) == 1
+    assert db.hedged_reads.reads == 2
+
+    await mapper.delete_table()
+    await Postmodel.close()
+    assert db._hedge_pools == []
+
+
+class RecordedTiming(QueryTiming):
+    __slots__ = ('added',)
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.added = []
+
+    def add(self, stage, seconds):
+        self.added.append(stage)
+        super().add(stage, seconds)
+
+
+@pytest.mark.asyncio
+async def test_hedged_stages(db_url):
+    await Postmodel.init(db_url + "&hedge_hosts=127.0.0.1", modules=[__name__])
+    db = Postmodel.get_database()
+    hedged = db.hedged_reads
+    hedged.latencies.extend([0.001] * hedged.min_samples)
+    hedged.min_delay = 0.01
+    hedged.tokens = hedged.burst
+
+    # stages of the losing read are not added
+    timing = RecordedTiming("HedgedNote")
+    token = current_query_timing.set(timing)
+    try:
+        _, rows = await db.execute_read("SELECT pg_sleep(0.1) AS slept")
+    finally:
+        current_query_timing.reset(token)
+    assert len(rows) == 1
+    assert hedged.hedged == 1
+    assert timing.added.count("acquire") == 1
+    assert timing.added.count("execute") == 1
+    assert 0.05 < timing.stages["execute"] < 0.2
+    await Postmodel.close()
@@ -0,0 +1,97 @@
+
+from postmodel import Postmodel
+from postmodel import models
+from postmodel.exceptions import IntegrityError
+from postmodel.sqldb.hooks import QueryHook, SlowQueryLog, fingerprint
+from postmodel.transaction import in_transaction
+import pytest
+
+
+class HookedNote(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "hooked_note"
+
+
+class RecordingHook(QueryHook):
+    def __init__(self):
+        self.before = []
+        self.after = []
+
+    async def before_query(self, event):
+        assert event.duration is None
+        self.before.append(event.sql)
+
+    async def after_query(self, event):
+        self.after.append((event.operation, event.fingerprint, event.params, event.rows,
+            event.in_transaction, type(event.error).__name__ if event.error else None))
+        assert event.db_name == "default"
+        assert event.duration >= 0
+
+
+def test_fingerprint():
+    assert fingerprint('SELECT "id" FROM "t1"  WHERE "id"=$1 AND "name"=\'it\'\'s\' LIMIT 10') == \
+        'SELECT "id" FROM "t1" WHERE "id"=? AND "name"=? LIMIT ?'
+    assert fingerprint('SELECT 1 FROM "t" WHERE "id" IN ($1,$2,$3)') == \
+        fingerprint('SELECT 1 FROM "t" WHERE "id" IN ($1, $2)') == 'SELECT ? FROM "t" WHERE "id" IN (...)'
+
+
+@pytest.mark.asyncio
+async def test_query_hooks(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    mapper = Postmodel.get_mapper(HookedNote)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+    db = Postmodel.get_database()
+    assert db.query_hooks == []
+
+    hook = RecordingHook()
+    Postmodel.add_query_hook(hook)
+    Postmodel.add_query_hook(hook)
+    await HookedNote.create(id=1, name="a")
+    await HookedNote.get(id=1)
+    with pytest.raises(IntegrityError):
+        await HookedNote.create(id=1, name="b")
+    async with in_transaction():
+        await HookedNote.filter(id__in=[1, 2]).update(name="c")
+    assert len(hook.before) == 4
+    assert hook.after == [
+        ("insert", 'INSERT INTO "hooked_note" ("id","name") VALUES (...)', 2, 1, False, None),
+        ("query", 'SELECT "id","name" FROM "hooked_note" WHERE "id"=? LIMIT ?', 1, 1, False, None),
+        ("insert", 'INSERT INTO "hooked_note" ("id","name") VALUES (...)', 2, None, False,
+            "UniqueViolationError"),
+        ("update", 'UPDATE "hooked_note" SET "name"=? WHERE "id" = ANY(?::bigint[])', 2, 1, True, None),
+    ]
+
+    Postmodel.remove_query_hook(hook)
+    await HookedNote.get(id=1)
+    assert len(hook.after) == 4
+    await mapper.delete_table()
+    await Postmodel.close()
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log(db_url):
+    await Postmodel.init(db_url + "&slow_query=0.05", modules=[__name__])
+    mapper = Postmodel.get_mapper(HookedNote)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+    slow_log = Postmodel.get_database().query_hooks[0]
+    assert isinstance(slow_log, SlowQueryLog)
+    assert slow_log.threshold == 0.05
+
+    logged = []
+    async def after_query(event):
+        if event.duration >= slow_log.threshold:
+            logged.append(event.fingerprint)
+    slow_log.after_query = after_query
+    await HookedNote.get_or_none(id=1)
+    await Postmodel.get_database().execute_query("SELECT pg_sleep(0.06)")
+    assert logged == ["SELECT pg_sleep(?)"]
+    del slow_log.after_query
+    await Postmodel.get_database().execute_query("SELECT pg_sleep(0.06)")
+
+    await mapper.delete_table()
+    await Postmodel.close()
@@ -0,0 +1,73 @@
+
+from postmodel import Postmodel
+from postmodel import models
+from postmodel.exceptions import IntegrityError, OperationalError
+from postmodel.sqldb.metrics import Histogram
+from postmodel.transaction import in_transaction
+import pytest
+
+
+class MeteredNote(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "metered_note"
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    assert histogram.snapshot() == {
+        "buckets": {0.1: 2, 1: 3, "+Inf": 4}, "sum": 2.65, "count": 4}
+
+
+@pytest.mark.asyncio
+async def test_database_metrics(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    mapper = Postmodel.get_mapper(MeteredNote)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+
+    await MeteredNote.create(id=1, name="a")
+    await MeteredNote.bulk_create([MeteredNote(id=2, name="b"), MeteredNote(id=3, name="c")])
+    assert len(await MeteredNote.all()) == 3
+    assert await MeteredNote.all().count() == 3
+    await MeteredNote.filter(id=3).update(name="d")
+    await MeteredNote.filter(id=3).delete()
+    with pytest.raises(IntegrityError):
+        await MeteredNote.create(id=1, name="e")
+    async with in_transaction():
+        await MeteredNote.get(id=1)
+
+    metrics = Postmodel.get_metrics()["default"]
+    assert metrics["pool"]["max_size"] == 30
+    assert metrics["pool"]["size"] == metrics["pool"]["in_use"] + metrics["pool"]["idle"]
+    operations = metrics["operations"]
+    assert operations["insert"]["count"] == 1
+    assert operations["bulk"]["count"] == 1
+    assert operations["count"]["count"] == 1
+    assert operations["update"]["count"] == 1
+    assert operations["delete"]["count"] == 1
+    assert operations["query"]["count"] >= 2
+    assert operations["query"]["buckets"]["+Inf"] == operations["query"]["count"]
+    assert metrics["rows"]["insert"] == 1
+    assert metrics["rows"]["bulk"] == 2
+    assert metrics["rows"]["update"] == 1
+    assert metrics["errors"] == {"IntegrityError": 1}
+    assert metrics["acquire_wait"]["count"] >= 8
+
+    text = Postmodel.get_metrics_text()
+    assert text.count("# TYPE postmodel_query_duration_seconds histogram") == 1
+    assert 'postmodel_pool_max_size{db="default"} 30' in text
+    assert 'postmodel_query_duration_seconds_bucket{db="default",operation="bulk",le="+Inf"} 1' in text
+    assert 'postmodel_rows_total{db="default",operation="bulk"} 2' in text
+    assert 'postmodel_errors_total{db="default",error="IntegrityError"} 1' in text
+
+    # failed reads are counted once
+    await mapper.delete_table()
+    with pytest.raises(OperationalError):
+        await MeteredNote.all()
+    assert Postmodel.get_metrics()["default"]["errors"] == {"IntegrityError": 1, "OperationalError": 1}
+    await Postmodel.close()
@@ -1,5 +1,6 @@
 
 from postmodel import Postmodel
+import asyncio
 import pytest
 from postmodel import models
 from basepy.asynclog import logger
@@ -85,4 +86,57 @@ async def test_database_transaction(db_url):
     async with db.in_transaction():
         with pytest.raises(Exception):
             db.in_transaction()
-    await Postmodel.close()
\ No newline at end of file
+    await Postmodel.close()
+
+async def terminate_listener(db):
+    listener = db._listener
+    await db.execute_script(
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+        f"WHERE pid = {listener.get_server_pid()}")
+    for _ in range(300):
+        if db._listener is not listener:
+            break
+        await asyncio.sleep(0.01)
+
+@pytest.mark.asyncio
+async def test_database_listener_reconnect(db_url, monkeypatch):
+    await Postmodel.init(db_url, modules=[__name__])
+    db = Postmodel.get_database()
+    received = []
+    def failed_callback(payload):
+        raise ValueError("callback failed")
+    # failed callbacks do not stop others
+    await db.listen("reconnect_failed", failed_callback)
+    await db.listen("reconnect_test", received.append)
+
+    # unexpected errors of reconnecting are retried
+    connect = db._connect_listener
+    attempts = []
+    async def flaky_connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OSError("connection refused")
+        await connect()
+    monkeypatch.setattr(db, "_connect_listener", flaky_connect)
+    await terminate_listener(db)
+    await asyncio.wait_for(db._reconnect_task, 5)
+    assert len(attempts) == 2
+    assert db._listener is not None
+    assert received == [None]
+    await db.notify("reconnect_test", "x")
+    for _ in range(300):
+        if len(received) == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert received == [None, "x"]
+
+    # closing database cancels reconnecting
+    async def failed_connect():
+        raise DBConnectionError("connection refused")
+    monkeypatch.setattr(db, "_connect_listener", failed_connect)
+    await terminate_listener(db)
+    task = db._reconnect_task
+    assert not task.done()
+    await Postmodel.close()
+    assert task.cancelled()
+    assert db._reconnect_task is None
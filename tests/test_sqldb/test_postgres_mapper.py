@@ -4,6 +4,7 @@ import pytest
 from postmodel.exceptions import (
     IntegrityError,
     OperationalError,
+    FieldError,
     DoesNotExist,
     MultipleObjectsReturned)
 import asyncio
@@ -189,4 +190,27 @@ async def test_mapper_functions_1(db_url):
     foo = foo[0]
     assert foo.foo_id == 6
 
-    await Postmodel.close()
\ No newline at end of file
+    await Postmodel.close()
+
+
+@pytest.mark.asyncio
+async def test_mapper_subquery_criterion(db_url):
+    await Postmodel.init(db_url, modules=[__name__])
+    mapper = Postmodel.get_mapper(Foo)
+    queryset = Foo.filter(name="a", foo_id__in=Book.filter(name="b").values("id"), tag="c")
+    sql, values = mapper._get_query_sql(queryset)
+    assert sql == ('SELECT "foo_id","name","tag","memo" FROM "single_primary_foo" '
+        'WHERE "name"=$1 AND "foo_id" IN (SELECT "id" FROM "book" WHERE "name"=$2) AND "tag"=$3')
+    assert values == ["a", "b", "c"]
+
+    criterion, values = mapper._expressions_to_criterion(
+        [Q(foo_id__not_in=Book.filter(id__gt=3).limit(5))], 1)
+    assert criterion.get_sql() == '"foo_id" NOT IN (SELECT "id" FROM "book" WHERE "id">$2 LIMIT 5)'
+    assert values == [3]
+
+    with pytest.raises(OperationalError):
+        mapper._expressions_to_criterion([Q(foo_id__in=Book.all().values("id", "name"))], 0)
+    with pytest.raises(FieldError):
+        mapper._expressions_to_criterion([Q(foo_id__gt=Book.all().values("id"))], 0)
+
+    await Postmodel.close()
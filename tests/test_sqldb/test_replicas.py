@@ -0,0 +1,133 @@
+
+from postmodel import Postmodel
+from postmodel import models
+from postmodel.sqldb.base import DatabaseGroup, current_write_map
+from postmodel.transaction import in_transaction
+from postmodel.exceptions import ConfigurationError
+from types import SimpleNamespace
+from contextvars import ContextVar
+import asyncio
+import time
+import pytest
+
+
+class Note(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "replica_note"
+
+
+def forget_writes():
+    current_write_map['default'].set(0)
+
+
+@pytest.mark.asyncio
+async def test_replica_reads(db_url, db_url2):
+    with pytest.raises(ConfigurationError):
+        await Postmodel.init(db_url, replica_urls=[db_url2], replica_policy='random')
+    with pytest.raises(ConfigurationError):
+        await Postmodel.init(db_url, replica_urls={'db2': [db_url2]})
+    await Postmodel.close()
+
+    await Postmodel.init(db_url, replica_urls=[db_url2], modules=[__name__], read_your_writes=30)
+    replica = Postmodel.get_database('default_replica0')
+    assert replica.replica_of == 'default'
+    for db_name in ('default', 'default_replica0'):
+        await Postmodel.get_mapper(Note, db_name).delete_table()
+    await Postmodel.generate_schemas()
+    await Postmodel.get_mapper(Note, 'default_replica0').create_table()
+    await replica.execute_script("INSERT INTO replica_note (id, name) VALUES (1, 'replica')")
+
+    # writes and reads after them in the same context go to primary
+    await Note.create(id=1, name='primary')
+    assert (await Note.get(id=1)).name == 'primary'
+
+    forget_writes()
+    assert (await Note.get(id=1)).name == 'replica'
+    assert await Note.filter(name='primary').count() == 0
+    async with in_transaction():
+        assert (await Note.get(id=1)).name == 'primary'
+        assert await Note.filter(name='primary').count() == 1
+    assert await Note.filter(id=1).update(name='updated') == 1
+    assert (await Note.get(id=1)).name == 'updated'
+
+    # window of writes in transaction starts again at commit
+    forget_writes()
+    async with in_transaction():
+        await Note.create(id=2, name='two')
+        current_write_map['default'].set(1)
+    assert current_write_map['default'].get() > 1
+    assert (await Note.get(id=2)).name == 'two'
+
+    for db_name in ('default', 'default_replica0'):
+        await Postmodel.get_mapper(Note, db_name).delete_table()
+    await Postmodel.close()
+
+
+def test_database_group():
+    def database(name, in_use=0):
+        return SimpleNamespace(name=name, _current_transacted_conn=lambda: None,
+            connections_in_use=lambda: in_use)
+
+    primary = database('group_primary')
+    replicas = [database('r0', 3), database('r1', 1), database('r2', 1)]
+    current_write_map['group_primary'] = ContextVar('LastWrite', default=0)
+    group = DatabaseGroup(primary, replicas)
+    assert [group.read_database().name for _ in range(4)] == ['r0', 'r1', 'r2', 'r0']
+    group = DatabaseGroup(primary, replicas, policy='least_loaded')
+    assert [group.read_database().name for _ in range(3)] == ['r1', 'r1', 'r2']
+    assert DatabaseGroup(primary, []).read_database() is primary
+
+
+@pytest.mark.asyncio
+async def test_replica_lag(db_url, db_url2, monkeypatch):
+    await Postmodel.init(db_url, extra_db_urls={'reporting': db_url2 + '&replica_of=default'},
+        modules=[__name__], replica_lag_interval=0.05)
+    reporting = Postmodel.get_database('reporting')
+    assert reporting.replica_of == 'default'
+    # not in recovery, so never behind
+    stats = Postmodel.get_replica_lag()['reporting']
+    assert stats['lag'] == 0 and stats['lag_bytes'] == 0 and stats['errors'] == 0
+    for db_name in ('default', 'reporting'):
+        await Postmodel.get_mapper(Note, db_name).delete_table()
+        await Postmodel.get_mapper(Note, db_name).create_table()
+    await reporting.execute_script("INSERT INTO replica_note (id, name) VALUES (1, 'replica')")
+    await Postmodel.get_database().execute_script("INSERT INTO replica_note (id, name) VALUES (1, 'primary')")
+
+    assert (await Note.get(id=1).using_db('reporting', max_lag=1)).name == 'replica'
+    assert (await Note.get(id=1)).name == 'replica'
+
+    async def lagging(primary=None):
+        reporting.lag = 5.0
+        reporting.lag_sampled_at = time.monotonic()
+
+    monkeypatch.setattr(reporting, 'sample_lag', lagging)
+    await asyncio.sleep(0.1)
+    assert (await Note.get(id=1).using_db('reporting', max_lag=1)).name == 'primary'
+    assert await Note.filter(name='replica').using_db('reporting', max_lag=1).count() == 0
+    assert (await Note.get(id=1).using_db('default', max_lag=10)).name == 'replica'
+    assert (await Note.get(id=1).using_db('default', max_lag=1)).name == 'primary'
+    assert (await Note.get(id=1).using_db('reporting')).name == 'replica'
+    assert Postmodel.get_replica_lag()['reporting']['skips'] == 3
+    monkeypatch.undo()
+
+    # lag is unknown if sampling fails or samples are old
+    async def failing(*args):
+        raise ConnectionError('replica down')
+
+    monkeypatch.setattr(reporting, 'execute_query_dict', failing)
+    assert await reporting.sample_lag() is None
+    assert reporting.lag is None and reporting.lag_errors >= 1
+    assert not reporting.within_lag(10)
+    monkeypatch.undo()
+    await reporting.sample_lag(Postmodel.get_database())
+    assert reporting.within_lag(0)
+    reporting.lag_sampled_at = 1
+    assert not reporting.within_lag(10)
+
+    for db_name in ('default', 'reporting'):
+        await Postmodel.get_mapper(Note, db_name).delete_table()
+    await Postmodel.close()
+    assert Postmodel._lag_tasks == {}
@@ -0,0 +1,148 @@
+
+from postmodel import Postmodel
+from postmodel import models
+from postmodel.sqldb.sharding import ShardedMapper
+from postmodel.transaction import in_transaction
+from postmodel.exceptions import ConfigurationError, OperationalError, DoesNotExist
+import pytest
+
+
+class Event(models.Model):
+    id = models.IntField(pk=True)
+    tenant_id = models.IntField()
+    name = models.CharField(max_length=64, null=True)
+    score = models.IntField(null=True)
+
+    class Meta:
+        table = "sharded_event"
+        shard_key = "tenant_id"
+        shards = ("shard0", "shard1")
+
+
+class TenantEvent(models.Model):
+    id = models.IntField(pk=True)
+    tenant_id = models.IntField()
+
+    class Meta:
+        table = "tenant_event"
+        shard_key = "tenant_id"
+        shards = ("default", "shard1")
+
+
+def test_shard_meta():
+    with pytest.raises(ConfigurationError):
+        class NoShards(models.Model):
+            id = models.IntField(pk=True)
+
+            class Meta:
+                shard_key = "id"
+
+
+async def shard_rows(db_name, table="sharded_event"):
+    rows = await Postmodel.get_database(db_name).execute_query_dict(
+        f"SELECT id FROM {table} ORDER BY id")
+    return [row["id"] for row in rows]
+
+
+@pytest.mark.asyncio
+async def test_sharded_model(db_url, db_url2):
+    await Postmodel.init(db_url, extra_db_urls={"shard0": db_url, "shard1": db_url2},
+        modules=[__name__])
+    mapper = Event.get_mapper()
+    assert isinstance(mapper, ShardedMapper)
+    assert not isinstance(Event.get_mapper("shard1"), ShardedMapper)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+
+    tenants = {}
+    for tenant in range(100):
+        tenants.setdefault(mapper.shard_of(tenant), []).append(tenant)
+    a, b = tenants["shard0"][:2]
+    c, d = tenants["shard1"][:2]
+    assert mapper.shard_of(str(a)) == "shard0"
+
+    # instances are written to shards of their shard key
+    await Event.create(id=1, tenant_id=a, name="a1", score=5)
+    await Event.create(id=2, tenant_id=c, name="c2", score=None)
+    await Event.bulk_create([
+        Event(id=3, tenant_id=b, name="b3", score=7),
+        Event(id=4, tenant_id=d, name="d4", score=1),
+        Event(id=5, tenant_id=c, name="c5", score=7),
+    ])
+    assert await shard_rows("shard0") == [1, 3]
+    assert await shard_rows("shard1") == [2, 4, 5]
+
+    # queries of shard keys run on their shards, others on all shards
+    assert [e.id for e in await Event.filter(tenant_id=c).order_by("id")] == [2, 5]
+    assert [e.id for e in await Event.filter(tenant_id__in=[a, d]).order_by("id")] == [1, 4]
+    assert await Event.filter(tenant_id__in=[]) == []
+    assert [e.id for e in await Event.all().order_by("-score", "id")] == [2, 3, 5, 1, 4]
+    assert [e.id for e in await Event.all().order_by("score", "-id").offset(1).limit(3)] == [1, 5, 3]
+    assert (await Event.get(id=4)).name == "d4"
+    assert (await Event.filter(score=7).order_by("-id").first()).id == 5
+    assert await Event.get_or_none(id=9) is None
+    with pytest.raises(DoesNotExist):
+        await Event.get(id=9)
+    assert await Event.filter(score=7).values("score").distinct() == [{"score": 7}]
+    assert await Event.all().count() == 5
+    assert await Event.filter(tenant_id=c).count() == 2
+
+    event = await Event.get(id=5)
+    event.name = "changed"
+    await event.save()
+    assert (await Event.get(id=5, tenant_id=c)).name == "changed"
+    assert await Event.filter(score=7).update(score=8) == 2
+    assert await Event.filter(score=8).count() == 2
+    await event.delete()
+    assert await Event.filter(name__not="a1").delete() == 3
+    assert [e.id for e in await Event.all()] == [1]
+
+    with pytest.raises(OperationalError):
+        async with in_transaction("shard0"):
+            await Event.all().select_for_update()
+    async with in_transaction("shard0"):
+        assert [e.id for e in await Event.filter(tenant_id=a).select_for_update()] == [1]
+
+    await mapper.delete_table()
+    await Postmodel.close()
+
+
+@pytest.mark.asyncio
+async def test_sharded_default_database(db_url, db_url2):
+    await Postmodel.init(db_url, extra_db_urls={"shard0": db_url, "shard1": db_url2},
+        modules=[__name__])
+    # database of model is one of its shards, only using_db chooses it alone
+    mapper = TenantEvent.get_mapper()
+    assert isinstance(mapper, ShardedMapper)
+    assert not isinstance(TenantEvent.get_mapper("default"), ShardedMapper)
+    await mapper.delete_table()
+    await Event.get_mapper().delete_table()
+    await Postmodel.generate_schemas()
+
+    tenants = {}
+    for tenant in range(100):
+        tenants.setdefault(mapper.shard_of(tenant), []).append(tenant)
+    a, b = tenants["default"][0], tenants["shard1"][0]
+    await TenantEvent.create(id=1, tenant_id=a)
+    await TenantEvent.create(id=2, tenant_id=b)
+    await TenantEvent.bulk_create([TenantEvent(id=3, tenant_id=b)])
+    assert await shard_rows("default", "tenant_event") == [1]
+    assert await shard_rows("shard1", "tenant_event") == [2, 3]
+    assert [e.id for e in await TenantEvent.all().order_by("id")] == [1, 2, 3]
+    assert (await TenantEvent.get(id=3)).tenant_id == b
+    assert await TenantEvent.all().count() == 3
+    assert [e.id for e in await TenantEvent.all().using_db("default")] == [1]
+    assert await TenantEvent.all().using_db("default").count() == 1
+
+    with pytest.raises(OperationalError, match="subquery of sharded model"):
+        await TenantEvent.filter(id__in=Event.filter(score=7).values("id"))
+    TenantEvent._meta.replicate_in_memory = True
+    try:
+        with pytest.raises(ConfigurationError, match="replicated in memory"):
+            await Postmodel._start_replicas()
+    finally:
+        TenantEvent._meta.replicate_in_memory = False
+
+    await mapper.delete_table()
+    await Event.get_mapper().delete_table()
+    await Postmodel.close()
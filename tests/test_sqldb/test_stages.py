@@ -0,0 +1,45 @@
+
+from postmodel import Postmodel
+from postmodel import models
+from postmodel.sqldb.stages import query_stages, current_query_stages, STAGES
+import pytest
+
+
+class StagedNote(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "staged_note"
+
+
+@pytest.mark.asyncio
+async def test_query_stages(db_url):
+    await Postmodel.init(db_url, modules=[__name__], query_stages=True)
+    mapper = Postmodel.get_mapper(StagedNote)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+    await StagedNote.bulk_create([StagedNote(id=i, name=str(i)) for i in range(10)])
+
+    assert current_query_stages.get() is None
+    async with query_stages() as totals:
+        assert current_query_stages.get() is totals
+        assert len(await StagedNote.all()) == 10
+        assert len(await StagedNote.filter(id__lt=5).values("id", "name")) == 5
+    assert current_query_stages.get() is None
+    assert totals.queries == 2
+    for stage in ('compile', 'acquire', 'execute', 'decode', 'hydrate'):
+        assert totals.stages[stage] > 0
+    assert totals.total() == sum(totals.stages.values())
+    await StagedNote.get(id=1)
+    assert totals.queries == 2
+
+    stats = Postmodel.get_query_stages()
+    assert stats["models"]["StagedNote"]["queries"] == 3
+    assert set(stats["models"]["StagedNote"]) == {"queries", "total", *STAGES}
+    assert stats["fingerprints"]['SELECT "id","name" FROM "staged_note" WHERE "id"=? LIMIT ?']["queries"] == 1
+    assert stats["fingerprints"]['SELECT "id","name" FROM "staged_note"']["hydrate"] > 0
+
+    await mapper.delete_table()
+    await Postmodel.close()
+    assert Postmodel.get_query_stages() is None
@@ -0,0 +1,77 @@
+
+from postmodel import Postmodel
+from postmodel import models
+from postmodel.sqldb.hooks import QueryEvent
+from postmodel.sqldb.statements import StatementStats
+import asyncio
+import json
+import pytest
+
+
+class CountedNote(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "counted_note"
+
+
+def event(sql, duration, rows=1):
+    event = QueryEvent("default", sql, "query", 1, False)
+    event.duration = duration
+    event.rows = rows
+    return event
+
+
+@pytest.mark.asyncio
+async def test_statement_stats_bounded():
+    stats = StatementStats(max_statements=10)
+    for i in range(10):
+        await stats.after_query(event(f'SELECT * FROM "t{i}" WHERE "id"=$1', 0.001))
+    for _ in range(3):
+        await stats.after_query(event('SELECT * FROM "t0" WHERE "id"=$1', 0.002, rows=2))
+    # high cardinality SQL drops statements with fewest calls
+    await stats.after_query(event('SELECT * FROM "t10"', 0.5, rows=0))
+    assert len(stats.entries) == 10
+    assert stats.dropped == 1
+    top = stats.top(2)
+    assert top[0]["fingerprint"] == 'SELECT * FROM "t10"'
+    assert top[0]["p99"] <= 0.5
+    assert top[1]["calls"] == 4
+    assert top[1]["rows_per_call"] == 1.75
+    assert top[1]["max_time"] == 0.002
+    assert stats.top(1, order_by="calls")[0]["calls"] == 4
+    with pytest.raises(ValueError):
+        stats.top(order_by="rows")
+    stats.reset()
+    assert stats.top() == []
+
+
+@pytest.mark.asyncio
+async def test_statement_stats(db_url, tmp_path):
+    path = tmp_path / "statements.json"
+    await Postmodel.init(db_url, modules=[__name__], statement_stats=True,
+        statement_stats_file=str(path), statement_stats_interval=0.05)
+    mapper = Postmodel.get_mapper(CountedNote)
+    await mapper.delete_table()
+    await Postmodel.generate_schemas()
+    Postmodel.reset_statement_stats()
+
+    await CountedNote.bulk_create([CountedNote(id=i, name=str(i)) for i in range(5)])
+    for i in range(5):
+        await CountedNote.get(id=i)
+    top = Postmodel.get_statement_stats(order_by="calls")
+    assert top[0]["fingerprint"] == 'SELECT "id","name" FROM "counted_note" WHERE "id"=? LIMIT ?'
+    assert top[0]["model"] == "CountedNote"
+    assert top[0]["calls"] == 5
+    assert top[0]["rows_per_call"] == 1
+
+    await asyncio.sleep(0.1)
+    with open(path) as f:
+        snapshot = json.load(f)
+    assert {item["fingerprint"] for item in snapshot["statements"]} == \
+        {item["fingerprint"] for item in Postmodel.get_statement_stats()}
+
+    await mapper.delete_table()
+    await Postmodel.close()
+    assert Postmodel.get_statement_stats() is None
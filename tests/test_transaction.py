@@ -1,8 +1,9 @@
-from tests.testmodels import Foo
-from postmodel.exceptions import OperationalError
+from tests.testmodels import Foo, Job
+from postmodel.exceptions import OperationalError, TransactionManagementError, ParamsError
 from postmodel.transaction import atomic, in_transaction
 from postmodel import Postmodel
 import pytest
+import asyncio
 
 @atomic()
 async def atomic_decorated_func():
@@ -61,3 +62,44 @@ async def test_transaction_1(db_url):
     mapper = Postmodel.get_mapper(Foo)
     await mapper.delete_table()
     await Postmodel.close()
+
+
+@pytest.mark.asyncio
+async def test_select_for_update(db_url):
+    await Postmodel.init(db_url, modules=["tests.testmodels"])
+    await Postmodel.generate_schemas()
+    await Job.all().delete()
+    await Job.bulk_create([Job(id=i) for i in range(1, 5)])
+
+    with pytest.raises(TransactionManagementError):
+        await Job.filter(id=1).select_for_update()
+    with pytest.raises(ParamsError):
+        Job.all().select_for_update(skip_locked=True, nowait=True)
+
+    locked = asyncio.Event()
+    release = asyncio.Event()
+
+    async def hold_lock():
+        async with in_transaction():
+            jobs = await Job.filter(id__lte=2).select_for_update(of=(Job,))
+            assert len(jobs) == 2
+            locked.set()
+            await release.wait()
+
+    task = asyncio.ensure_future(hold_lock())
+    await locked.wait()
+    async with in_transaction():
+        jobs = await Job.all().order_by("id").select_for_update(skip_locked=True)
+        assert [job.id for job in jobs] == [3, 4]
+    with pytest.raises(OperationalError):
+        async with in_transaction():
+            await Job.filter(id=1).select_for_update(nowait=True)
+    release.set()
+    await task
+
+    async with in_transaction():
+        jobs = await Job.filter(id__lte=2).select_for_update(nowait=True)
+        assert len(jobs) == 2
+
+    await Job.all().delete()
+    await Postmodel.close()
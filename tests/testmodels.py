@@ -42,6 +42,92 @@ class Book(models.Model):
     class Meta:
         table = "book"
 
+class Counter(models.Model):
+    id = models.IntField(pk=True)
+    count = models.IntField(default=0)
+    balance = models.DecimalField(max_digits=18, decimal_places=2, default=0)
+    updated = models.DatetimeField(auto_now=True)
+    data_ver = models.DataVersionField()
+
+    class Meta:
+        table = "counter"
+
+class Job(models.Model):
+    id = models.IntField(pk=True)
+    status = models.CharField(max_length=32, default="pending")
+    worker = models.CharField(max_length=64, null=True)
+    attempts = models.IntField(default=0)
+
+    class Meta:
+        table = "job"
+
+class Author(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "author"
+
+class Article(models.Model):
+    id = models.IntField(pk=True)
+    title = models.CharField(max_length=128)
+    author = models.ForeignKeyField(Author)
+    editor = models.ForeignKeyField(Author, null=True, on_delete="SET NULL")
+
+    class Meta:
+        table = "article"
+
+class Category(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+    parent = models.ForeignKeyField("self", null=True)
+
+    class Meta:
+        table = "category"
+
+class Profile(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+    balance = models.DecimalField(max_digits=18, decimal_places=2, default=0)
+    avatar = models.BinaryField(null=True)
+    settings = models.JSONField(default=dict)
+    updated = models.DatetimeField(auto_now=True)
+    data_ver = models.DataVersionField()
+
+    class Meta:
+        table = "profile"
+        cache = True
+
+class Tag(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "tag"
+        cache = True
+
+class City(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+    country = models.CharField(max_length=8)
+    population = models.IntField(index=True)
+    founded = models.DateField(null=True)
+
+    class Meta:
+        table = "city"
+        replicate_in_memory = True
+        indexes = (("country", "name"), )
+
+class CityVisit(models.Model):
+    city_id = models.IntField()
+    day = models.IntField()
+    visitors = models.IntField(default=0)
+
+    class Meta:
+        table = "city_visit"
+        primary_key = ("city_id", "day")
+        replicate_in_memory = True
+
 class IntFieldsModel(models.Model):
     id = models.IntField(pk=True)
     intnum = models.IntField()
@@ -136,3 +222,53 @@ class UUIDFieldsModel(models.Model):
     data = models.UUIDField()
     data_auto = models.UUIDField(default=uuid.uuid4)
     data_null = models.UUIDField(null=True)
+
+
+class EvaluatorSample(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=32, null=True)
+    amount = models.IntField(null=True)
+    ratio = models.FloatField(null=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    day = models.DateField(null=True)
+    at = models.DatetimeField(null=True)
+    flag = models.BooleanField(null=True)
+    uid = models.UUIDField(null=True)
+    span = models.TimeDeltaField(null=True)
+    data = models.JSONField(null=True)
+
+    class Meta:
+        table = "evaluator_sample"
+
+
+class Member(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+
+    class Meta:
+        table = "member"
+        negative_cache = 100
+        negative_cache_ttl = 30
+
+
+class Label(models.Model):
+    id = models.IntField(pk=True)
+    name = models.CharField(max_length=64)
+    data_ver = models.DataVersionField()
+
+    class Meta:
+        table = "label"
+        cache = True
+        cache_local_ttl = 30
+        cache_local_size = 2
+
+
+class Badge(models.Model):
+    id = models.UUIDField(pk=True)
+    name = models.CharField(max_length=64)
+    data_ver = models.DataVersionField()
+
+    class Meta:
+        table = "badge"
+        cache = True
+        cache_local_ttl = 30